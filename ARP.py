@@ -1,9 +1,151 @@
 from Headers import *
 from Debug import *
+from concurrent.futures import Future
+from collections import OrderedDict
+import threading
+import time
+
+INCOMPLETE = "INCOMPLETE"   # Request sent, no reply yet; never handed out as a MAC
+REACHABLE = "REACHABLE"     # Confirmed by a reply within reachable_time
+STALE = "STALE"             # Older than that. Still used, but reprobed once it is
+
+
+class NeighborTable:
+    """
+    An ARP cache along the lines of an RFC 4861 neighbor cache. Resolved
+    entries are kept least recently used first, so garbage collecting unused
+    ones and evicting at max_size only ever look at the front. Lookups only
+    ever return a MAC, or None while unresolved.
+
+        table.markIncomplete(ip)    # Request sent
+        table.confirm(ip, mac)      # Reply received: REACHABLE
+        table.get(ip)               # mac, None if missing or INCOMPLETE
+        table.expire()              # Periodically; returns IPs to reprobe
+
+    Not thread safe, even get() reorders the table. ARPHandler only touches
+    it holding ARPHandler.lock; look up MACs with `ARPHandler.lookup()`.
+    """
+    def __init__(self, clock=time.time, reachable_time=30, gc_time=60, incomplete_time=5, max_size=1024):
+        """
+        :param clock: Function returning the current time, see `Device.clock()`
+        :param reachable_time: Seconds after a reply that an entry goes STALE
+        :param gc_time: Seconds an entry may go unused before it's dropped
+        :param incomplete_time: Seconds to wait on a request, or a reprobe of a STALE entry
+        :param max_size: Resolved entries kept before evicting the least recently used
+        """
+        self.clock = clock
+        self.reachable_time = reachable_time
+        self.gc_time = gc_time
+        self.incomplete_time = incomplete_time
+        self.max_size = max_size
+
+        self.entries = OrderedDict()    # IP: [MAC, confirmed at, used at], least recently used first
+        self.incomplete = OrderedDict() # IP: requested at, oldest first
+        self.probing = {}               # IP: reprobed at, for STALE entries in use
+        self.evicted = 0
+
+    def get(self, ip, default=None):
+        """
+        :returns: The MAC for ip, or default if it's missing or INCOMPLETE
+        """
+        entry = self.entries.get(ip)
+        if entry is None:
+            return default
+        now = self.clock()
+        entry[2] = now
+        self.entries.move_to_end(ip)
+        if now - entry[1] >= self.reachable_time and ip not in self.probing:
+            self.probing[ip] = None # Due a reprobe, see expire()
+        return entry[0]
+
+    def state(self, ip):
+        """
+        :returns: INCOMPLETE, REACHABLE, STALE, or None if there's no entry
+        """
+        entry = self.entries.get(ip)
+        if entry is not None:
+            return REACHABLE if self.clock() - entry[1] < self.reachable_time else STALE
+        return INCOMPLETE if ip in self.incomplete else None
+
+    def markIncomplete(self, ip):
+        """
+        A request for ip is going out. Resolved entries keep their MAC meanwhile
+        """
+        if ip not in self.entries and ip not in self.incomplete:
+            self.incomplete[ip] = self.clock()
+
+    def confirm(self, ip, mac):
+        """
+        A reply came in: ip is at mac, as of now
+        """
+        now = self.clock()
+        self.incomplete.pop(ip, None)
+        self.probing.pop(ip, None)
+        entry = self.entries.get(ip)
+        if entry is None:
+            if len(self.entries) >= self.max_size:
+                old, _ = self.entries.popitem(last=False)
+                self.probing.pop(old, None)
+                self.evicted += 1
+            self.entries[ip] = [mac, now, now]
+            return
+        entry[0] = mac
+        entry[1] = entry[2] = now
+        self.entries.move_to_end(ip)
+
+    def discardIncomplete(self, ip):
+        """
+        Give up on a request. Does nothing to a resolved entry
+        """
+        self.incomplete.pop(ip, None)
+
+    def remove(self, ip):
+        self.entries.pop(ip, None)
+        self.incomplete.pop(ip, None)
+        self.probing.pop(ip, None)
+
+    def expire(self):
+        """
+        Drop unused entries and requests nobody answered, and find the STALE
+        entries still in use that need reprobing
+
+        :returns: IPs to send a probe to, [IP]
+        """
+        now = self.clock()
+        while self.entries:
+            ip, entry = next(iter(self.entries.items()))
+            if now - entry[2] < self.gc_time:
+                break
+            del self.entries[ip]
+            self.probing.pop(ip, None)
+        while self.incomplete:
+            ip, since = next(iter(self.incomplete.items()))
+            if now - since < self.incomplete_time:
+                break
+            del self.incomplete[ip]
+
+        probe = []
+        for ip, since in list(self.probing.items()):
+            if since is None:
+                self.probing[ip] = now
+                probe.append(ip)
+            elif now - since >= self.incomplete_time:
+                # Went quiet; forget it so the next use asks again
+                self.remove(ip)
+        return probe
+
+    def __contains__(self, ip):
+        return ip in self.entries or ip in self.incomplete
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return repr({ip: entry[0] for ip, entry in self.entries.items()})
 
 
 class ARPHandler:
-    def __init__(self, ID, linkid, ip=None, debug=1):
+    def __init__(self, ID, linkid, ip=None, debug=1, clock=time.time):
         self.DEBUG = debug
         self.id = ID
         self.linkid = linkid
@@ -17,22 +159,87 @@ class ARPHandler:
         #    self.getIP = None
 
         # x.x.x.x = -H-123123123
-        self.arp_cache = {} # IP to MAC/ID 
+        self.arp_cache = NeighborTable(clock) # IP to MAC/ID
+
+        # Requests still waiting on a reply: IP to [Future of the target's ID,
+        # number of callers waiting on it]. There's only ever one request out
+        # per IP; everyone resolving it shares the Future, which handleARP()
+        # resolves. See `Device.sendARP()`
+        self.waiting = {}
+        self.lock = threading.Lock() # Callers may be on several threads
+
+    def lookup(self, ip):
+        """
+        :returns: The MAC cached for ip, or None, see `NeighborTable.get()`
+        """
+        with self.lock:
+            return self.arp_cache.get(ip)
+
+    def resolve(self, targetIP):
+        """
+        Wait on targetIP's resolution, starting it if nobody else has
+
+        :param targetIP: IP
+        :returns: (Future of the target's ID, the request to send or None if one is already out)
+        """
+        with self.lock:
+            pending = self.waiting.get(targetIP)
+            if pending is not None:
+                pending[1] += 1
+                if self.DEBUG == 2:
+                    Debug(self.id, "joining ARP request for", targetIP,
+                        color="blue", f=self.__class__.__name__
+                    )
+                return pending[0], None
+            pending = self.waiting[targetIP] = [Future(), 1]
+            self.arp_cache.markIncomplete(targetIP)
+        return pending[0], self._request(targetIP)
+
+    def abandon(self, targetIP, future=None):
+        """
+        Stop waiting on targetIP. Once nobody is, the request is given up on
+        and the next resolve() sends a new one
+
+        :param future: The Future a timed out resolve() waited on, or None
+            for a request nobody waits on, see sendARP()
+        """
+        with self.lock:
+            pending = self.waiting.get(targetIP)
+            if pending is None or (future is not None and pending[0] is not future):
+                return # Already answered, or a newer request
+            if future is not None:
+                pending[1] -= 1
+            if pending[1] <= 0:
+                del self.waiting[targetIP]
+                self.arp_cache.discardIncomplete(targetIP)
 
     def sendARP(self, targetIP):
         """ 
-        ARP Wrapper for self.send()
+        Start resolving targetIP without waiting on it, e.g. for a Router to
+        queue frames behind. Give up with abandon(targetIP)
 
         :param targetID: The IP of the target device
-        :param onlinkID: Link to be sent on, default None targets first link on self.links
-        :returns: The response packet, dict
-        :returns: The linkID it should be sent out on, str
+        :returns: The request to send, Packet, or None if one is already out
         """
-        
-        # Set the IP to a missing value, to be checked later
-        # once the response comes in
-        self.arp_cache[targetIP] = False
-        
+        with self.lock:
+            if targetIP in self.waiting:
+                return None
+            self.waiting[targetIP] = [Future(), 0]
+            self.arp_cache.markIncomplete(targetIP)
+        return self._request(targetIP)
+
+    def announce(self):
+        """
+        :returns: A gratuitous ARP for our own IP, broadcast so every neighbor caches it, Packet
+        """
+        if self.DEBUG:
+            Debug(self.id, "announcing", self.ip,
+                color="green", f=self.__class__.__name__
+            )
+        ARP = createARPHeader(1, self.id, self.ip, 0, self.ip)
+        return makePacket(makePacket_L2("ARP", self.id, MAC_BROADCAST, data=ARP))
+
+    def _request(self, targetIP):
         if self.DEBUG:
             Debug(self.id, "sending ARP request to", targetIP,
                 color="green", f=self.__class__.__name__
@@ -51,8 +258,8 @@ class ARPHandler:
         """ 
         Process an ARP request and generate a response
         
-        :param data: See `Headers.makePacket()`, dict
-        :returns: The response packet, dict
+        :param data: See `Headers.makePacket()`, Packet
+        :returns: The response packet, Packet
         :returns: The linkID it should be sent out on, str
         """
         # If an ip function hasnt been provided to the class, then this device has no IP,
@@ -65,16 +272,35 @@ class ARPHandler:
             return
 
         # Receiving an ARP Request
-        if data["L2"]["To"] == MAC_BROADCAST and data["L2"]["Data"]["OP"] == 1:
+        # Gratuitous: someone announcing their own IP, see announce()
+        if data.L2.Data.OP == 1 and data.L2.Data.SPA == data.L2.Data.TPA:
+            if data.L2.Data.SPA == self.ip:
+                Debug(self.id, "IP conflict: ", self.ip, "is also used by", data.L2.Data.SHA,
+                    color="red", f=self.__class__.__name__
+                )
+                return None
+            if self.DEBUG == 2:
+                Debug(self.id, "learned", data.L2.Data.SPA, "=", data.L2.Data.SHA, "from gratuitous ARP",
+                    color="blue", f=self.__class__.__name__
+                )
+            with self.lock:
+                self.arp_cache.confirm(data.L2.Data.SPA, data.L2.Data.SHA)
+                pending = self.waiting.pop(data.L2.Data.SPA, None)
+            if pending and not pending[0].done():
+                pending[0].set_result(data.L2.Data.SHA)
+            return None
+
+        # Broadcast, or unicast when reprobing a STALE entry, see expire()
+        if data.L2.To in (MAC_BROADCAST, self.id) and data.L2.Data.OP == 1:
             
             # Do I have the IP requested?
-            if self.ip == data["L2"]["Data"]["TPA"]:
+            if self.ip == data.L2.Data.TPA:
                 if self.DEBUG:
-                    Debug(self.id, "got Request from", data["L2"]["From"], "- sending Response",
+                    Debug(self.id, "got Request from", data.L2.From, "- sending Response",
                         color="green", f=self.__class__.__name__
                     )
-                ARP = createARPHeader(2, fr=self.id, frIP=self.ip, to=data["L2"]["Data"]["SHA"], toIP=data["L2"]["Data"]["SPA"])
-                p2 = makePacket_L2("ARP", self.id, data["L2"]["From"], data=ARP) # Resp has no data
+                ARP = createARPHeader(2, fr=self.id, frIP=self.ip, to=data.L2.Data.SHA, toIP=data.L2.Data.SPA)
+                p2 = makePacket_L2("ARP", self.id, data.L2.From, data=ARP) # Resp has no data
                 p = makePacket(p2)
                 return p#, interface
             #else:
@@ -83,8 +309,8 @@ class ARPHandler:
             
         
         # Receiving an ARP Response
-        elif data["L2"]["To"] == self.id and data["L2"]["Data"]["OP"] == 2:
-            if data["L2"]["Data"]["SPA"] not in self.arp_cache:
+        elif data.L2.To == self.id and data.L2.Data.OP == 2:
+            if data.L2.Data.SPA not in self.arp_cache and data.L2.Data.SPA not in self.waiting:
                 # Produced if the IP that gets updated is not the one I requested originally
                 Debug(self.id, "Got ARP response for a missing IP - did I request this? Dropping frame", self.arp_cache,
                     color="yellow", f=self.__class__.__name__
@@ -92,7 +318,7 @@ class ARPHandler:
                 return None
 
             if self.DEBUG:
-                Debug(self.id, "updating ARP cache:", data["L2"]["Data"]["SPA"], "=", data["L2"]["From"],
+                Debug(self.id, "updating ARP cache:", data.L2.Data.SPA, "=", data.L2.From,
                     color="green", f=self.__class__.__name__
                 )
 
@@ -103,13 +329,36 @@ class ARPHandler:
 
             # Update the local ARP cache with the received data
             # x.x.x.x = -H-123123123
-            self.arp_cache[data["L2"]["Data"]["SPA"]] = data["L2"]["From"]
+            with self.lock:
+                self.arp_cache.confirm(data.L2.Data.SPA, data.L2.From)
+                pending = self.waiting.pop(data.L2.Data.SPA, None)
+            # Every caller resolving this IP wakes up with the one answer
+            if pending and not pending[0].done():
+                pending[0].set_result(data.L2.From)
             if self.DEBUG == 2:
                 Debug(self.id, "new ARP cache info:", self.arp_cache,
                     color="blue", f=self.__class__.__name__
                 )
 
         else:
-            if self.DEBUG: genericIgnoreMessage("ARP", self.id, data["L2"]["From"])
+            if self.DEBUG: genericIgnoreMessage("ARP", self.id, data.L2.From)
         return None#, None
 
+    def expire(self):
+        """
+        Age the ARP cache, see `NeighborTable.expire()`
+
+        :returns: Unicast requests reprobing STALE entries still in use, [Packet]
+        """
+        probes = []
+        with self.lock:
+            # Requests nobody is waiting on that went unanswered
+            for ip, pending in list(self.waiting.items()):
+                if pending[1] <= 0 and ip not in self.arp_cache:
+                    del self.waiting[ip]
+            # Take the MACs now; an entry may be gone once the lock is let go
+            stale = [(ip, self.arp_cache.entries[ip][0]) for ip in self.arp_cache.expire()]
+        for ip, mac in stale:
+            ARP = createARPHeader(1, self.id, self.ip, mac, ip)
+            probes.append(makePacket(makePacket_L2("ARP", self.id, mac, data=ARP)))
+        return probes
@@ -0,0 +1,81 @@
+import asyncio
+import traceback
+
+# An opt-in asyncio runtime, next to the default threaded one.
+#
+# Devices created while an AsyncRuntime is active get an asyncio.Queue as
+# their listen_buffer and run listen as a task on the current event loop
+# instead of as a thread. Frames are handled inline by that task, and
+# sendARP() / sendICMP() / sendDHCP() return coroutines to be awaited, so
+# thousands of devices can share one event loop.
+#
+#   async def main():
+#       with AsyncRuntime() as rt:
+#           A, B, C, D, R1, R2, S1, S2, S3 = topology1()
+#       await A.sendICMP(B.getIP())
+#       await rt.stop()
+#
+#   asyncio.run(main())
+
+
+class AsyncRuntime:
+
+    # The runtime that newly constructed Devices attach themselves to
+    active = None
+
+    def __init__(self, tick=0.25):
+        """
+        :param tick: Seconds between _checkTimeouts() calls per device, float
+        """
+        self.tick = tick
+        self.loop = None
+        self.devices = []
+        self.tasks = set()
+        self.previous = None
+
+    def __enter__(self):
+        # Must be entered from inside a coroutine; listeners are tasks on this loop
+        self.loop = asyncio.get_running_loop()
+        self.previous = AsyncRuntime.active
+        AsyncRuntime.active = self
+        return self
+
+    def __exit__(self, *exc):
+        AsyncRuntime.active = self.previous
+        self.previous = None
+
+    def addDevice(self, device):
+        """
+        Start a device's listener task, the equivalent of starting its listener thread
+        """
+        self.devices.append(device)
+        self.spawn(device.alisten())
+
+    def spawn(self, coro):
+        """
+        Run a coroutine in the background, keeping a reference so it isn't
+        garbage collected mid-flight
+
+        :returns: asyncio.Task
+        """
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        # Mirror a crashed handler thread: report it and carry on
+        if not task.cancelled() and task.exception():
+            traceback.print_exception(task.exception())
+
+    async def stop(self):
+        """
+        Stop every listener and background task started by this runtime
+        """
+        for device in self.devices:
+            device.stop()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
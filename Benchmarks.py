@@ -0,0 +1,384 @@
+from L2 import *
+from L3 import *
+from Scheduler import Scheduler
+from AsyncRuntime import AsyncRuntime
+from FIB import FIB
+import asyncio
+import argparse
+import time
+import os
+import tempfile
+import tracemalloc
+
+"""
+Rough performance numbers for the simulation itself, meant to be compared
+across runtimes and across changes. Run one with e.g.
+
+    python Benchmarks.py runtimes --pings 50
+"""
+
+def chain(hosts=2, warm=False):
+    """
+    hosts[0] --- S1 --- R1 --- S2 --- hosts[1:]
+
+    :param warm: Fill ARP caches and MAC tables up front, see `L2.preResolve()`
+    :returns: A list of every device, the pinging host first and its target second
+    """
+    A = Host(["1.1.1.2/24"], debug=0)
+    others = [Host(["2.2.2." + str(i + 2) + "/24"], debug=0) for i in range(hosts - 1)]
+    S1 = Switch([A], debug=0)
+    S2 = Switch(others, debug=0)
+    R1 = Router(["1.1.1.1/24", "2.2.2.1/24"], [S1, S2], debug=0)
+
+    A.interfaces[0].gateway = "1.1.1.1/24"
+    for host in others:
+        host.interfaces[0].gateway = "2.2.2.1/24"
+
+    devices = [A] + others + [S1, S2, R1]
+    quiet(devices)
+    if warm:
+        preResolve(devices)
+    return devices
+
+def quiet(devices):
+    """
+    Silence the handlers too, which don't take the device's debug setting
+    """
+    for device in devices:
+        for interface in device.interfaces:
+            for handler in (interface.ARPHandler, interface.ICMPHandler, interface.DHCPClient):
+                if handler: handler.DEBUG = 0
+
+def _report(name, pings, elapsed):
+    print("{:<10} {:>6} pings {:>9.3f}s {:>10.1f} pings/s".format(name, pings, elapsed, pings / elapsed))
+
+def benchThreaded(pings, warm=False):
+    devices = chain(warm=warm)
+    A, B = devices[0], devices[1]
+    start = time.perf_counter()
+    for i in range(pings):
+        A.sendICMP(B.getIP())
+    elapsed = time.perf_counter() - start
+
+    for device in devices:
+        device.stop()
+    for device in devices:
+        device.lthread.join()
+    _report("threaded", pings, elapsed)
+
+def benchAsyncio(pings, warm=False):
+    async def run():
+        with AsyncRuntime() as rt:
+            devices = chain(warm=warm)
+        A, B = devices[0], devices[1]
+        start = time.perf_counter()
+        for i in range(pings):
+            await A.sendICMP(B.getIP())
+        elapsed = time.perf_counter() - start
+        await rt.stop()
+        return elapsed
+    _report("asyncio", pings, asyncio.run(run()))
+
+def benchScheduler(pings, warm=False):
+    with Scheduler():
+        devices = chain(warm=warm)
+    A, B = devices[0], devices[1]
+    start = time.perf_counter()
+    for i in range(pings):
+        A.sendICMP(B.getIP())
+    _report("scheduler", pings, time.perf_counter() - start)
+
+class Sink(L2Device):
+    """
+    Counts the frames it receives and does nothing else, so the device
+    under test is the only thing being measured
+    """
+    def __init__(self):
+        self.received = 0
+        super().__init__([], 0, "-K-" + str(random.randint(10000, 99999999)))
+
+    def handleData(self, data, oninterface):
+        self.received += 1
+
+    def _checkTimeouts(self):
+        return
+
+def switchFlood(ports=48, frames=2000, vlans=1):
+    """
+    Broadcast DHCP Discovers into one Switch port, flooded out of every other
+    port on its VLAN
+
+    :param vlans: Spread the ports over this many VLANs, int
+    :returns: Frames delivered per second, float
+    """
+    with Scheduler() as sim:
+        sinks = [Sink() for i in range(ports)]
+        S1 = Switch(sinks, debug=0)
+    for i, interface in enumerate(S1.interfaces):
+        S1.setAccess(interface, 1 + i % vlans)
+
+    DHCP = createDHCPHeader(chaddr=sinks[0].id, options={53:1, 55:[1, 3, 6]})
+    p = makePacket(
+        makePacket_L2("IPv4", sinks[0].id, MAC_BROADCAST),
+        makePacket_L3("0.0.0.0", IP_BROADCAST, DHCP, "UDP"),
+        makePacket_L4_UDP(68, 67)
+    )
+
+    start = time.perf_counter()
+    for i in range(frames):
+        sinks[0].send(p)
+    sim.run()
+    elapsed = time.perf_counter() - start
+
+    delivered = sum(sink.received for sink in sinks)
+    print("{:<10} {:>6} ports {:>4} VLANs {:>8} frames {:>9.3f}s {:>10.1f} frames/s {:>10.1f} broadcasts/s".format(
+        "switch", ports, vlans, delivered, elapsed, delivered / elapsed, frames / elapsed))
+    return delivered / elapsed
+
+def randomRoutes(n, rng):
+    """
+    :returns: n (prefix, prefixlen) pairs, mostly /24s like a real table
+    """
+    lengths = [8, 12, 16, 20, 22, 24, 24, 24, 24, 28, 32]
+    return [(IP(rng.getrandbits(32)), rng.choice(lengths)) for i in range(n)]
+
+def fibLookups(routes, lookups=100000, linear=False):
+    """
+    Longest prefix match lookups per second against a table of `routes` routes
+
+    :param linear: Also time the old linear scan over the routing table, bool
+    """
+    rng = random.Random(routes)
+    table = randomRoutes(routes, rng)
+    addresses = [rng.getrandbits(32) for i in range(lookups)]
+
+    start = time.perf_counter()
+    fib = FIB()
+    for prefix, prefixlen in table:
+        fib.insert(prefix, prefixlen, prefixlen)
+    built = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ip in addresses:
+        fib.lookup(ip)
+    rate = lookups / (time.perf_counter() - start)
+    print("{:<10} {:>7} routes {:>8.3f}s build {:>12.1f} lookups/s".format(
+        "fib", routes, built, rate))
+
+    if linear:
+        rows = sorted(((prefixToMask(l), prefix & prefixToMask(l), l) for prefix, l in table), key=lambda x: -x[2])
+        sample = addresses[:max(100, lookups // max(1, routes // 10))]
+        start = time.perf_counter()
+        for ip in sample:
+            for mask, dst, prefixlen in rows:
+                if ip & mask == dst:
+                    break
+        elapsed = time.perf_counter() - start
+        print("{:<10} {:>7} routes {:>8}       {:>12.1f} lookups/s".format(
+            "linear", routes, "", len(sample) / elapsed))
+    return rate
+
+def stpRing(switches=8):
+    """
+    Converge Spanning Tree on a ring of switches, then cut a link of the
+    tree and converge again. Times are virtual seconds.
+
+    :returns: Seconds to converge after the link failure, float
+    """
+    with Scheduler() as sim:
+        ring = [Switch([], debug=0, stp=True)]
+        for i in range(switches - 2):
+            ring.append(Switch([ring[-1]], debug=0, stp=True))
+        ring.append(Switch([ring[-1], ring[0]], debug=0, stp=True)) # Close the ring
+
+    start = time.perf_counter()
+    sim.run(until=120)
+    converged = max(S.STPHandler.last_change for S in ring)
+
+    # Cut the first link of the tree, on the root
+    root = min(ring, key=lambda S: S.STPHandler.bridge)
+    port = next(p for p in root.STPHandler.ports.values() if p.state == "forwarding")
+    port.interface.link.up = False
+    failed = sim.now
+    sim.run(until=failed + 120)
+    reconverged = max(S.STPHandler.last_change for S in ring) - failed
+    elapsed = time.perf_counter() - start
+
+    print("{:<10} {:>6} switches {:>8.1f}s converge {:>8.1f}s reconverge {:>8} events {:>9.3f}s".format(
+        "stp", len(ring), converged, reconverged, sim.processed, elapsed))
+    return reconverged
+
+def leaseRestart(leases=100000):
+    """
+    Start a DHCPServer on a lease file holding `leases` leases, as when
+    restarting a simulation
+
+    :returns: Seconds to build the server, leases loaded included, float
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "leases")
+        store = LeaseStore(path)
+        for i in range(leases):
+            chaddr = "-H-" + str(i)
+            ip = IP("10.0.0.10") + i
+            store.put(IP(ip), (chaddr + str(IP(ip)), 3600, 0.0, chaddr))
+        store.flush()
+        store.close()
+        size = os.path.getsize(path)
+
+        with Scheduler():
+            start = time.perf_counter()
+            D1 = DHCPServer("10.0.0.2/8", gateway="10.0.0.1/8", debug=0, lease_file=path)
+            elapsed = time.perf_counter() - start
+        D1.stop()
+
+    print("{:<10} {:>7} leases {:>9.3f}s restart {:>10} bytes".format(
+        "leases", len(D1.DHCPServerHandler.leased_ips), elapsed, size))
+    return elapsed
+
+def _percentile(values, p):
+    """
+    :param values: Sorted, [float]
+    :param p: 0 - 100
+    """
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def _storm(clients, per_switch, prefixlen, init_delay, timeout):
+    """
+    See dhcpStorm()
+
+    :returns: A dict of results
+    """
+    with Scheduler() as sim:
+        hosts = [Host(debug=0) for i in range(clients)]
+        switches = [Switch(hosts[i:i + per_switch], debug=0) for i in range(0, clients, per_switch)]
+        core = switches[0] if len(switches) == 1 else Switch(switches, debug=0)
+        D1 = DHCPServer("10.0.0.2/" + str(prefixlen), gateway="10.0.0.1/" + str(prefixlen), connectedTo=[core], debug=0)
+    quiet(hosts)
+    handler = D1.DHCPServerHandler
+    handler.DEBUG = 0
+
+    # Time the server's handler alone
+    cpu = [0.0, 0] # Seconds, messages
+    handleDHCP = handler.handleDHCP
+    def timed(data, oninterface):
+        start = time.process_time()
+        p = handleDHCP(data, oninterface)
+        cpu[0] += time.process_time() - start
+        cpu[1] += 1
+        return p
+    handler.handleDHCP = timed
+
+    # Note when each client has applied its lease, as its sendDHCP() caller would see it
+    leased = []
+    start = time.perf_counter()
+    for host in hosts:
+        client = host.interfaces[0].DHCPClient
+        client.init_delay = init_delay
+        host.sendDHCP("init", timeout=0)
+        client.waiting[client.current_tx].add_done_callback(lambda f: leased.append(time.perf_counter()))
+    sim.runUntil(lambda: len(leased) == clients, timeout)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(t - start for t in leased)
+    retransmits = sum(host.interfaces[0].DHCPClient.retransmits for host in hosts)
+    D1.stop()
+    return {
+        "leased":len(leased),
+        "elapsed":elapsed,
+        "virtual":sim.now,
+        "p50":_percentile(latencies, 50) if latencies else 0.0,
+        "p99":_percentile(latencies, 99) if latencies else 0.0,
+        "cpu":cpu[0] / max(1, len(leased)),
+        "messages":cpu[1],
+        "retransmits":retransmits,
+        "switches":len(switches),
+    }
+
+def dhcpStorm(clients=500, per_switch=48, prefixlen=16, init_delay=0, timeout=600, memory=True):
+    """
+    Every one of `clients` Hosts starts DHCP at the same moment, behind
+    Switches of `per_switch` ports each, off one DHCPServer. Latencies are
+    wall clock from the start to each client having its address. Every Discover and
+    Request is flooded to every client, so past a few hundred clients that,
+    not the server, is most of the time; compare us/DORA for the server.
+
+    :param prefixlen: Size of the server's subnet, and so its pool, int
+    :param init_delay: Spread the Discovers over this many virtual seconds, see `DHCPClientHandler.init_delay`
+    :param timeout: Give up after this many virtual seconds, float
+    :param memory: Also run it again under tracemalloc for peak memory (slow), bool
+    :returns: DORA exchanges per second, float
+    """
+    result = _storm(clients, per_switch, prefixlen, init_delay, timeout)
+    peak = 0
+    if memory:
+        tracemalloc.start()
+        _storm(clients, per_switch, prefixlen, init_delay, timeout)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    rate = result["leased"] / result["elapsed"]
+    print("{:<10} {:>6}/{:<6} leased {:>4} switches /{:<2} {:>9.3f}s all {:>8.1f}ms p50 {:>8.1f}ms p99 "
+          "{:>7.1f}us/DORA {:>9.1f} DORA/s {:>6} retransmits {:>8.1f}s virtual {:>8.1f}MB peak".format(
+        "dhcp", result["leased"], clients, result["switches"], prefixlen, result["elapsed"],
+        result["p50"] * 1000, result["p99"] * 1000, result["cpu"] * 1e6, rate,
+        result["retransmits"], result["virtual"], peak / 2**20))
+    return rate
+
+def runtimes(pings=20, warm=False):
+    """
+    Sequential ICMP round trips across a router, per runtime
+
+    :param warm: Leave the first round of ARP out of it, see chain()
+    """
+    benchThreaded(pings, warm)
+    benchAsyncio(pings, warm)
+    benchScheduler(pings, warm)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("runtimes", help="ICMP round trips: threaded vs asyncio vs scheduler")
+    p.add_argument("--pings", type=int, default=20)
+    p.add_argument("--warm", action="store_true", help="Pre-resolve ARP so only steady state is measured")
+
+    p = sub.add_parser("fib", help="Router FIB lookups per second by table size")
+    p.add_argument("--routes", type=int, nargs="+", default=[10, 10000, 500000])
+    p.add_argument("--lookups", type=int, default=100000)
+    p.add_argument("--linear", action="store_true", help="Compare with a linear scan (slow on big tables)")
+
+    p = sub.add_parser("switch", help="Frames per second flooded through a Switch")
+    p.add_argument("--ports", type=int, default=48)
+    p.add_argument("--frames", type=int, default=2000)
+    p.add_argument("--vlans", type=int, default=1)
+
+    p = sub.add_parser("leases", help="DHCPServer start up time from a lease file")
+    p.add_argument("--leases", type=int, default=100000)
+
+    p = sub.add_parser("dhcp", help="DHCP storm: every client doing DORA at once")
+    p.add_argument("--clients", type=int, nargs="+", default=[100, 500])
+    p.add_argument("--per-switch", type=int, default=48, help="Clients behind each access Switch")
+    p.add_argument("--prefixlen", type=int, default=16, help="Server subnet, and so pool, size")
+    p.add_argument("--init-delay", type=float, default=0, help="Spread Discovers over this many virtual seconds")
+    p.add_argument("--timeout", type=float, default=600, help="Virtual seconds to give up after")
+    p.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc run for peak memory")
+
+    p = sub.add_parser("stp", help="Spanning Tree convergence time on a ring of switches")
+    p.add_argument("--switches", type=int, default=8)
+
+    args = parser.parse_args()
+    if args.bench == "runtimes":
+        runtimes(args.pings, args.warm)
+    elif args.bench == "fib":
+        for routes in args.routes:
+            fibLookups(routes, args.lookups, args.linear)
+    elif args.bench == "switch":
+        switchFlood(args.ports, args.frames, args.vlans)
+    elif args.bench == "leases":
+        leaseRestart(args.leases)
+    elif args.bench == "dhcp":
+        for clients in args.clients:
+            dhcpStorm(clients, args.per_switch, args.prefixlen, args.init_delay, args.timeout, not args.no_memory)
+    elif args.bench == "stp":
+        stpRing(args.switches)
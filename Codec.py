@@ -0,0 +1,455 @@
+import struct
+import time
+from Headers import *
+
+# The binary wire format. encodePacket() packs a Packet into the bytes a real
+# NIC would put on the wire (Ethernet II, RFC 826 ARP, RFC 791 IPv4, RFC 768
+# UDP, RFC 2131 DHCP, RFC 792 ICMP, 802.1D BPDUs), and WirePacket reads them
+# back lazily.
+#
+# Devices with `wire = True` send frames to each other this way instead of as
+# header objects; see Device.send(). A frame in flight is then one bytes
+# object, and a Switch that only looks at L2 never unpacks anything above it.
+#
+# Device IDs stand in for MAC addresses throughout the project, so they are
+# mapped onto 6 byte locally administered MACs: 02:<kind>:<number (4 bytes)>,
+# where kind is the ID's index in ID_PREFIXES.
+#
+#   raw = encodePacket(p)
+#   p2 = WirePacket(raw)
+#   p2.L3.Data.xid == p.L3.Data.xid
+#
+# Fields this project doesn't model (checksums, lengths) are filled in on the
+# way out, and read into the header on the way in.
+
+ETHERNET = struct.Struct("!6s6sH")
+DOT1Q = struct.Struct("!HH") # TCI, then the real EtherType
+ARP = struct.Struct("!HHBBH6sI6sI")
+IPV4 = struct.Struct("!BBHHHBBHII")
+UDP = struct.Struct("!HHHH")
+DHCP = struct.Struct("!BBBBIHHIIII16s64s128s4s")
+ICMP = struct.Struct("!BBHHH")
+BPDU_CONFIG = struct.Struct("!HBBBH6sIH6sHHHHH")
+BPDU_TCN = struct.Struct("!HBB")
+
+# BPDUs go in 802.3 frames, with a length where the EtherType would be and an LLC header
+LLC_STP = b"\x42\x42\x03"
+_STP_GROUP = bytes.fromhex("0180c2000000")
+
+DHCP_MAGIC = b"\x63\x82\x53\x63"
+
+# Names used in the headers, and their numbers on the wire
+ETHERTYPES = {"IPv4":0x0800, "ARP":0x0806}
+TPID_8021Q = 0x8100 # In place of the EtherType on a VLAN tagged frame
+PROTOCOLS = {"ICMP":1, "UDP":17}
+HARDWARE_TYPES = {"Ethernet":1}
+_ETHERTYPE_NAMES = {v: k for k, v in ETHERTYPES.items()}
+_PROTOCOL_NAMES = {v: k for k, v in PROTOCOLS.items()}
+_HARDWARE_NAMES = {v: k for k, v in HARDWARE_TYPES.items()}
+
+# How the value of each DHCP option we use is packed
+DHCP_OPTION_TYPES = {
+    1: "ip",    # Subnet mask
+    3: "ip",    # Router
+    6: "ip",    # DNS server
+    50: "ip",   # Requested IP
+    51: "u32",  # Lease time
+    53: "u8",   # Message type
+    54: "ip",   # Server ID
+    55: "u8s",  # Parameter request list
+    61: "str",  # Client ID
+}
+
+# Device ID prefixes, see idToMAC(). Append to this to give new kinds of device a MAC
+ID_PREFIXES = ["___", "_I_", "-H-", "=R=", "{S}", "=DHCP="]
+
+_BROADCAST = b"\xff" * 6
+_ZERO = bytes(6)
+_macs = {}  # ID: MAC
+_ids = {}   # MAC: ID
+
+def idToMAC(ID):
+    """
+    :param ID: A device or interface ID, MAC_BROADCAST, or 0 / "" for none
+    :returns: 6 bytes
+    """
+    mac = _macs.get(ID)
+    if mac is not None:
+        return mac
+
+    if ID == MAC_BROADCAST:
+        return _BROADCAST
+    if ID == MAC_STP:
+        return _STP_GROUP
+    if not ID: # Unknown, like the target of an ARP request
+        return _ZERO
+    for kind, prefix in enumerate(ID_PREFIXES):
+        if ID.startswith(prefix):
+            mac = struct.pack("!BBI", 0x02, kind, int(ID[len(prefix):]))
+            break
+    else:
+        raise ValueError("No MAC mapping for ID " + str(ID) + ", see Codec.ID_PREFIXES")
+
+    _macs[ID] = mac
+    _ids[mac] = ID
+    return mac
+
+def macToID(mac):
+    """
+    The reverse of idToMAC(). MACs that don't belong to the simulation come
+    back as the usual aa:bb:cc:dd:ee:ff string.
+
+    :param mac: 6 bytes
+    :returns: str, or 0 for the all zero MAC
+    """
+    mac = bytes(mac)
+    ID = _ids.get(mac)
+    if ID is not None:
+        return ID
+
+    if mac == _BROADCAST:
+        return MAC_BROADCAST
+    if mac == _STP_GROUP:
+        return MAC_STP
+    if mac == _ZERO:
+        return 0
+    local, kind, number = struct.unpack("!BBI", mac)
+    if local == 0x02 and kind < len(ID_PREFIXES):
+        ID = ID_PREFIXES[kind] + str(number)
+        _macs[ID] = mac
+        _ids[mac] = ID
+        return ID
+    return mac.hex(":")
+
+def checksum(buf):
+    """
+    The 16 bit ones' complement checksum used by IPv4 and ICMP
+
+    :param buf: bytes-like
+    :returns: int
+    """
+    if len(buf) % 2:
+        buf = bytes(buf) + b"\0"
+    total = sum(struct.unpack("!%dH" % (len(buf) // 2), buf))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+def _pack(names, value):
+    number = names.get(value, value)
+    if not isinstance(number, int):
+        raise ValueError("No wire value for " + repr(value))
+    return number
+
+def _packOption(code, value):
+    kind = DHCP_OPTION_TYPES.get(code)
+    if kind == "ip":
+        # Empty addresses (no DNS server) pack to nothing
+        value = struct.pack("!I", value) if value != "" else b""
+    elif kind == "u32":
+        value = struct.pack("!I", value)
+    elif kind == "u8":
+        value = bytes((value,))
+    elif kind == "u8s":
+        value = bytes(value)
+    elif isinstance(value, str):
+        value = value.encode()
+    else:
+        value = bytes(value)
+    return bytes((code, len(value))) + value
+
+def _unpackOption(code, value):
+    kind = DHCP_OPTION_TYPES.get(code)
+    if kind == "ip":
+        return IP(struct.unpack("!I", value)[0]) if len(value) == 4 else ""
+    if kind == "u32":
+        return struct.unpack("!I", value)[0]
+    if kind == "u8":
+        return value[0]
+    if kind == "u8s":
+        return list(value)
+    if kind == "str":
+        return bytes(value).decode()
+    return bytes(value)
+
+def packARP(m):
+    """
+    :param m: ARPMessage
+    :returns: bytes
+    """
+    return ARP.pack(
+        _pack(HARDWARE_TYPES, m.HT), _pack(ETHERTYPES, m.PT), m.HAL, m.PAL, m.OP,
+        idToMAC(m.SHA), m.SPA, idToMAC(m.THA), m.TPA
+    )
+
+def unpackARP(buf, offset=0):
+    """
+    :param buf: bytes-like
+    :returns: ARPMessage
+    """
+    ht, pt, hal, pal, op, sha, spa, tha, tpa = ARP.unpack_from(buf, offset)
+    m = ARPMessage(op, macToID(sha), IP(spa), macToID(tha), IP(tpa))
+    m.HT = _HARDWARE_NAMES.get(ht, ht)
+    m.PT = _ETHERTYPE_NAMES.get(pt, pt)
+    m.HAL = hal
+    m.PAL = pal
+    return m
+
+def packBPDU(m):
+    """
+    :param m: BPDU
+    :returns: bytes, timers in 1/256ths of a second as on the wire
+    """
+    if m.type == 0x80:
+        return BPDU_TCN.pack(m.protocol, m.version, m.type)
+    return BPDU_CONFIG.pack(
+        m.protocol, m.version, m.type, m.flags,
+        m.root[0], idToMAC(m.root[1]), m.cost, m.bridge[0], idToMAC(m.bridge[1]), m.port,
+        int(m.age * 256), int(m.max_age * 256), int(m.hello * 256), int(m.forward_delay * 256)
+    )
+
+def unpackBPDU(buf, offset=0):
+    """
+    :param buf: bytes-like
+    :returns: BPDU
+    """
+    protocol, version, typ = BPDU_TCN.unpack_from(buf, offset)
+    if typ == 0x80:
+        # A TCN doesn't carry the sender's bridge ID; the frame's source MAC does
+        return BPDU(typ, 0, None, 0, None, 0, 0, 0, 0, 0)
+    (protocol, version, typ, flags, rprio, rmac, cost, bprio, bmac, port,
+        age, max_age, hello, forward_delay) = BPDU_CONFIG.unpack_from(buf, offset)
+    return BPDU(typ, flags, (rprio, macToID(rmac)), cost, (bprio, macToID(bmac)), port,
+        age / 256, max_age / 256, hello / 256, forward_delay / 256)
+
+def packDHCP(m):
+    """
+    :param m: DHCPMessage
+    :returns: bytes
+    """
+    parts = [DHCP.pack(
+        m.op, m.htype, m.hardwareaddrlen, m.hops, m.xid, m.seconds,
+        0x8000 if m.flags else 0, # Only the broadcast bit is defined
+        m.ciaddr, m.yiaddr, m.siaddr, m.giaddr,
+        idToMAC(m.chaddr), m.sname.encode(), m.file.encode(), DHCP_MAGIC
+    )]
+    for code, value in m.options.items():
+        parts.append(_packOption(code, value))
+    parts.append(b"\xff")
+    return b"".join(parts)
+
+def unpackDHCP(buf, offset=0):
+    """
+    :param buf: bytes-like
+    :returns: DHCPMessage
+    """
+    (op, htype, hlen, hops, xid, seconds, flags, ciaddr, yiaddr, siaddr, giaddr,
+        chaddr, sname, file, magic) = DHCP.unpack_from(buf, offset)
+    if magic != DHCP_MAGIC:
+        raise ValueError("Not a DHCP message")
+
+    options = {}
+    i = offset + DHCP.size
+    while i < len(buf):
+        code = buf[i]
+        if code == 255: # End
+            break
+        if code == 0:   # Pad
+            i += 1
+            continue
+        length = buf[i + 1]
+        options[code] = _unpackOption(code, buf[i + 2:i + 2 + length])
+        i += 2 + length
+
+    m = DHCPMessage(op, htype, hlen, hops, xid, seconds, 1 if flags & 0x8000 else 0,
+                    IP(ciaddr), IP(yiaddr), IP(siaddr), IP(giaddr),
+                    macToID(chaddr[:6]), options)
+    m.sname = sname.rstrip(b"\0").decode()
+    m.file = file.rstrip(b"\0").decode()
+    return m
+
+def packICMP(m):
+    """
+    :param m: ICMPMessage
+    :returns: bytes
+    """
+    raw = ICMP.pack(m.type, m.code, 0, m.identifier, m.SNum)
+    return ICMP.pack(m.type, m.code, checksum(raw), m.identifier, m.SNum)
+
+def unpackICMP(buf, offset=0):
+    """
+    :param buf: bytes-like
+    :returns: ICMPMessage
+    """
+    typ, code, csum, identifier, snum = ICMP.unpack_from(buf, offset)
+    return ICMPMessage(typ, code, identifier, snum)
+
+def packIPv4(L3, L4=""):
+    """
+    :param L3: IPv4Packet
+    :param L4: The UDPDatagram, for UDP packets
+    :returns: bytes
+    """
+    data = L3.Data
+    if L3.Protocol == "ICMP":
+        payload = packICMP(data)
+    elif L3.Protocol == "UDP":
+        body = packDHCP(data) if isinstance(data, DHCPMessage) else bytes(data)
+        payload = UDP.pack(L4.SPort, L4.DPort, UDP.size + len(body), 0) + body # No UDP checksum, as IPv4 allows
+    else:
+        payload = bytes(data) if data else b""
+
+    header = bytearray(IPV4.pack(
+        0x45, L3.TOS, IPV4.size + len(payload), L3.ID, L3.Flags << 13 | L3.FOffset,
+        L3.TTL, _pack(PROTOCOLS, L3.Protocol or 0), 0, L3.SIP, L3.DIP
+    ))
+    struct.pack_into("!H", header, 10, checksum(header))
+    return bytes(header) + payload
+
+def unpackIPv4(buf, offset=0):
+    """
+    :param buf: bytes-like
+    :returns: The IPv4Packet, and its UDPDatagram or "" as L4
+    """
+    (vihl, tos, total, ID, fragment, ttl, proto, csum,
+        sip, dip) = IPV4.unpack_from(buf, offset)
+    hlen = (vihl & 0x0F) * 4
+    start = offset + hlen
+    end = offset + total
+
+    L3 = IPv4Packet(IP(sip), IP(dip), "", _PROTOCOL_NAMES.get(proto, proto), ttl, ID)
+    L3.Version = vihl >> 4
+    L3.HLEN = hlen
+    L3.TOS = tos
+    L3.TotalLength = total
+    L3.Flags = fragment >> 13
+    L3.FOffset = fragment & 0x1FFF
+    L3.Checksum = csum
+
+    L4 = ""
+    if proto == PROTOCOLS["ICMP"]:
+        L3.Data = unpackICMP(buf, start)
+    elif proto == PROTOCOLS["UDP"]:
+        sport, dport, length, csum = UDP.unpack_from(buf, start)
+        L4 = UDPDatagram(sport, dport, length, csum, "")
+        body = memoryview(buf)[start + UDP.size:start + length]
+        L3.Data = unpackDHCP(body) if sport in (67, 68) and dport in (67, 68) else bytes(body)
+    else:
+        L3.Data = bytes(memoryview(buf)[start:end])
+    return L3, L4
+
+def encodePacket(p):
+    """
+    Pack a whole frame. A WirePacket keeps the bytes it arrived as for
+    everything above L2, since those layers are read only (see Headers.Packet).
+
+    :param p: Packet
+    :returns: bytes
+    """
+    L2 = p.L2
+    if L2.EtherType == "STP":
+        body = LLC_STP + packBPDU(L2.Data)
+        return _packEthernet(L2, len(body)) + body
+    head = _packEthernet(L2, _pack(ETHERTYPES, L2.EtherType))
+    if L2.EtherType == "ARP":
+        return head + packARP(L2.Data)
+    if isinstance(p, WirePacket):
+        return head + memoryview(p.buf)[_unpackEthernet(p.buf)[4]:]
+    return head + packIPv4(p.L3, p.L4)
+
+def _packEthernet(L2, ethertype):
+    if L2.VLAN is None:
+        return ETHERNET.pack(idToMAC(L2.To), idToMAC(L2.From), ethertype)
+    return ETHERNET.pack(idToMAC(L2.To), idToMAC(L2.From), TPID_8021Q) + DOT1Q.pack(L2.VLAN & 0x0FFF, ethertype)
+
+def _unpackEthernet(buf):
+    """
+    :returns: (to, from, EtherType, VLAN ID or None, where the payload starts)
+    """
+    to, fr, ethertype = ETHERNET.unpack_from(buf)
+    if ethertype == TPID_8021Q:
+        tci, ethertype = DOT1Q.unpack_from(buf, ETHERNET.size)
+        return to, fr, ethertype, tci & 0x0FFF, ETHERNET.size + DOT1Q.size
+    return to, fr, ethertype, None, ETHERNET.size
+
+class _Lazy:
+    """
+    Stands in for one of Packet's slots on a WirePacket: the first read
+    unpacks that layer into the slot, and after that it's a plain attribute
+    """
+    def __init__(self, name, unpack):
+        self.slot = Packet.__dict__[name]
+        self.unpack = unpack
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            return self.slot.__get__(obj, cls)
+        except AttributeError:
+            self.unpack(obj)
+            return self.slot.__get__(obj, cls)
+
+    def __set__(self, obj, value):
+        self.slot.__set__(obj, value)
+
+def _unpackL2(p):
+    to, fr, ethertype, vlan, offset = _unpackEthernet(p.buf)
+    ethertype = _ETHERTYPE_NAMES.get(ethertype, ethertype)
+    data = unpackARP(p.buf, offset) if ethertype == "ARP" else ""
+    if ethertype == len(p.buf) - offset and p.buf[offset:offset + 3] == LLC_STP:
+        ethertype = "STP"
+        data = unpackBPDU(p.buf, offset + 3)
+    p.L2 = EthernetFrame(ethertype, macToID(fr), macToID(to), p.fromlink, data, vlan)
+
+def _unpackL3(p):
+    # L3 and L4 come off the wire together
+    to, fr, ethertype, vlan, offset = _unpackEthernet(p.buf)
+    if ethertype == ETHERTYPES["IPv4"]:
+        p.L3, p.L4 = unpackIPv4(p.buf, offset)
+    else:
+        p.L3, p.L4 = "", ""
+
+class WirePacket(Packet):
+    """
+    A Packet read from the bytes it was sent as. Each layer is unpacked
+    straight out of the buffer the first time it's read, so a device only
+    pays for the layers it actually looks at.
+    """
+    __slots__ = ("buf", "fromlink")
+    _fields = Packet.__slots__
+
+    L2 = _Lazy("L2", _unpackL2)
+    L3 = _Lazy("L3", _unpackL3)
+    L4 = _Lazy("L4", _unpackL3)
+
+    def __init__(self, buf, fromlink=""):
+        """
+        :param buf: A frame from encodePacket(), bytes
+        :param fromlink: optional, the link ID it arrived on, see EthernetFrame.FromLink
+        """
+        self.buf = buf # Kept as bytes; a memoryview costs more than most frames
+        self.fromlink = fromlink
+
+    def size(self):
+        """
+        :returns: The length of the frame on the wire, int
+        """
+        return len(self.buf)
+
+def writePcap(f, frames):
+    """
+    Write frames as a pcap capture, readable by Wireshark or tcpdump
+
+    :param f: A file opened for binary writing
+    :param frames: Iterable of Packets, or of (timestamp, Packet)
+    """
+    f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)) # Ethernet link type
+    for frame in frames:
+        if isinstance(frame, tuple):
+            when, frame = frame
+        else:
+            when = time.time()
+        raw = encodePacket(frame)
+        f.write(struct.pack("<IIII", int(when), int(when % 1 * 1000000), len(raw), len(raw)))
+        f.write(raw)
@@ -1,11 +1,16 @@
 from Headers import *
 from Debug import *
-import ipaddress
+from FIB import FIB
 import time
+from concurrent.futures import Future
+from collections import OrderedDict
+import heapq
+import os
+import re
+import threading
 
 # This DHCP S/C implements most of the "MUST" functionality
-# described in RFC2131, with the exception being retransmission
-# of lost or dropped packets. Not all options are implemented.
+# described in RFC2131. Not all options are implemented.
 
 # For example, DHCPNAK is not implemented as it is technically
 # "SHOULD" functionality per 3.1.4, so the server silently
@@ -15,42 +20,322 @@ import time
 # https://www.netmanias.com/en/post/techdocs/5998/dhcp-network-protocol/understanding-the-basic-operations-of-dhcp
 # https://avocado89.medium.com/dhcp-packet-analysis-c84827e162f0
 
-# TODO: Implement DHCP Client retransmission / timeouts
 # TODO: DHCP Snooping
-# TODO: Verify lease expiration
+
+
+class AddressPool:
+    """
+    The addresses a DHCP server hands out, tracked as offsets into a range
+    rather than as a list of every address. Addresses never handed out are
+    taken in order from a counter, returned ones are reused most recent first,
+    so allocate() and release() are O(1) however big the subnet is.
+    """
+    def __init__(self, first, last):
+        """
+        :param first: Lowest address in the pool, see `Headers.IP`
+        :param last: Highest address in the pool, inclusive
+        """
+        self.first = IP(first)
+        self.size = max(0, IP(last) - self.first + 1)
+        self.next = 0 # Every offset from here on has never been handed out
+        self.free = [] # Offsets handed back; may hold some taken since, see allocate()
+        self.taken = set()
+
+    def __contains__(self, ip):
+        """
+        :returns: Whether ip is part of this pool, taken or not, bool
+        """
+        return 0 <= IP(ip) - self.first < self.size
+
+    def __len__(self):
+        """
+        :returns: How many addresses are taken, int
+        """
+        return len(self.taken)
+
+    def available(self):
+        """
+        :returns: How many addresses are left to hand out, int
+        """
+        return self.size - len(self.taken)
+
+    def isFree(self, ip):
+        """
+        :returns: Whether ip is in the pool and nobody has it, bool
+        """
+        return ip in self and IP(ip) - self.first not in self.taken
+
+    def allocate(self):
+        """
+        Take any free address
+
+        :returns: The address, or None if the pool is exhausted, IP
+        """
+        while self.free:
+            offset = self.free.pop()
+            if offset not in self.taken: # Else reserve()d since it was released
+                self.taken.add(offset)
+                return IP(self.first + offset)
+        while self.next < self.size:
+            offset = self.next
+            self.next += 1
+            if offset not in self.taken:
+                self.taken.add(offset)
+                return IP(self.first + offset)
+        return None
+
+    def reserve(self, ip):
+        """
+        Take a particular address, like the one a client asks to keep
+
+        :returns: Whether it was free and is now taken, bool
+        """
+        offset = IP(ip) - self.first
+        if not 0 <= offset < self.size or offset in self.taken:
+            return False
+        self.taken.add(offset)
+        return True
+
+    def release(self, ip):
+        """
+        Hand an address back. Releasing a free or foreign address does nothing
+        """
+        offset = IP(ip) - self.first
+        if offset in self.taken:
+            self.taken.remove(offset)
+            self.free.append(offset)
+
+
+class DHCPScope:
+    """
+    A subnet a DHCP server hands out addresses on, with its own lease time and options
+    """
+    def __init__(self, gateway, server=None, lease=None, options=None):
+        """
+        :param gateway: The subnet's router, which also gives the subnet, "x.x.x.x/n"
+        :param server: The server's own IP on the subnet, if it has one, which is then never handed out
+        :param lease: Lease time in seconds, int. None for the server's lease_offer
+        :param options: Options handed out on request, e.g. {6: "8.8.8.8"}, {int: value}
+        """
+        self.server = IP(server) if server else None
+        self.lease = lease
+        self.options = options or {}
+        self.gateway, self.nmask = splitAddr(gateway)
+        self.prefixlen = maskToPrefix(self.nmask)
+        self.network = removeHostBits(self.gateway, self.nmask)
+
+        # Every host address in the subnet, but the first 10 are reserved for whatever
+        broadcast = self.network | (~self.nmask & 0xFFFFFFFF)
+        self.pool = AddressPool(self.network + 10, broadcast - 1)
+        self.pool.reserve(self.gateway)
+        if self.server:
+            self.pool.reserve(self.server)
+
+    def __repr__(self):
+        return str(self.network) + "/" + str(self.prefixlen)
+
+
+def _escape(s):
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def _unescape(s):
+    if "\\" not in s:
+        return s
+    return re.sub(r"\\(.)", lambda m: {"t":"\t", "n":"\n"}.get(m.group(1), m.group(1)), s)
+
+def _leaseLine(ip, lease):
+    """
+    :returns: A lease's line in a LeaseStore file, str
+    """
+    return "+\t%d\t%d\t%r\t%s\t%s\n" % (ip, lease[1], lease[2], _escape(lease[3]), _escape(lease[0]))
+
+
+class LeaseStore:
+    """
+    Keeps a DHCP server's leases on disk so a restarted simulation picks up
+    where it left off instead of every client running DORA again.
+
+    The file is an append-only log, one line per lease granted or renewed
+    ("+") or dropped ("-"). Changes are buffered and written in one go by
+    flush(), which the server calls every tick, and once the log holds
+    compact_ratio times more lines than there are leases it is rewritten as
+    a snapshot of just the live ones. load() reads the whole file at once.
+    Fields are tab separated, with tabs, newlines and backslashes in client
+    IDs escaped.
+
+    Lease times are whatever the server's clock said, so virtual seconds
+    on a Scheduler, see `Device.clock()`.
+    """
+    def __init__(self, path, compact_ratio=2, compact_min=1024):
+        """
+        :param path: The lease file, created if missing, str
+        :param compact_ratio: Compact once the log is this many times the live leases, int
+        :param compact_min: But never while it has fewer lines than this, int
+        """
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.pending = [] # Lines not yet written
+        self.lock = threading.Lock() # flush() and close() may come from outside the server's handlers, see DHCPServer.stop()
+        self.lines = 0 # Lines in the file
+        self.file = None
+
+        # Stats
+        self.writes = 0
+        self.compactions = 0
+
+    def load(self):
+        """
+        Lines that can't be read, like one left half written by a crash, are
+        skipped, and a torn last line is cut off so appends start on a line
+        of their own
+
+        :returns: Every lease in the file, {IP: (client ID, lease time, leased at, chaddr)}
+        """
+        leases = {}
+        if not os.path.exists(self.path):
+            return leases
+        with open(self.path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            os.truncate(self.path, end)
+        new = int.__new__ # Parses straight into an IP, skipping IP.__new__'s checks
+        self.lines = 0
+        for line in data[:end].decode().split("\n"):
+            fields = line.split("\t")
+            try:
+                ip = new(IP, fields[1])
+                if fields[0] == "+" and len(fields) == 6:
+                    leases[ip] = (_unescape(fields[5]), int(fields[2]), float(fields[3]), _unescape(fields[4]))
+                elif fields[0] == "-" and len(fields) == 2:
+                    leases.pop(ip, None)
+                else:
+                    continue
+            except (IndexError, ValueError):
+                continue
+            self.lines += 1
+        return leases
+
+    def put(self, ip, lease):
+        """
+        Record a lease granted or renewed
+
+        :param lease: (client ID, lease time, leased at, chaddr), see `DHCPServerHandler.leased_ips`
+        """
+        self.pending.append(_leaseLine(ip, lease))
+
+    def delete(self, ip):
+        self.pending.append("-\t%d\n" % ip)
+
+    def flush(self, leases=None):
+        """
+        Write out everything buffered, compacting first if the log has grown too long
+
+        :param leases: The server's live leases, needed to compact, see `DHCPServerHandler.leased_ips`
+        """
+        with self.lock:
+            if leases is not None and self.lines + len(self.pending) > max(self.compact_min, self.compact_ratio * len(leases)):
+                return self._compact(leases)
+            # Swapped, not cleared after writing, so nothing put() meanwhile is lost
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write("".join(pending))
+            self.file.flush()
+            self.lines += len(pending)
+            self.writes += 1
+
+    def compact(self, leases):
+        """
+        Replace the log with one line per live lease. Written to a temporary
+        file first, so a crash part way leaves the old log intact
+        """
+        with self.lock:
+            self._compact(leases)
+
+    def _compact(self, leases):
+        # Everything buffered so far is in the snapshot, taken after
+        self.pending = []
+        snapshot = dict(leases)
+        self._close()
+        lines = [_leaseLine(ip, lease) for ip, lease in snapshot.items()]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("".join(lines))
+        os.replace(tmp, self.path)
+        self.lines = len(lines)
+        self.compactions += 1
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 class DHCPServerHandler:
     """
     Handles DHCP Discovery / Request / Renewal
     """
-    def __init__(self, ip, nmask, haddr, gateway, DEBUG, interfaces):
+    def __init__(self, ip, nmask, haddr, gateway, DEBUG, interfaces, clock=time.time):
         """
-        :param ip: DHCP Server IP, str
-        :param nmask: Netmask of the served subnet, str
+        :param ip: DHCP Server IP, IP or str
+        :param nmask: Netmask of the served subnet, IP or str
+        :param clock: Function returning the current time, see `Device.clock()`
         """
         self.interfaces = interfaces
+        self.clock = clock
+        self.id = haddr
+        self.DEBUG = DEBUG
 
-        self.ip = ip
-        self.nmask = str(nmask)
+        self.ip = IP(ip)
+        self.nmask = IP(nmask)
 
-        self.gateway = splitAddr(gateway)[0]
+        self.gateway, gateway_mask = splitAddr(gateway)
 
-        if splitAddr(gateway)[1] != self.nmask:
+        if gateway_mask != self.nmask:
             raise ValueError("Mask conflict between gateway", splitAddr(gateway), "and self", self.nmask)
 
         
         if self.nmask == 0: raise
 
-        self.ip_range = [str(ip) for ip in ipaddress.IPv4Network(removeHostBits(ip) + "/" + nmask)]
-        self.ip_range = self.ip_range[10:] # Reserve the first 10 IPs in a subnet for whatever
-        try: self.ip_range.remove(ip)
-        except: pass
-
-        self.leased_ips = {}
+        self.leased_ips = {} # IP: (client ID, lease time, leased at, chaddr)
         self.lease_offer = 20
-        self.id = haddr
-        self.DEBUG = DEBUG
+
+        # Which IP each client leases, so a returning client gets it back
+        # without a search through leased_ips. By client identifier (61) for
+        # clients that send one, and by chaddr for every client
+        self.by_client_id = {}
+        self.by_chaddr = {}
+        self.store = None # On disk copy of leased_ips, see restore()
+
+        # Subnets served, found by longest prefix match on a relay's giaddr or
+        # on the address of the interface a request came in on, see _scopeFor().
+        # self.scope is the server's own subnet, on the interface at ip
+        self.scopes = FIB()
+        self.server_ips = set()
+        self.scope = self.addScope(gateway, self.ip)
+        self.pool = self.scope.pool
+
+        # (expires, IP), one per lease, soonest first. A renewal leaves its
+        # entry alone; expireLeases() moves it once it comes up
+        self.lease_expiry = []
+        # IPs with an entry in lease_expiry. An address unleased and leased again
+        # before its old entry comes up reuses it, so the heap never holds more
+        # than one entry per address
+        self.expiry_queued = set()
+        self.expired = 0
+
+        # Addresses offered but not yet requested, held so no one else is
+        # offered them meanwhile: chaddr: (IP, expires), oldest first
+        self.offers = OrderedDict()
+        self.offer_timeout = 30
         
         if self.DEBUG:
             Debug(self.id, "Initialize gateway", ["IP:", self.ip, "NM:", self.nmask, "GW:", gateway],
@@ -61,7 +346,138 @@ class DHCPServerHandler:
         #self.client_msgtype = {}
 
     
-    def handleRequestedOptions(self, data):
+    def addScope(self, gateway, server=None, lease=None, options=None):
+        """
+        Also hand out addresses on gateway's subnet: to clients on a segment
+        the server has an interface on, or whose Discovers a relay agent
+        forwards from there, see `Router.setDHCPRelay()`
+
+        :param gateway: The subnet's router, "x.x.x.x/n"
+        :param server: Our interface's IP on the subnet, if we have one there
+        :param lease: Lease time in seconds, int. By default lease_offer
+        :param options: Options handed out on request, {int: value}
+        :returns: DHCPScope
+        """
+        scope = DHCPScope(gateway, server, lease, options)
+        self.scopes.insert(scope.network, scope.prefixlen, scope)
+        if scope.server:
+            self.server_ips.add(scope.server)
+        if self.DEBUG == 2:
+            Debug(self.id, "Serving", scope,
+                color="blue", f=self.__class__.__name__
+            )
+        return scope
+
+    def _scopeFor(self, data, oninterface=None):
+        """
+        :returns: The DHCPScope a client asking with data belongs to, or None if we don't serve it
+        """
+        giaddr = data["L3"]["Data"]["giaddr"]
+        if giaddr:
+            return self.scopes.lookup(giaddr)
+        if oninterface is not None and oninterface.ip:
+            return self.scopes.lookup(oninterface.ip)
+        return self.scope
+
+    def _serverID(self, oninterface):
+        """
+        :returns: The address clients on oninterface know us by, option 54, IP
+        """
+        if oninterface is not None and oninterface.ip in self.server_ips:
+            return oninterface.ip
+        return self.ip
+
+    def _leaseTime(self, scope):
+        return scope.lease if scope.lease is not None else self.lease_offer
+
+    def findLease(self, data):
+        """
+        The address the client sending data already leases, looked up by its
+        client identifier if it sends one, else by its chaddr. O(1)
+
+        :returns: IP, or None
+        """
+        options = data["L3"]["Data"]["options"]
+        if 61 in options:
+            return self.by_client_id.get(options[61])
+        return self.by_chaddr.get(data["L3"]["Data"]["chaddr"])
+
+    def _lease(self, ip, data, scope):
+        """
+        Record a new lease on ip, or renew it. A client holds a single lease,
+        so one it held on another address is dropped
+        """
+        chaddr = data["L3"]["Data"]["chaddr"]
+        old = self.findLease(data)
+        if old is not None and old != ip:
+            self._unlease(old)
+
+        if ip not in self.expiry_queued:
+            heapq.heappush(self.lease_expiry, (self.clock() + self._leaseTime(scope), ip))
+            self.expiry_queued.add(ip)
+        clientID = self._clientID(data, ip)
+        self.leased_ips[ip] = (clientID, self._leaseTime(scope), self.clock(), chaddr)
+        self.by_chaddr[chaddr] = ip
+        if 61 in data["L3"]["Data"]["options"]:
+            self.by_client_id[clientID] = ip
+        if self.store:
+            self.store.put(ip, self.leased_ips[ip])
+
+    def _unlease(self, ip):
+        """
+        Forget the lease on ip and hand the address back. Its expiry heap
+        entry stays behind, and is skipped or reused, see expireLeases()
+        """
+        clientID, lease, leased_at, chaddr = self.leased_ips.pop(ip)
+        if self.by_chaddr.get(chaddr) == ip:
+            del self.by_chaddr[chaddr]
+        if self.by_client_id.get(clientID) == ip:
+            del self.by_client_id[clientID]
+        self._release(ip)
+        if self.store:
+            self.store.delete(ip)
+
+    def restore(self, store):
+        """
+        Take up the leases kept in store, and keep it up to date from now on.
+        Call once every scope has been added; leases outside them are dropped
+
+        :param store: LeaseStore
+        :returns: How many leases were restored, int
+        """
+        self.store = store
+        scope = None
+        for ip, lease in store.load().items():
+            if scope is None or not scope.pool.reserve(ip): # Leases mostly come in runs from one scope
+                scope = self.scopes.lookup(ip)
+                if scope is None or not scope.pool.reserve(ip):
+                    store.delete(ip)
+                    continue
+            clientID, lease_time, leased_at, chaddr = lease
+            self.leased_ips[ip] = lease
+            self.by_chaddr[chaddr] = ip
+            if clientID != chaddr + str(ip): # Else there was no option 61, see _clientID()
+                self.by_client_id[clientID] = ip
+            if ip not in self.expiry_queued:
+                self.lease_expiry.append((leased_at + lease_time, ip))
+                self.expiry_queued.add(ip)
+        heapq.heapify(self.lease_expiry)
+
+        if self.DEBUG:
+            Debug(self.id, "Restored", len(self.leased_ips), "leases from", store.path,
+                color="blue", f=self.__class__.__name__
+            )
+        return len(self.leased_ips)
+
+    def _release(self, ip):
+        """
+        Hand ip back to whichever scope it came from
+        """
+        scope = self.scopes.lookup(ip)
+        if scope is not None:
+            scope.pool.release(ip)
+
+    def handleRequestedOptions(self, data, scope=None):
         """
         Receive and parse opts (a list of #s) from the client's option 55
         Return a dict with each option filled out
@@ -69,44 +485,173 @@ class DHCPServerHandler:
 
         See https://www.iana.org/assignments/bootp-dhcp-parameters/bootp-dhcp-parameters.xhtml#options
 
-        :param data: See `Headers.makePacket()`, dict
+        :param data: See `Headers.makePacket()`, Packet
+        :param scope: The client's DHCPScope, by default the server's own subnet
         :returns: dict that contains requested params and their values, dict
         """
-        
+        scope = scope or self.scope
         result = {}
         if not 55 in data["L3"]["Data"]["options"]:
             return result
 
         for opt in data["L3"]["Data"]["options"][55]: # TODO: What options can a client request?
-            if opt == 1: # Subnet mask
-                result[opt] = self.nmask
-            if opt == 3: # Router Addr
-                result[opt] = self.gateway
-            if opt == 6: # DNS Server
+            if opt in scope.options: # Configured for the scope, see addScope()
+                result[opt] = scope.options[opt]
+            elif opt == 1: # Subnet mask
+                result[opt] = scope.nmask
+            elif opt == 3: # Router Addr
+                result[opt] = scope.gateway
+            elif opt == 6: # DNS Server
                 result[opt] = "" # Not doing DNS
-            if opt == 51: # Lease Offer
-                result[opt] = self.lease_offer
-            if opt == 54: # DHCP Server IP
-                result[opt] = self.ip
+            elif opt == 51: # Lease Offer
+                result[opt] = self._leaseTime(scope)
+            elif opt == 54: # DHCP Server IP
+                result[opt] = scope.server or self.ip
 
         return result
                 
-    def generateIP(self):
+    def generateIP(self, chaddr, scope=None, current=None):
         """
-        Generate an IP not currently leased out
+        Pick the address to offer chaddr and hold it until offer_timeout passes.
+        A client that Discovers again is offered the same address.
 
-        :returns: "X.X.X.X", str
+        :param scope: DHCPScope to pick from, by default the server's own subnet
+        :param current: The address the client leases already, see findLease(). Offered again if it's in scope
+        :returns: IP, or None if the pool is exhausted
         """
-        while True:
-            #x = "10.10.10." + str(random.randint(2, 254))
-            x = random.choice(self.ip_range)
-            #if self.DEBUG: print("(DHCP)", self.id, "Finding an IP:", x, "for client")
-            if self.DEBUG: 
-                Debug(self.id, "Finding an IP for client:", Debug.color(x, "blue"), 
-                    color="green", f=self.__class__.__name__
-                )
-            if not x in self.leased_ips:
-                return x
+        scope = scope or self.scope
+        self.expireOffers()
+        offer = self.offers.pop(chaddr, None)
+        if offer is not None and offer[0] in scope.pool:
+            ip = offer[0]
+        elif current is not None and current in scope.pool:
+            ip = current
+        else:
+            if offer is not None and offer[0] not in self.leased_ips:
+                self._release(offer[0]) # They've moved subnets
+            ip = scope.pool.allocate()
+            if ip is None:
+                if self.DEBUG:
+                    Debug(self.id, "Address pool exhausted, no offer for", chaddr,
+                        color="red", f=self.__class__.__name__
+                    )
+                return None
+        self.offers[chaddr] = (ip, self.clock() + self.offer_timeout)
+        if self.DEBUG:
+            Debug(self.id, "Offering", Debug.color(ip, "blue"), "to", chaddr,
+                color="green", f=self.__class__.__name__
+            )
+        return ip
+
+    def expireOffers(self):
+        """
+        Return addresses offered more than offer_timeout ago and never requested to the pool
+        """
+        now = self.clock()
+        while self.offers:
+            chaddr, (ip, expires) = next(iter(self.offers.items()))
+            if expires > now:
+                break # Offers expire in the order they were made
+            if self.offers.pop(chaddr, None) is None:
+                continue # Already taken out, don't free it twice
+            if ip not in self.leased_ips:
+                self._release(ip)
+
+    def expireLeases(self):
+        """
+        Free every lease that ran out, costing only as much as there are expired
+        or renewed leases to look at. Call this periodically, see `DHCPServer._checkTimeouts()`
+
+        :returns: The IPs freed, [IP]
+        """
+        now = self.clock()
+        freed = []
+        heap = self.lease_expiry
+        while heap and heap[0][0] <= now:
+            expires, ip = heapq.heappop(heap)
+            lease = self.leased_ips.get(ip)
+            if lease is None:
+                self.expiry_queued.discard(ip)
+                continue # Already gone
+            if lease[2] + lease[1] > now:
+                heapq.heappush(heap, (lease[2] + lease[1], ip)) # Renewed since
+                continue
+            # TODO: Clean up entry deletion procedure per RFC
+            self.expiry_queued.discard(ip)
+            self._unlease(ip)
+            self.expired += 1
+            freed.append(ip)
+
+        if freed and self.DEBUG:
+            Debug(self.id, "Leases expired:", Debug.color(freed, "blue"),
+                color="yellow", f=self.__class__.__name__
+            )
+        return freed
+
+    def _clientID(self, data, yiaddr):
+        """
+        If the client defines a client identifier (61) use it,
+        otherwise the client ID is chaddr + IP. Not the L2 source, which
+        is the relay agent's for relayed requests
+
+        :returns: What leased_ips knows the client by, str
+        """
+        if 61 in data["L3"]["Data"]["options"]:
+            return data["L3"]["Data"]["options"][61]
+        return data["L3"]["Data"]["chaddr"] + str(yiaddr)
+
+    def _canLease(self, data, yiaddr, scope):
+        """
+        Take yiaddr for the requesting client if it may have it: it was offered
+        to them, they already lease it, or nobody else in scope holds it.
+
+        :returns: bool
+        """
+        chaddr = data["L3"]["Data"]["chaddr"]
+        offer = self.offers.get(chaddr)
+        if offer is not None and offer[0] == yiaddr:
+            del self.offers[chaddr]
+            return True
+        if offer is not None:
+            # They want another address instead; the offered one goes back
+            del self.offers[chaddr]
+            if offer[0] not in self.leased_ips:
+                self._release(offer[0])
+        if yiaddr in self.leased_ips:
+            return self.leased_ips[yiaddr][0] == self._clientID(data, yiaddr)
+        return scope.pool.reserve(yiaddr)
+
+    def _reply(self, data, DHCP, server):
+        """
+        Address a reply to the client that sent data, RFC2131 S4.1: back to
+        the relay agent if there was one, to ciaddr if the client has an
+        address, and otherwise broadcast unless the client asked for unicast
+
+        :param DHCP: See `Headers.createDHCPHeader()`
+        :param server: Our address to send from, see _serverID()
+        :returns: Packet
+        """
+        request = data["L3"]["Data"]
+        if request["giaddr"]:
+            p4 = makePacket_L4_UDP(67, 67)
+            p3 = makePacket_L3(server, request["giaddr"], DHCP, "UDP")
+            to = data["L2"]["From"]
+        elif request["ciaddr"]:
+            p4 = makePacket_L4_UDP(67, 68)
+            p3 = makePacket_L3(server, request["ciaddr"], DHCP, "UDP")
+            to = data["L2"]["From"]
+        else:
+            p4 = makePacket_L4_UDP(67, 68)
+            p3 = makePacket_L3(server, IP_BROADCAST, DHCP, "UDP")
+            # Check if the client wants the message broadcast or unicast
+            to = MAC_BROADCAST if request["flags"] else data["L2"]["From"]
+
+        p2 = makePacket_L2("IPv4", 
+                self.id, # From
+                to, # To
+                data["L2"]["FromLink"] # Onlink
+            )
+        return makePacket(p2, p3, p4)
 
     def handleDHCP(self, data, oninterface): # Send (O)ffer
         """
@@ -119,8 +664,8 @@ class DHCPServerHandler:
         will always be sent back out on the same interface the request came in on to
         ensure interface outputs dont get mixed up
         
-        :param data: See `Headers.makePacket()`, dict
-        :returns: The response packet, dict
+        :param data: See `Headers.makePacket()`, Packet
+        :returns: The response packet, Packet
         :returns: The linkID it should be sent out on, str
         """
         
@@ -135,18 +680,28 @@ class DHCPServerHandler:
                 Debug(self.id, "received Discover from", data["L2"]["From"], ", sending offer", 
                     color="green", f=self.__class__.__name__
                 )
-            clientip = self.generateIP()
+            scope = self._scopeFor(data, oninterface)
+            if scope is None:
+                if self.DEBUG:
+                    Debug(self.id, "No scope for", data["L3"]["Data"]["giaddr"] or oninterface.ip, 
+                        color="yellow", f=self.__class__.__name__
+                    )
+                return None
+            clientip = self.generateIP(data["L3"]["Data"]["chaddr"], scope, self.findLease(data))
+            if clientip is None:
+                return None
 
             # Check clients requested options & satisfy them, if any
-            requested_options = self.handleRequestedOptions( data )
+            requested_options = self.handleRequestedOptions( data, scope )
 
             # RFC2131 S4.3.1 Table 3
             # Server must send: 51      53      54      55 if applicable
             #                   Lease   MsgType SrvID   Requested Params
+            server = self._serverID(oninterface)
             server_options = {
-                51: self.lease_offer,
+                51: self._leaseTime(scope),
                 53: 2, # DHCP Offer
-                54: self.ip # DHCP Server ID
+                54: server # DHCP Server ID
             }
 
             options = mergeDicts(requested_options, server_options)
@@ -160,20 +715,11 @@ class DHCPServerHandler:
             DHCP = createDHCPHeader(op=2, 
                     chaddr=data["L3"]["Data"]["chaddr"],
                     yiaddr=clientip,
+                    giaddr=data["L3"]["Data"]["giaddr"],
                     options=options,
                     xid=data["L3"]["Data"]["xid"]
                 )
-            p4 = makePacket_L4_UDP(67, 68)
-            p3 = makePacket_L3(self.ip, "255.255.255.255", DHCP, "UDP")
-            
-            # Check if the client wants the message broadcast or unicast
-            p2 = makePacket_L2("IPv4", 
-                    self.id, # From
-                    MAC_BROADCAST if data["L3"]["Data"]["flags"] else data["L2"]["From"], # To
-                    data["L2"]["FromLink"] # Onlink
-                )
-
-            p = makePacket(p2, p3, p4)
+            p = self._reply(data, DHCP, server)
 
             if self.DEBUG == 2: print(p)
             #interface = findInterfaceFromLinkID(data["L2"]["FromLink"], self.interfaces)
@@ -184,21 +730,39 @@ class DHCPServerHandler:
             # Send a DHCP Ack
             
             # Client sent option 50, the requested / assigned IP
-            if data["L3"]["Data"]["ciaddr"] == "0.0.0.0": # R(equest)
+            if data["L3"]["Data"]["ciaddr"] == IP_ANY: # R(equest)
                 yiaddr = data["L3"]["Data"]["options"][50]
             else: #R(enewal)
                 yiaddr = data["L3"]["Data"]["ciaddr"]
+
+            server = self._serverID(oninterface)
+            if data["L3"]["Data"]["options"].get(54, server) not in self.server_ips:
+                # They took another server's offer
+                offer = self.offers.pop(data["L3"]["Data"]["chaddr"], None)
+                if offer and offer[0] not in self.leased_ips:
+                    self._release(offer[0])
+                return None
+
+            # A renewal comes straight from the client, which tells us its subnet
+            scope = self._scopeFor(data, oninterface) if not data["L3"]["Data"]["ciaddr"] else self.scopes.lookup(yiaddr)
+            if scope is None or not self._canLease(data, yiaddr, scope):
+                # No DHCPNAK, see the top of this file
+                if self.DEBUG:
+                    Debug(self.id, "Ignoring Request for", Debug.color(yiaddr, "blue"), "from", data["L2"]["From"],
+                        color="yellow", f=self.__class__.__name__
+                    )
+                return None
             
             # Check clients requested options & satisfy them, if any
-            requested_options = self.handleRequestedOptions( data )
+            requested_options = self.handleRequestedOptions( data, scope )
 
             # RFC2131 S4.3.1 Table 3
             # Server must send: 51      53      54      55 if applicable
             #                   Lease   MsgType SrvID   Requested Params
             server_options = {
-                51: self.lease_offer,
+                51: self._leaseTime(scope),
                 53: 5, # DHCP ACK
-                54: self.ip # DHCP Server ID
+                54: server # DHCP Server ID
             }
 
             options = mergeDicts(requested_options, server_options)
@@ -207,20 +771,11 @@ class DHCPServerHandler:
             DHCP = createDHCPHeader(op=2, 
                     chaddr=data["L3"]["Data"]["chaddr"],
                     yiaddr=yiaddr,
+                    giaddr=data["L3"]["Data"]["giaddr"],
                     options=options,
                     xid=data["L3"]["Data"]["xid"]
                 )
-
-            p4 = makePacket_L4_UDP(67, 68)
-            p3 = makePacket_L3(self.ip, "255.255.255.255", DHCP, "UDP")
-
-            # Check if the client wants the message broadcast or unicast
-            p2 = makePacket_L2("IPv4", 
-                    self.id, # From
-                    MAC_BROADCAST if data["L3"]["Data"]["flags"] else data["L2"]["From"], # To
-                    data["L2"]["FromLink"] # Onlink
-                )
-            p = makePacket(p2, p3, p4)
+            p = self._reply(data, DHCP, server)
 
             if self.DEBUG: 
                 Debug(self.id, "received Request from", data["L2"]["From"], 
@@ -230,17 +785,8 @@ class DHCPServerHandler:
                     color="green", f=self.__class__.__name__
                 )
             
-            # IP: (chaddr, lease_offer, lease_give_time)
-            # Update leased IP
-    
-            # If client defines a client identifier (61), use it
-            # otherwise clientID is chaddr + IP
-            # TODO: Find out how this table is actually formatted
-            if 61 in data["L3"]["Data"]["options"]:
-                self.leased_ips[yiaddr] = (data["L3"]["Data"]["options"][61], self.lease_offer, time.time())
-            else:
-                combo = data["L2"]["From"] + yiaddr
-                self.leased_ips[yiaddr] = (combo, self.lease_offer, time.time())
+            # Update leased IP, see _lease()
+            self._lease(yiaddr, data, scope)
 
             #interface = findInterfaceFromLinkID(data["L2"]["FromLink"], self.interfaces)
             return p#, interface
@@ -255,11 +801,12 @@ class DHCPServerHandler:
 # Not a Device, just deals with DHCP functionality
 # then returns output to the host / whatever it's inside of
 class DHCPClientHandler:
-    def __init__(self, haddr, linkid, debug=1):
+    def __init__(self, haddr, linkid, debug=1, clock=time.time):
 
         self.id = haddr
         self.linkid = linkid
         self.DEBUG = debug
+        self.clock = clock
         
         # 1 Subnet mask
         # 3 Router ID
@@ -267,30 +814,52 @@ class DHCPClientHandler:
         self.requested_options = [1,3,6]
         
         # L3
-        self.ip = ""
-        self.nmask = ""
-        self.gateway = ""
-        self.offered_ip = ""
+        self.ip = IP_ANY
+        self.nmask = IP_ANY
+        self.gateway = IP_ANY
+        self.offered_ip = IP_ANY
         self.lease = (-1, -1) # (leaseTime, time (s) received the lease)
         self.DHCP_FLAG = 0 # 0: No IP --- 1: Awaiting ACK --- 2: Received ACK & has active IP
         self.DHCP_MAC = ""
-        self.DHCP_IP = ""
+        self.DHCP_IP = IP_ANY
         self.current_tx = ""
 
-        # Not for the protocol
-        self.DHCP_FLAG = 0 # 0: No IP     1: Awaiting ACK     2: Received ACK & has active IP
+        # Transactions still waiting on an ACK: xid to a Future of the leased
+        # IP, resolved by the device once it has applied the lease
+        self.waiting = {}
+
+        # RFC2131 S4.4 states: INIT, SELECTING (Discover out), REQUESTING
+        # (Request out), BOUND, RENEWING (T1, unicast Request to our server)
+        # and REBINDING (T2, broadcast Request to any server)
+        self.state = "INIT"
+
+        # Retransmission, S4.1: the last message goes out again after 4
+        # seconds, then 8, 16 ... up to 64, each randomized by +-1 second so
+        # clients that started together drift apart. See tick()
+        self.retransmit_initial = 4
+        self.retransmit_max = 64
+        self.jitter = 1
+        self.request_attempts = 4 # Requests sent before going back to Discover
+        self.init_delay = 0 # Wait up to this long before the first Discover; S4.4.1 suggests 10
+        self.pending = None # The message being retransmitted, Packet
+        self.attempts = 0 # Times it has been sent
+        self.retransmit_at = None
+        self.lapsed = False # Set when a lease runs out unrenewed; the device drops the IP
+
+        # Stats
+        self.retransmits = 0
 
     def handleDHCP(self, data, oninterface):
         """
         Handle Offer / ACK, reply with Response. See `DHCPServerHandler.handleDHCP`.
         Will return None, None on ACK
 
-        :param data: See `Headers.makePacket()`, dict
-        :returns: The response packet, dict
+        :param data: See `Headers.makePacket()`, Packet
+        :returns: The response packet, Packet
         :returns: The linkID it should be sent out on, str
         """
-        # Process O(ffer)
-        if data["L3"]["Data"]["op"] == 2 and data["L3"]["Data"]["options"][53] == 2 and data["L3"]["Data"]["xid"] == self.current_tx:  
+        # Process O(ffer), the first one only
+        if data["L3"]["Data"]["op"] == 2 and data["L3"]["Data"]["options"][53] == 2 and data["L3"]["Data"]["xid"] == self.current_tx and self.state == "SELECTING":  
             # Send R(equest)
             
             #if self.DEBUG: print("(DHCP)", self.id, "received DHCP Offer, sending Request (broadcast)")
@@ -317,9 +886,11 @@ class DHCPClientHandler:
             DHCP = createDHCPHeader(chaddr=self.id, flags=1, options=options, xid=data["L3"]["Data"]["xid"])
 
             p4 = makePacket_L4_UDP(68, 67)
-            p3 = makePacket_L3("0.0.0.0", "255.255.255.255", DHCP, "UDP")
+            p3 = makePacket_L3(IP_ANY, IP_BROADCAST, DHCP, "UDP")
             p2 = makePacket_L2("IPv4", self.id, MAC_BROADCAST)
             p = makePacket(p2, p3, p4)
+            self.state = "REQUESTING"
+            self._retransmit(p)
             
             # Send it out on the same link we received data on
             #interface = findInterfaceFromLinkID(data["L2"]["FromLink"], self.interfaces)
@@ -335,9 +906,15 @@ class DHCPClientHandler:
             # if 6 in ... (DNS)
 
             self.ip = data["L3"]["Data"]["yiaddr"]
-            self.lease = (data["L3"]["Data"]["options"][51], int(time.time()) )
-            self.lease_left = (self.lease[0] + self.lease[1]) - int(time.time())
+            self.lease = (data["L3"]["Data"]["options"][51], int(self.clock()) )
+            self.lease_left = (self.lease[0] + self.lease[1]) - int(self.clock())
+            if 54 in data["L3"]["Data"]["options"]:
+                # Whoever ACKed a rebind is our server now
+                self.DHCP_IP = data["L3"]["Data"]["options"][54]
+                self.DHCP_MAC = data["L2"]["From"]
             self.DHCP_FLAG = 2
+            self.state = "BOUND"
+            self.pending = self.retransmit_at = None
             #self.current_xid = -1
             #if self.DEBUG: print("(DHCP)", self.id, "received DHCP ACK from", data["L2"]["From"]+".", "New IP:", self.ip)
             if self.DEBUG: 
@@ -356,12 +933,11 @@ class DHCPClientHandler:
     # Send D(iscover) or R(equest)
     def sendDHCP(self, context):
         """
-        Send (return) a DHCP Discover, or Request message.
+        Send (return) a DHCP Discover, or Request message. Whatever is sent
+        is retransmitted by tick() until it's answered.
 
-        :param context: "Init" or "Renew", str 
-        :param onLinkID: ID of link to be sent out on, str
-        :returns: The response packet, dict
-        :returns: The linkID it should be sent out on, str
+        :param context: "Init", "Renew" or "Rebind", str 
+        :returns: The packet to send, Packet. None for a Discover held back by init_delay
         """
         #if not oninterface:
         #    oninterface = self.interfaces[0]
@@ -385,14 +961,44 @@ class DHCPClientHandler:
             DHCP = createDHCPHeader(chaddr=self.id, options=options)
             
             p4 = makePacket_L4_UDP(68, 67)
-            p3 = makePacket_L3("0.0.0.0", "255.255.255.255", DHCP, "UDP") # MAC included
+            p3 = makePacket_L3(IP_ANY, IP_BROADCAST, DHCP, "UDP") # MAC included
             p2 = makePacket_L2("IPv4", self.id, MAC_BROADCAST, self.linkid)
             p = makePacket(p2, p3, p4)
 
-            self.current_tx = DHCP["xid"]
+            self._transaction(DHCP["xid"])
+            self.state = "SELECTING"
+            if self.init_delay:
+                # Send it from tick() in a while, so clients booting together don't all ask at once
+                self.pending, self.attempts = p, 0
+                self.retransmit_at = self.clock() + random.uniform(0, self.init_delay)
+                return None
+            self._retransmit(p)
             #interface = findInterfaceFromLinkID(onLinkID, self.interfaces)
             return p#, oninterface
         
+        # Send R(equest) rebinding: like a renewal, but broadcast to whichever server will answer
+        if context.lower() == "rebind":
+            self.DHCP_FLAG = 1
+            if self.DEBUG: 
+                Debug(self.id, "sending DHCP Request Rebinding", Debug.color(self.ip, "blue"), 
+                    f=self.__class__.__name__
+                )
+            options = {
+                53: 3, # Request
+                55: self.requested_options
+            }
+            DHCP = createDHCPHeader(chaddr=self.id, ciaddr=self.ip, options=options)
+
+            p4 = makePacket_L4_UDP(68, 67)
+            p3 = makePacket_L3(self.ip, IP_BROADCAST, DHCP, "UDP")
+            p2 = makePacket_L2("IPv4", self.id, MAC_BROADCAST)
+            p = makePacket(p2, p3, p4)
+
+            self._transaction(DHCP["xid"])
+            self.state = "REBINDING"
+            self._retransmit(p)
+            return p
+
         # Send R(equest) renewal
         if context.lower() == "renew":
             self.DHCP_FLAG = 1
@@ -417,6 +1023,77 @@ class DHCPClientHandler:
             p2 = makePacket_L2("IPv4", self.id, self.DHCP_MAC)
             p = makePacket(p2, p3, p4)
 
-            self.current_tx = DHCP["xid"]
+            self._transaction(DHCP["xid"])
+            self.state = "RENEWING"
+            self._retransmit(p)
             #interface = findInterfaceFromLinkID(onLinkID, self.interfaces)
             return p#, interface
+
+    def _transaction(self, xid):
+        """
+        Start transaction xid, superseding any older one. Whoever is still
+        waiting on the old one waits on this one instead, so a client that
+        starts over (a rebind, or a Discover after a Request went unanswered)
+        still wakes its caller once it's bound
+        """
+        self.current_tx = xid
+        future = next((f for f in self.waiting.values() if not f.done()), None)
+        self.waiting = {xid: future or Future()}
+
+    def _retransmit(self, p):
+        """
+        p was just sent; send it again in a while unless it's answered
+        """
+        self.pending, self.attempts = p, 1
+        self.retransmit_at = self.clock() + self._backoff()
+
+    def _backoff(self):
+        """
+        :returns: Seconds until the next retransmission, doubling each attempt, float
+        """
+        delay = min(self.retransmit_initial * 2 ** (self.attempts - 1), self.retransmit_max)
+        return max(0, delay + random.uniform(-self.jitter, self.jitter))
+
+    def tick(self):
+        """
+        Retransmit whatever went unanswered, and move a lease along: renew it
+        at T1 (half of it), rebind it at T2 (7/8 of it) and give it up at the
+        end, setting lapsed. Call this periodically, see `Host._checkTimeouts()`
+
+        :returns: Packets to send, [Packet]
+        """
+        now = self.clock()
+        out = []
+
+        if self.state in ("BOUND", "RENEWING", "REBINDING") and self.lease[0] >= 0:
+            length, start = self.lease
+            if now >= start + length:
+                if self.DEBUG:
+                    Debug(self.id, "lease on", self.ip, "ran out",
+                        color="red", f=self.__class__.__name__
+                    )
+                self.ip = IP_ANY
+                self.lease = (-1, -1)
+                self.lapsed = True
+                p = self.sendDHCP("init")
+                return [p] if p else []
+            if self.state != "REBINDING" and now >= start + 0.875 * length:
+                return [self.sendDHCP("rebind")]
+            if self.state == "BOUND" and now >= start + 0.5 * length:
+                return [self.sendDHCP("renew")]
+
+        if self.pending is not None and now >= self.retransmit_at:
+            if self.state == "REQUESTING" and self.attempts >= self.request_attempts:
+                # The server never answered our Request; start over
+                p = self.sendDHCP("init")
+                return [p] if p else []
+            if self.attempts:
+                self.retransmits += 1
+                if self.DEBUG == 2:
+                    Debug(self.id, "retransmitting", self.state, "attempt", self.attempts + 1,
+                        color="yellow", f=self.__class__.__name__
+                    )
+            self.attempts += 1
+            self.retransmit_at = now + self._backoff()
+            out.append(self.pending)
+        return out
@@ -2,20 +2,69 @@ import random
 import time
 import threading
 import os, sys
+import traceback
 
 from abc import ABC, abstractmethod
-import copy
+import asyncio
+import concurrent.futures
 from Headers import *
 from L1 import *
 from Debug import Debug
 from DHCP import DHCPServerHandler, DHCPClientHandler
 from ARP import ARPHandler
 from ICMP import ICMPHandler
-import ipaddress
+from Scheduler import Scheduler
+from AsyncRuntime import AsyncRuntime
+from WorkerPool import WorkerPool
+from Codec import encodePacket, WirePacket
 import pprint
+from collections import deque
 
 random.seed(123)
 
+class Inbox:
+    """
+    A device's listen_buffer in the threaded runtime. Any number of senders may
+    put() at once; each put() wakes the listener immediately, and drain() hands
+    back every pending frame in one go.
+    """
+    def __init__(self, lock=None):
+        """
+        :param lock: optional, the receiving device's lock to guard the queue with
+        """
+        self.frames = deque()
+        self.cv = threading.Condition(lock or threading.Lock())
+        self.closed = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, data):
+        with self.cv:
+            self.frames.append(data)
+            self.cv.notify()
+
+    def drain(self, timeout=None):
+        """
+        Wait until at least one frame is pending, then take all of them
+
+        :param timeout: optional, seconds to wait before giving up, float
+        :returns: deque of frames in arrival order, possibly empty
+        """
+        with self.cv:
+            if not self.frames and not self.closed:
+                self.cv.wait(timeout)
+            frames, self.frames = self.frames, deque()
+            return frames
+
+    def close(self):
+        """
+        Wake the listener for good, see `Device.stop()`
+        """
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
 # Abstract Base Class
 class Device(ABC):
     def __init__(self, connectedTo=[], debug=1, ID=None): # Device
@@ -28,6 +77,8 @@ class Device(ABC):
             - _initConnections() with devices in connectedTo
             - listen() for incoming data. Must be a while loop query on self.buffer, nothing else
                 - _checkTimeouts() in this listener, or another managed thread
+            - start() once constructed, which either starts the listener thread or,
+              if the device was created inside a Scheduler or AsyncRuntime, registers with it
         
         :param connectedTo: List of Devices
         :param debug: See below
@@ -45,25 +96,58 @@ class Device(ABC):
         # Debug 2 : Show who sends what to who
         self.DEBUG = debug
 
-        # For visualization purposes
-        self.listen_delay = 0.25
+        # For visualization purposes, seconds to pause before handling each frame
+        self.listen_delay = 0
+
+        # Seconds between _checkTimeouts() calls queued by the listener thread
+        self.check_interval = 0.25
+
+        # Send frames as packed bytes instead of header objects, see Codec
+        self.wire = False
         
         if ID: self.id = ID
         else: self.id = "___" + str(random.randint(10000, 99999999))
         self.interfaces = []
 
-        # To be used as a recipient for send(), read by listen()
-        self.listen_buffer = []
+        # Indexes over self.interfaces so per-frame lookups don't scan every
+        # interface; only ever add interfaces through addInterface()
+        self.interfaces_by_id = {}      # Interface ID: Interface
+        self.interfaces_by_link = {}    # Link ID: Interface
+        self.peers = {}                 # Link ID: Device on the other end
 
         self.lock = threading.Lock()
         self.thread_exit = False
+        self.check_queued = False # See listen()
+
+        # If created inside a `with Scheduler():` block, frames and timeouts are
+        # driven by its event queue in virtual time instead of by threads
+        self.scheduler = Scheduler.active
+
+        # If created inside a `with AsyncRuntime():` block, listen is a task on
+        # its event loop and the send*() request methods are coroutines
+        self.aio = AsyncRuntime.active
+
+        # To be used as a recipient for send(), read by listen()
+        if self.aio:
+            self.listen_buffer = asyncio.Queue()
+        else:
+            self.listen_buffer = Inbox(self.lock)
+
+        # Where listen() sends frames to be handled. Shared by every device by
+        # default; assign a separate WorkerPool to give a device its own threads.
+        # A Scheduler or AsyncRuntime handles frames itself, so needs no threads
+        self.executor = None
+        if not self.scheduler and not self.aio:
+            self.executor = WorkerPool.shared()
+
         self._initConnections(connectedTo)
 
-        self.lthread = threading.Thread(target=self.listen, args=())
+        # Daemon, so a finished script doesn't hang on devices nobody stopped
+        self.lthread = threading.Thread(target=self.listen, args=(), daemon=True)
 
         # Some devices need additional setup after the constructor,
         # So we let child devices start the listening thread manually
-        #self.lthread.start()
+        #self.start()
 
     def __del__(self):
         # If this object falls out of scope, safely terminate the running thread
@@ -80,30 +164,155 @@ class Device(ABC):
 
         return s
 
+    def start(self):
+        """
+        Begin listening: start the listener thread, or hand this device to the
+        Scheduler or AsyncRuntime it was created under.
+        """
+        if self.scheduler:
+            self.scheduler.addDevice(self)
+        elif self.aio:
+            self.aio.addDevice(self)
+        else:
+            self.lthread.start()
+
+    def stop(self):
+        """
+        Stop listening. The listener thread exits right away rather than at its next check.
+        """
+        self.thread_exit = True
+        if isinstance(self.listen_buffer, Inbox):
+            self.listen_buffer.close()
+
+    def clock(self):
+        """
+        The time according to this device: virtual seconds when running on a
+        Scheduler, otherwise wall clock time.
+        """
+        if self.scheduler:
+            return self.scheduler.now
+        return time.time()
+
     def listen(self):
+        next_check = time.time()
         while True:
             if self.thread_exit: return
-            self._checkTimeouts()
-            time.sleep(self.listen_delay)
-            if self.listen_buffer:
-                data = self.listen_buffer.pop(0)
-                # Grab the interface it came in on
-                interface = findInterfaceFromLinkID(data["L2"]["FromLink"], self.interfaces)
-                if self.DEBUG == 1: 
-                    Debug(self.id, "got data from", Debug.colorID(self.getOtherDeviceOnInterface(data["L2"]["FromLink"]).id), 
-                        color="green", f=self.__class__.__name__
-                    )
-                if self.DEBUG == 2:
-                    Debug(self.id, "got data from", Debug.colorID(self.getOtherDeviceOnInterface(data["L2"]["FromLink"]).id),
-                        data, 
-                        color="blue", f=self.__class__.__name__
-                    )
-
-                # Spawn a thread to handle this data
-
-                #self.handleData(data, interface)
-                x = threading.Thread(target=self.handleData, args=(data, interface))
-                x.start()
+            if time.time() >= next_check:
+                # Through the same queue as frames, so timers never run alongside a handler
+                if not self.check_queued:
+                    self.check_queued = True
+                    self.executor.submit(self, self._queuedCheck)
+                next_check = time.time() + self.check_interval
+
+            # Sleep until send() wakes us, or until timeouts are due, then take everything pending
+            for data in self.listen_buffer.drain(next_check - time.time()):
+                if self.listen_delay:
+                    time.sleep(self.listen_delay)
+                interface = self._receive(data)
+
+                # Hand it to a worker; frames for this device are handled one at a time, in order
+                self.executor.submit(self, self.handleData, data, interface)
+
+    def _queuedCheck(self):
+        """
+        _checkTimeouts(), as submitted by listen(). At most one is ever queued,
+        so a handler blocked for a while doesn't come back to a pile of them
+        """
+        self.check_queued = False
+        self._checkTimeouts()
+
+    async def alisten(self):
+        """
+        listen(), as a coroutine for devices running on an AsyncRuntime. Frames
+        are handled inline rather than in a thread each.
+        """
+        loop = asyncio.get_running_loop()
+        next_check = loop.time()
+        while not self.thread_exit:
+            if loop.time() >= next_check:
+                self._checkTimeouts()
+                next_check = loop.time() + self.aio.tick
+            try:
+                data = await asyncio.wait_for(self.listen_buffer.get(), next_check - loop.time())
+            except asyncio.TimeoutError:
+                continue
+
+            if self.listen_delay:
+                await asyncio.sleep(self.listen_delay)
+
+            interface = self._receive(data)
+            try:
+                self.handleData(data, interface)
+            except Exception:
+                # Mirror a crashed handler thread: report it and keep listening
+                traceback.print_exc()
+
+    def _receive(self, data):
+        """
+        Bookkeeping common to every incoming frame, however it was delivered
+
+        :returns: The Interface the frame came in on
+        """
+        # Grab the interface it came in on
+        interface = findInterfaceFromLinkID(data.L2.FromLink, self.interfaces_by_link)
+        if self.DEBUG == 1: 
+            Debug(self.id, "got data from", Debug.colorID(self.getOtherDeviceOnInterface(data.L2.FromLink).id), 
+                color="green", f=self.__class__.__name__
+            )
+        if self.DEBUG == 2:
+            Debug(self.id, "got data from", Debug.colorID(self.getOtherDeviceOnInterface(data.L2.FromLink).id),
+                data, 
+                color="blue", f=self.__class__.__name__
+            )
+        return interface
+
+    def _deliver(self, data):
+        """
+        Scheduler event: a frame arrives at this device and is handled right away
+        """
+        if self.thread_exit: return
+        interface = self._receive(data)
+        self.handleData(data, interface)
+
+    def _waitFor(self, future, timeout):
+        """
+        Block until a handler resolves future, or timeout seconds pass. On a
+        Scheduler, the wait runs the simulation forward in virtual time instead.
+
+        :param future: concurrent.futures.Future, handed out by ARPHandler etc.
+        :param timeout: Seconds, float
+        :returns: future.done(), bool
+        """
+        if self.scheduler:
+            return self.scheduler.runUntil(future.done, timeout)
+
+        deadline = time.time() + timeout
+        with self.executor.blocking():
+            if not self.executor.holds(self):
+                # Sleep until the listener's worker resolves it
+                concurrent.futures.wait([future], timeout)
+                return future.done()
+
+            # We're one of our own handlers, so the reply is queued behind us
+            # and nobody else will run it; handle frames inline while we wait
+            while not future.done():
+                if self.executor.runPending(self):
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                concurrent.futures.wait([future], min(remaining, 0.01))
+        return future.done()
+
+    async def _awaitFor(self, future, timeout):
+        """
+        _waitFor(), for devices running on an AsyncRuntime
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return future.done()
 
     
     @abstractmethod
@@ -140,40 +349,56 @@ class Device(ABC):
         Send an ARP request to another device on the same subnet. By default,
         send out this request on the first interface.
         
-        :param targetIP: IP of target device
+        :param targetIP: IP of target device, see `Headers.IP`
         :param oninterface: optional, the interface object to send the request on
+        :returns: The target's ID (MAC), or False on timeout. A coroutine on an AsyncRuntime
         """
-        
+        if self.aio:
+            return self.asendARP(targetIP, oninterface, timeout, result)
+
+        targetIP = IP(targetIP)
+        oninterface, future = self._startARP(targetIP, oninterface)
+
+        # Here, wait for the target ip to be populated with an ID (MAC)
+        resolved = timeout and self._waitFor(future, timeout)
+        return self._finishARP(targetIP, oninterface, future, resolved, result)
+
+    async def asendARP(self, targetIP, oninterface=None, timeout=5, result=None):
+        """
+        sendARP(), awaitable. See `Device.sendARP()`
+        """
+        targetIP = IP(targetIP)
+        oninterface, future = self._startARP(targetIP, oninterface)
+        resolved = timeout and await self._awaitFor(future, timeout)
+        return self._finishARP(targetIP, oninterface, future, resolved, result)
+
+    def _startARP(self, targetIP, oninterface):
         if not oninterface:
             oninterface = self.interfaces[0]
         
         assert isinstance(oninterface, Interface)
 
-        if not isinstance(targetIP, str):
-            #print(targetIP, type(targetIP))
-            raise ValueError("TargetIP must be string, given: " + str(targetIP) )
-        
+
         # Internally:
-        # Establish targetIP as -1 and change it upon receiving an ARP response
-        p = oninterface.ARPHandler.sendARP(targetIP)
-        self.send(p, oninterface)
-
-        # Here, check whether or not the target ip has been populated with an ID (MAC)
-        now = time.time()
-        b = 0
-        if timeout:
-            while (time.time() - now) < timeout:
-                if oninterface.ARPHandler.arp_cache[targetIP] != False:
-                    # ARP Response received!
-                    if result:
-                        result[0] = oninterface.ARPHandler.arp_cache[targetIP]
-                    return oninterface.ARPHandler.arp_cache[targetIP]
+        # The handler hands back a Future, resolved with the target's ID once
+        # the response comes in. If someone's already resolving targetIP we
+        # share their request and Future instead of broadcasting another
+        future, p = oninterface.ARPHandler.resolve(targetIP)
+        if p: self.send(p, oninterface)
+        return oninterface, future
+
+    def _finishARP(self, targetIP, oninterface, future, resolved, result):
+        if resolved:
+            # ARP Response received!
+            if result:
+                result[0] = future.result()
+            return future.result()
 
         if self.DEBUG:
             Debug(self.id, "ARP timeout for", targetIP,
                 color="red", f=self.__class__.__name__
             )
-        del oninterface.ARPHandler.arp_cache[targetIP]
+        oninterface.ARPHandler.abandon(targetIP, future)
         return False
             
 
@@ -181,7 +406,7 @@ class Device(ABC):
         """
         Handle incoming ARP data
 
-        :param data: See `Headers.makePacket()`, dict
+        :param data: See `Headers.makePacket()`, Packet
         """
 
         if not oninterface:
@@ -199,42 +424,71 @@ class Device(ABC):
         first interface on this device. For multi interface Devices like a Switch
         or Router, onlinkID may be defined.
         
-        :param data: See `Headers.makePacket()`, dict
+        :param data: See `Headers.makePacket()`, Packet
         :param onLinkID: optional, id parameter of link to be send out on
         """
         
-        assert isinstance(data, dict)
+        assert isinstance(data, Packet)
         if oninterface:
             assert isinstance(oninterface, Interface)
             assert "_I_" in oninterface.id
         if oninterface == None:
             oninterface = self.interfaces[0]
+        if not oninterface.link.up:
+            return # Nothing on the other end hears it
 
         # Is data in the right format?
-        for k, v in data.items():
-            if v == "": continue
-            if not k in ["L1", "L2", "L3", "L4", "L5", "L6", "L7"] or not isinstance(v, dict):
-                print("Data: ", data)
-                raise ValueError("data not in the correct format")
+        if not isinstance(data.L2, EthernetFrame):
+            print("Data: ", data)
+            raise ValueError("data not in the correct format")
 
-        # Don't modify the original dict
-        # This 26 character line represents at least 6 hours of my day
-        data = copy.deepcopy(data)
+        if self.wire:
+            # The receiver unpacks whatever layers it reads, see `Codec.WirePacket`
+            data = WirePacket(encodePacket(data), oninterface.linkid)
+        else:
+            # Don't modify the original frame; the receiver gets its own L2 header,
+            # and shares the rest copy-on-write, see `Headers.Packet`
+            data = data.copyL2()
 
-        #onlinkID = self.getInterfaceFromID(oninterfaceID).linkid
-        data["L2"]["FromLink"] = oninterface.linkid
+            #onlinkID = self.getInterfaceFromID(oninterfaceID).linkid
+            data.L2.FromLink = oninterface.linkid
 
         end = self.getOtherDeviceOnInterface(oninterface.linkid)
 
         if self.DEBUG:
-            Debug(self.id, "==>", Debug.colorID(end.id), "via", Debug.color(data["L2"]["FromLink"], "ul"), 
+            Debug(self.id, "==>", Debug.colorID(end.id), "via", Debug.color(data.L2.FromLink, "ul"), 
                 color="green", f=self.__class__.__name__
             )
-        self.lock.acquire()
-        end.listen_buffer.append(data)
-        self.lock.release()
+        if self.scheduler:
+            self.scheduler.schedule(self.scheduler.link_delay, end._deliver, data)
+            return
+        if self.aio:
+            end.listen_buffer.put_nowait(data)
+            return
+
+        # Guarded by the receiver's lock, see Inbox
+        end.listen_buffer.put(data)
         return
 
+    def addInterface(self, interface):
+        """
+        Attach an Interface to this device and index it by its ID, its link's
+        ID and the device on the other end of that link.
+
+        :param interface: Interface
+        :returns: False if it was already attached, bool
+        """
+        if interface.id in self.interfaces_by_id:
+            return False
+        self.interfaces.append(interface)
+        self.interfaces_by_id[interface.id] = interface
+        self.interfaces_by_link[interface.linkid] = interface
+
+        # Find the other device on the link
+        dl = interface.link.dl
+        self.peers[interface.linkid] = dl[1] if dl[0].id == self.id else dl[0]
+        return True
+
     def getOtherDeviceOnInterface(self, onlinkID):
         """
         Given a link ID, find the single device on the other end of it
@@ -242,13 +496,11 @@ class Device(ABC):
         :param onLinkID: id parameter of a link
         :returns: Device instance
         """
-        if not isinstance(onlinkID, str): raise ValueError("onlinkID must be of type <str>")
-        onlink = self.getLinkFromID(onlinkID)
-        # Find the other device on a link
-        if onlink.dl[0].id == self.id:
-            return onlink.dl[1]
-        else:
-            return onlink.dl[0]
+        peer = self.peers.get(onlinkID)
+        if peer is None:
+            if not isinstance(onlinkID, str): raise ValueError("onlinkID must be of type <str>")
+            raise ValueError("LinkID " + onlinkID + " not located in " + self.id + " interfaces")
+        return peer
     
     def getInterfaceFromID(self, ID):
         """
@@ -256,14 +508,12 @@ class Device(ABC):
 
         :returns: Interface
         """
-        if not isinstance(ID, str): raise ValueError("ID must be of type <str>")
-        if not "_I_" in ID: raise ValueError("Provided ID " + ID + " not a link ID")
-        
-        for interface in self.interfaces:
-            if interface.id == ID:
-                return interface
-        else:
-            raise ValueError("LinkID " + ID + " not located in " + self.id + " interfaces")
+        interface = self.interfaces_by_id.get(ID)
+        if interface is None:
+            if not isinstance(ID, str): raise ValueError("ID must be of type <str>")
+            if not "_I_" in ID: raise ValueError("Provided ID " + ID + " not an interface ID")
+            raise ValueError("InterfaceID " + ID + " not located in " + self.id + " interfaces")
+        return interface
 
     def getLinkFromID(self, ID):
         """
@@ -271,11 +521,9 @@ class Device(ABC):
             
         :returns: Link
         """
-        if not isinstance(ID, str): raise ValueError("ID must be of type <str>")
-        if not "[L]" in ID: raise ValueError("Provided ID " + ID + " not a link ID")
-        
-        for interface in self.interfaces:
-            if interface.linkid == ID:
-                return interface.link
-        else:
+        interface = self.interfaces_by_link.get(ID)
+        if interface is None:
+            if not isinstance(ID, str): raise ValueError("ID must be of type <str>")
+            if not "[L]" in ID: raise ValueError("Provided ID " + ID + " not a link ID")
             raise ValueError("LinkID " + ID + " not located in " + self.id + " interfaces")
+        return interface.link
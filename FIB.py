@@ -0,0 +1,154 @@
+from Headers import IP
+
+# The Router's forwarding table: a path compressed binary (Patricia) trie
+# over 32 bit addresses. Every route sits on the node for its prefix, nodes
+# with a single child are skipped over, and a lookup walks down from the root
+# remembering the last route it passed. That walk is at most 33 nodes deep no
+# matter how many routes there are, and the route it ends up with is always
+# the longest matching prefix.
+#
+#   fib = FIB()
+#   fib.insert("10.0.0.0", 8, route_a)
+#   fib.insert("10.1.0.0", 16, route_b)
+#   fib.lookup(IP("10.1.2.3"))   # route_b
+#   fib.lookup(IP("10.9.9.9"))   # route_a
+
+
+def _mask(prefixlen):
+    return (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF
+
+def _bit(key, index):
+    # Bit `index` of key, counting from the most significant
+    return (key >> (31 - index)) & 1
+
+
+class _Node:
+    __slots__ = ("key", "prefixlen", "route", "zero", "one")
+
+    def __init__(self, key, prefixlen, route=None):
+        self.key = key
+        self.prefixlen = prefixlen
+        self.route = route
+        self.zero = None
+        self.one = None
+
+    def child(self, bit):
+        return self.one if bit else self.zero
+
+    def setChild(self, bit, node):
+        if bit: self.one = node
+        else: self.zero = node
+
+
+class FIB:
+    def __init__(self):
+        self.root = _Node(0, 0)
+        self.routes = 0
+        self.nodes = 1
+
+    def __len__(self):
+        return self.routes
+
+    def insert(self, prefix, prefixlen, route):
+        """
+        Add a route, replacing any route already on the same prefix
+
+        :param prefix: Network address, see `Headers.IP`. Host bits are ignored
+        :param prefixlen: 0 - 32, int
+        :param route: Whatever lookup() should return for this prefix
+        """
+        prefixlen = int(prefixlen)
+        key = IP(prefix) & _mask(prefixlen)
+        node = self.root
+        while True:
+            # Invariant: node's prefix covers key, and node.prefixlen <= prefixlen
+            if node.prefixlen == prefixlen:
+                if node.route is None:
+                    self.routes += 1
+                node.route = route
+                return
+
+            bit = _bit(key, node.prefixlen)
+            child = node.child(bit)
+            if child is None:
+                node.setChild(bit, _Node(key, prefixlen, route))
+                self.routes += 1
+                self.nodes += 1
+                return
+
+            # How far do key and the child's prefix agree?
+            limit = min(prefixlen, child.prefixlen)
+            diff = (key ^ child.key) & _mask(limit)
+            common = limit if not diff else 32 - diff.bit_length()
+
+            if common == child.prefixlen:
+                node = child
+                continue
+
+            if common == prefixlen:
+                # The new prefix sits between node and child
+                new = _Node(key, prefixlen, route)
+                new.setChild(_bit(child.key, prefixlen), child)
+                node.setChild(bit, new)
+                self.nodes += 1
+            else:
+                # They part ways below node; join them under a routeless node
+                glue = _Node(key & _mask(common), common)
+                glue.setChild(_bit(child.key, common), child)
+                glue.setChild(_bit(key, common), _Node(key, prefixlen, route))
+                node.setChild(bit, glue)
+                self.nodes += 2
+            self.routes += 1
+            return
+
+    def remove(self, prefix, prefixlen):
+        """
+        Remove the route on exactly this prefix, if there is one
+
+        :returns: The removed route, or None
+        """
+        prefixlen = int(prefixlen)
+        key = IP(prefix) & _mask(prefixlen)
+        node = self.root
+        while node is not None and node.prefixlen < prefixlen:
+            node = node.child(_bit(key, node.prefixlen))
+        if node is None or node.prefixlen != prefixlen or node.key != key:
+            return None
+        route, node.route = node.route, None
+        if route is not None:
+            self.routes -= 1
+        return route
+
+    def lookup(self, ip):
+        """
+        Longest prefix match
+
+        :param ip: int or IP
+        :returns: The route on the longest prefix containing ip, or None
+        """
+        best = None
+        node = self.root
+        while node is not None:
+            if (ip ^ node.key) & _MASKS[node.prefixlen]:
+                break # Diverged from this branch
+            if node.route is not None:
+                best = node.route
+            if node.prefixlen == 32:
+                break
+            node = node.one if (ip >> (31 - node.prefixlen)) & 1 else node.zero
+        return best
+
+    def __iter__(self):
+        """
+        Every (prefix, prefixlen, route), shortest prefixes first along each branch
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.route is not None:
+                yield IP(node.key), node.prefixlen, node.route
+            for child in (node.one, node.zero):
+                if child is not None:
+                    stack.append(child)
+
+_MASKS = [_mask(n) for n in range(33)]
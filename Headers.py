@@ -1,4 +1,6 @@
 import random
+import copy
+from socket import inet_aton, inet_ntoa
 
 """
 Supported Protocols:
@@ -6,8 +8,56 @@ DHCP
 ARP
 """
 
+class IP(int):
+    """
+    An IPv4 address, kept as a plain 32 bit int so that comparing, hashing and
+    masking one is a single int operation. Strings are only for display:
+    str() gives the dotted form back.
+
+    Anywhere an address is accepted it may be given as "x.x.x.x", "x.x.x.x/n"
+    (the prefix is dropped), an int, or an IP.
+    """
+    __slots__ = ()
+
+    def __new__(cls, value=0):
+        if value.__class__ is cls:
+            return value
+        if isinstance(value, str):
+            if not value:
+                value = 0
+            else:
+                try:
+                    value = int.from_bytes(inet_aton(value.split("/")[0]), "big")
+                except OSError:
+                    raise ValueError("Not an IPv4 address: " + repr(value))
+        elif value is None:
+            value = 0
+        return int.__new__(cls, value)
+
+    def __str__(self):
+        return inet_ntoa(self.to_bytes(4, "big"))
+
+    def __repr__(self):
+        return str(self)
+
+def prefixToMask(prefixlen):
+    """
+    :param prefixlen: 0 - 32, int
+    :returns: The netmask, e.g. 24 -> 255.255.255.0, IP
+    """
+    return IP((0xFFFFFFFF << (32 - int(prefixlen))) & 0xFFFFFFFF)
+
+def maskToPrefix(mask):
+    """
+    :param mask: A netmask, IP or str
+    :returns: The prefix length, e.g. 255.255.255.0 -> 24, int
+    """
+    return bin(IP(mask)).count("1")
+
 MAC_BROADCAST = "FFFF"
-IP_BROADCAST = "255.255.255.255"
+MAC_STP = "0180C2" # 01:80:C2:00:00:00, the bridge group address BPDUs are sent to
+IP_BROADCAST = IP("255.255.255.255")
+IP_ANY = IP("0.0.0.0")
 #random.seed(123)
 
 def mergeDicts(x, y):
@@ -25,16 +75,19 @@ def mergeDicts(x, y):
     
     return x
 
-def removeHostBits(s): # TODO: Fix for non-24 masks
-    s = s.split("/")[0].split(".")
-    s[-1] = "0"
-    s = ".".join(s)
-    return s
+def removeHostBits(ip, mask):
+    """
+    :returns: The network address of ip, IP
+    """
+    return IP(IP(ip) & IP(mask))
 
 def splitAddr(s):
+    """
+    :param s: "x.x.x.x/n", str
+    :returns: The address and its netmask, IP, IP
+    """
     l = s.split("/")
-    netmask = '.'.join([str((0xffffffff << (32 - int(l[1])) >> i) & 0xff) for i in [24, 16, 8, 0]])
-    return l[0], netmask
+    return IP(l[0]), prefixToMask(l[1])
 
 def genericIgnoreMessage(inproto, ID, fr=None):
     s = ""
@@ -42,8 +95,18 @@ def genericIgnoreMessage(inproto, ID, fr=None):
     print("("+inproto+")", ID, "ignoring data", s)
 
 def findInterfaceFromLinkID(ID, interfaces):
+    """
+    :param interfaces: A list of Interfaces, or a Device's interfaces_by_link index
+        which makes this a single dict lookup
+    :returns: The Interface on link ID
+    """
     if not ID or not interfaces:
         raise ValueError("ID or interfaces is None")
+    if isinstance(interfaces, dict):
+        interface = interfaces.get(ID)
+        if interface is None:
+            raise ValueError("Could not find interface from linkID:" + ID)
+        return interface
     for interface in interfaces:
         if interface.linkid == ID:
             return interface
@@ -51,70 +114,241 @@ def findInterfaceFromLinkID(ID, interfaces):
         raise ValueError("Could not find interface from linkID:" + ID)
 
 
+class Header:
+    """
+    Base for every header below. Fields live in __slots__ named exactly like the
+    keys of the dicts these classes replace, so handlers can keep writing
+    data["L2"]["To"], "To" in data["L2"], data.items() and so on, while each
+    header costs a fixed handful of pointers instead of a dict.
+    """
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The fields exposed through the dict view: the class's own __slots__, unless it says otherwise
+        if "_fields" not in cls.__dict__:
+            cls._fields = cls.__slots__
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return self._fields
+
+    def values(self):
+        return [getattr(self, k) for k in self._fields]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self._fields]
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def copy(self):
+        """
+        :returns: A shallow copy; anything this header encapsulates is shared
+        """
+        new = object.__new__(self.__class__)
+        for k in self._fields:
+            setattr(new, k, getattr(self, k))
+        return new
+
+    def __deepcopy__(self, memo):
+        # Much quicker than deepcopy's generic __reduce_ex__ route for slotted objects
+        new = object.__new__(self.__class__)
+        for k in self._fields:
+            v = getattr(self, k)
+            setattr(new, k, v if v.__class__ in (str, int, IP) else copy.deepcopy(v, memo))
+        return new
+
+    def toDict(self):
+        """
+        :returns: A plain nested dict of this header and everything it encapsulates
+        """
+        return {k: v.toDict() if isinstance(v, Header) else v for k, v in self.items()}
+
+    def __repr__(self):
+        return repr(self.toDict())
+
+class Packet(Header):
+    """
+    The whole frame, one header per OSI layer. Nothing here goes above L4.
+
+    Frames are copy-on-write. Every hop gets its own L2 header (see copyL2(),
+    used by Device.send()) and may rewrite it freely, but L3 and up are shared
+    with every other copy of the frame in flight and must be treated as read
+    only; copy() a header before changing it.
+    """
+    __slots__ = ("L2", "L3", "L4")
+
+    def __init__(self, L2="", L3="", L4=""):
+        self.L2 = L2
+        self.L3 = L3
+        self.L4 = L4
+
+    def copyL2(self):
+        """
+        :returns: A new Packet with its own copy of the L2 header, sharing everything above it
+        """
+        new = Packet.__new__(Packet)
+        new.L2 = self.L2.copy()
+        new.L3 = self.L3
+        new.L4 = self.L4
+        return new
+
+class EthernetFrame(Header):
+    __slots__ = ("EtherType", "From", "To", "FromLink", "VLAN", "Data")
+
+    def __init__(self, EtherType, From, To, FromLink, Data, VLAN=None):
+        self.EtherType = EtherType # Defines which protocol is encapsulated in data
+        self.From = From
+        self.To = To
+        self.FromLink = FromLink
+        self.VLAN = VLAN # 802.1Q VLAN ID, or None if untagged. Switches add and strip it, see Switch
+        self.Data = Data # ARP packet, IP packet, DHCP packet, etc
+
+class IPv4Packet(Header):
+    __slots__ = ("Version", "HLEN", "TOS", "TotalLength", "ID", "Flags", "FOffset",
+                 "TTL", "Protocol", "Checksum", "SIP", "DIP", "Data")
+
+    def __init__(self, SIP, DIP, Data, Protocol, TTL, ID):
+        self.Version = 4 # Make a new parameter if you love 6 so much, nerd
+        self.HLEN = 0 # unimplemented until we care about fragmentation
+        self.TOS = 0 # unused
+        self.TotalLength = 0
+        self.ID = ID # fragmentation
+        self.Flags = 0 # fragmentation
+        self.FOffset = 0
+        self.TTL = TTL
+
+        # https://www.iana.org/assignments/protocol-numbers/protocol-numbers.xhtml
+        # For "Protocol" we'll probably just use names to not confuse ourselves
+        self.Protocol = Protocol
+        self.Checksum = 0
+        self.SIP = SIP # Src, Dst
+        self.DIP = DIP
+        self.Data = Data
+
+class UDPDatagram(Header):
+    __slots__ = ("SPort", "DPort", "Length", "Checksum", "Data")
+
+    def __init__(self, SPort, DPort, Length, Checksum, Data):
+        self.SPort = SPort
+        self.DPort = DPort
+        self.Length = Length
+        self.Checksum = Checksum
+        self.Data = Data
+
+class ARPMessage(Header):
+    __slots__ = ("HT", "PT", "HAL", "PAL", "OP", "SHA", "SPA", "THA", "TPA")
+
+    def __init__(self, OP, SHA, SPA, THA, TPA):
+        self.HT = "Ethernet"
+        self.PT = "IPv4" # We won't be using anything other than IPv4 for the time being
+        self.HAL = 6
+        self.PAL = 4 # From http://www.tcpipguide.com/free/t_ARPMessageFormat.htm
+        self.OP = OP
+        self.SHA = SHA
+        self.SPA = SPA
+        self.THA = THA
+        self.TPA = TPA
+
+class DHCPMessage(Header):
+    __slots__ = ("op", "htype", "hardwareaddrlen", "hops", "xid", "seconds", "flags",
+                 "ciaddr", "yiaddr", "siaddr", "giaddr", "chaddr", "sname", "file", "options")
+
+    def __init__(self, op, htype, hardwareaddrlen, hops, xid, seconds, flags,
+                 ciaddr, yiaddr, siaddr, giaddr, chaddr, options):
+        self.op = op
+        self.htype = htype
+        self.hardwareaddrlen = hardwareaddrlen
+        self.hops = hops # Incremented by relays
+        self.xid = xid
+        self.seconds = seconds
+        self.flags = flags
+        self.ciaddr = ciaddr
+        self.yiaddr = yiaddr
+        self.siaddr = siaddr
+        self.giaddr = giaddr
+        self.chaddr = chaddr
+        self.sname = ""
+        self.file = ""
+        self.options = options
+
+class BPDU(Header):
+    __slots__ = ("protocol", "version", "type", "flags", "root", "cost", "bridge", "port",
+                 "age", "max_age", "hello", "forward_delay")
+
+    def __init__(self, type, flags, root, cost, bridge, port, age, max_age, hello, forward_delay):
+        self.protocol = 0
+        self.version = 0 # 802.1D
+        self.type = type # 0 Configuration, 0x80 Topology Change Notification
+        self.flags = flags # TC 0x01, TCA 0x80
+        self.root = root # Bridge IDs are (priority, switch ID)
+        self.cost = cost # Root path cost of the sender
+        self.bridge = bridge
+        self.port = port
+        self.age = age # Seconds; timers are carried so the root's settings win everywhere
+        self.max_age = max_age
+        self.hello = hello
+        self.forward_delay = forward_delay
+
+class ICMPMessage(Header):
+    __slots__ = ("type", "code", "identifier", "SNum")
+
+    def __init__(self, type, code, identifier, SNum):
+        self.type = type
+        self.code = code
+        self.identifier = identifier
+        self.SNum = SNum
+
 def makePacket(L2="", L3="", L4="", L5="", L6="", L7=""):
     """
     The standard packet format used in this project. Each entry
     represents an OSI layer, which has its own packing function
     elsewhere in this file.
+
+    :returns: Packet
     """
-    
-    d = {
-        "L2":L2,
-        "L3":L3,
-        "L4":L4,
-        "L5":L5,
-        "L6":L6,
-        "L7":L7 
-    }
-    
-    for k, v in d.items():
-        if v != "" and not isinstance(v, dict):
-            raise ValueError("Arguments must be of type <dict>")
+    if L5 != "" or L6 != "" or L7 != "":
+        raise ValueError("Layers above L4 are not implemented")
 
-    return d
+    for v in (L2, L3, L4):
+        if v != "" and not isinstance(v, Header):
+            raise ValueError("Arguments must be headers, see makePacket_L2() etc.")
+
+    return Packet(L2, L3, L4)
 
 # An ethernet frame
-def makePacket_L2(ethertype="", fr="", to="", fromlink="", data=""):
-    return {
-        "EtherType":ethertype, # Defines which protocol is encapsulated in data
-        "From":fr,
-        "To":to,
-        "FromLink":fromlink,
-        "Data":data, # ARP packet, IP packet, DHCP packet, etc
-    }
+def makePacket_L2(ethertype="", fr="", to="", fromlink="", data="", vlan=None):
+    return EthernetFrame(ethertype, fr, to, fromlink, data, vlan)
 
 # an IP packet
 def makePacket_L3(sip, dip, data="", proto=None, TTL=10 ):
-    if data: assert isinstance(data, dict)
+    if data: assert isinstance(data, Header)
     if proto: assert isinstance(proto, str)
-    return {
-        "Version":4, # Make a new parameter if you love 6 so much, nerd
-        "HLEN":0, # unimplemented until we care about fragmentation
-        "TOS":0, # unused
-        "TotalLength":0,
-        "ID":random.randint(0, 2**16), # fragmentation
-        "Flags":0, # fragmentation
-        "FOffset":0,
-        "TTL":TTL,
-
-        # https://www.iana.org/assignments/protocol-numbers/protocol-numbers.xhtml
-        # For "Protocol" we'll probably just use names to not confuse ourselves
-        "Protocol":proto,
-        "Checksum":0,
-        "SIP":sip, # Src, Dst
-        "DIP":dip,
-        "Data":data
-    }
+    return IPv4Packet(IP(sip), IP(dip), data, proto, TTL, random.randint(0, 0xFFFF))
 
 # UDP
 def makePacket_L4_UDP(sp="", dp="", data="", length="", checksum=""):
-    return {
-        "SPort":sp,
-        "DPort":dp,
-        "Length":length,
-        "Checksum":checksum,
-        "Data":data
-    }
+    return UDPDatagram(sp, dp, length, checksum, data)
 
 
 #https://www.rfc-editor.org/rfc/rfc6747
@@ -152,22 +386,7 @@ ARP REQUEST PACKET FORMAT                       ARP RESPONSE FORMAT (same thing)
 +--------+--------+--------+--------+           +--------+--------+--------+--------+
 """
 def createARPHeader(op, fr, frIP, to, toIP):
-    d = {
-        "HT":"Ethernet",
-        "PT":"IPv4", # We won't be using anything other than IPv4 for the time being
-        "HAL":6,
-        "PAL":4, # From http://www.tcpipguide.com/free/t_ARPMessageFormat.htm
-        "OP":op,
-        "SHA":fr,
-        "SPA":frIP,
-        "THA":to,
-        "TPA":toIP
-    }
-
-    #for option_name, option_value in options.items():
-    #    d[option_name] = option_value
-
-    return d
+    return ARPMessage(op, fr, IP(frIP), to, IP(toIP))
 
 
 """
@@ -200,7 +419,7 @@ DHCP RFC 2131
 OP                  Request 1 (D / R) or Response 2 (O / A)
 htype               1 for ethernet, all we use here
 hardwareaddrlen     Length of hardware address
-hops                TTL
+hops                Number of relay agents the message passed through
 xid                 Transaction ID, randomly generated
 seconds             Seconds since start of DORA from client, recorded by server
 flags               1: Broadcast --- 0: unicast
@@ -216,36 +435,16 @@ options             DORA uses message 53, which is all we will use. This field w
 # https://www.netmanias.com/en/post/techdocs/5998/dhcp-network-protocol/understanding-the-basic-operations-of-dhcp
 # https://avocado89.medium.com/dhcp-packet-analysis-c84827e162f0
 def createDHCPHeader(op=1, htype=1, hardwareaddrlen=6,
-                     hops=-1, xid=None,
-                     seconds=0, flags=1, ciaddr="0.0.0.0", yiaddr="0.0.0.0",
-                     siaddr="0.0.0.0",giaddr="0.0.0.0", chaddr="", options={}):
+                     hops=0, xid=None,
+                     seconds=0, flags=1, ciaddr=IP_ANY, yiaddr=IP_ANY,
+                     siaddr=IP_ANY, giaddr=IP_ANY, chaddr="", options={}):
     
     if not xid:
-        xid = random.randint(1000000000, 9999999999)
-
-
-    d = {
-        "op":op,
-        "htype":htype,
-        "hardwareaddrlen":hardwareaddrlen,
-        "hops":hops, # No limit by default
-        "xid":xid,
-        "seconds":seconds,
-        "flags":flags,
-        "ciaddr":ciaddr,
-        "yiaddr":yiaddr,
-        "siaddr":siaddr,
-        "giaddr":giaddr,
-        "chaddr":chaddr,
-        "sname":"",
-        "file":"",
-        "options":options
-    }
-
-    #for option_name, option_value in options.items():
-    #    d[option_name] = option_value
-
-    return d
+        xid = random.randint(1, 0xFFFFFFFF) # 32 bits on the wire
+
+
+    return DHCPMessage(op, htype, hardwareaddrlen, hops, xid, seconds, flags,
+                       IP(ciaddr), IP(yiaddr), IP(siaddr), IP(giaddr), chaddr, options)
 
 """
 ICMP RFC 792
@@ -266,20 +465,34 @@ Seq Number          Same as Identifier? TODO
 """
 def createICMPHeader(typ, code=0, identifier=None, snum=None): # Only echo requests / replies, we ignore the rest
 
-    if not identifier:
-        identifier = random.randint(0, 999999)
-    if not snum:
-        snum = random.randint(0, 999999)
+    # Both are 16 bits on the wire
+    if identifier is None:
+        identifier = random.randint(0, 0xFFFF)
+    if snum is None:
+        snum = random.randint(0, 0xFFFF)
     """
     To form an echo reply message, the source and destination
     addresses are simply reversed, the type code changed to 0,
     and the checksum recomputed.
     """
-    d = {
-        "type":int(typ),
-        "code":int(code),
-        "identifier":int(identifier),
-        "SNum":int(snum),
-    }
-
-    return d
+    return ICMPMessage(int(typ), int(code), int(identifier), int(snum))
+
+
+"""
+802.1D Configuration BPDU, sent in an 802.3 frame with LLC 42 42 03
++--------+--------+--------+--------+--------+--------+--------+--------+
+| Protocol ID (2) |Version |  Type  | Flags  |     Root ID (8) ...      |
++--------+--------+--------+--------+--------+--------+--------+--------+
+|  ... Root ID             |        Root Path Cost (4)         | Bridge |
++--------+--------+--------+--------+--------+--------+--------+--------+
+|                ... Bridge ID (8)                    |  Port ID (2)    |
++--------+--------+--------+--------+--------+--------+--------+--------+
+| Message Age (2) |   Max Age (2)   | Hello Time (2)  | Fwd Delay (2)   |
++--------+--------+--------+--------+--------+--------+--------+--------+
+A Topology Change Notification is only the first 4 bytes, with Type 0x80
+"""
+def createBPDUHeader(root, cost, bridge, port, age=0, tc=False, max_age=20, hello=2, forward_delay=15):
+    return BPDU(0x00, 0x01 if tc else 0x00, root, cost, bridge, port, age, max_age, hello, forward_delay)
+
+def createTCNHeader(bridge):
+    return BPDU(0x80, 0x00, None, 0, bridge, 0, 0, 0, 0, 0)
@@ -1,6 +1,6 @@
 from Headers import *
 from Debug import *
-import ipaddress
+from concurrent.futures import Future
 
 class ICMPHandler:
     def __init__(self, ID, linkid, ip, nmask, debug=1):
@@ -13,6 +13,7 @@ class ICMPHandler:
         self.nmask = nmask
         
         # Used to keep track of outgoing ICMP connections
+        # identifier: Future, resolved (True) once the reply comes in
         self.icmp_table = {}
     
     def sendICMP(self, targetIP, targetID):
@@ -24,7 +25,7 @@ class ICMPHandler:
         p2 = makePacket_L2("IPv4", self.id, targetID)
         p = makePacket(p2, p3)
 
-        self.icmp_table[ICMP["identifier"]] = False
+        self.icmp_table[ICMP["identifier"]] = Future()
 
         if self.DEBUG:
             Debug(self.id, "sending ICMP to", targetIP,
@@ -52,7 +53,9 @@ class ICMPHandler:
                     color="green", f=self.__class__.__name__
                 )
             if data["L3"]["Data"]["identifier"] in self.icmp_table:
-                self.icmp_table[data["L3"]["Data"]["identifier"]] = True
+                future = self.icmp_table[data["L3"]["Data"]["identifier"]]
+                if not future.done():
+                    future.set_result(True)
             else:
                 if self.DEBUG:
                     Debug(self.id, data["L3"]["Data"]["identifier"], "not in ICMP table - did I send this request?",
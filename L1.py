@@ -1,4 +1,5 @@
 import random
+from Headers import IP
 
 
 class Link:
@@ -7,17 +8,32 @@ class Link:
         self.id = "[L]" + str(random.randint(10000, 99999999))
         self.dl = dl
 
+        # Set False to cut the cable: frames sent on it are dropped, and a
+        # Switch running STP treats its port as disabled
+        self.up = True
+
 class Interface:
+    # Stored as IP however they're assigned, see __setattr__
+    ADDRESSES = ("ip", "nmask", "gateway")
+
     def __init__(self, link, ip, parentID):
         self.id = "_I_" + str(random.randint(10000, 99999999))
         self.link = link
         self.linkid = link.id
+        self.network = IP()
         self.ip = ip
 
         self.DHCPClient = None
         self.ARPHandler = None
         self.ICMPHandler = None
 
+        # 802.1Q, only looked at by Switches; see Switch.setAccess() / setTrunk().
+        # An access port carries one VLAN untagged. A trunk carries allowed_vlans
+        # (None for all of them) tagged, except its native VLAN which goes untagged
+        self.vlan = 1
+        self.trunk = False
+        self.allowed_vlans = None
+
         # Will also have gateway / nmask, and anything else important per interface
         self.gateway = ""
         self.nmask = ""
@@ -25,8 +41,26 @@ class Interface:
         # If this interface was configured with DHCP, they will be the same
         # If not, then the DHCPClient contains defualt into and should not be referred to
 
+    def __setattr__(self, name, value):
+        # Addresses may be set as "x.x.x.x", "x.x.x.x/n" or IP; the network
+        # address is kept up to date alongside, see inSubnet()
+        if name in Interface.ADDRESSES:
+            value = IP(value)
+            object.__setattr__(self, name, value)
+            if name != "gateway":
+                object.__setattr__(self, "network", IP(self.ip & getattr(self, "nmask", 0)))
+            return
+        object.__setattr__(self, name, value)
+
+    def inSubnet(self, ip):
+        """
+        :param ip: IP
+        :returns: Whether ip is on this interface's subnet, bool
+        """
+        return ip & self.nmask == self.network
+
     def __str__(self):
-        return "(" + self.id + ":" + self.ip + ")"
+        return "(" + self.id + ":" + str(self.ip) + ")"
     def __repr__(self):
-        return "(" + self.id + ":" + self.ip + ")"
+        return "(" + self.id + ":" + str(self.ip) + ")"
 
@@ -1,5 +1,7 @@
 from Device import *
 from L3 import L3Device
+from STP import STPHandler
+from collections import OrderedDict
 
 
 random.seed(123)
@@ -15,7 +17,7 @@ class L2Device(Device):
         :param ID: Optionally a child class can provide its ID to be used with inits of some Handler, like DHCP or ARP
         """
         super().__init__(connectedTo, debug, ID)
-        self.lthread.start()
+        self.start()
 
     def _initConnections(self, connectedTo):
         """
@@ -30,20 +32,18 @@ class L2Device(Device):
             your_interface = Interface(link, "0.0.0.0", device.id)
 
             # Create my interface to you
-            if not my_interface in self.interfaces:
-                self.interfaces.append(my_interface)
+            self.addInterface(my_interface)
 
             # Create your interface to me
-            if not your_interface in device.interfaces:
-                device.interfaces.append(your_interface)
+            if device.addInterface(your_interface):
                 if self.DEBUG == 2:
                     Debug(self.id, "Initializing connection with", type(device), device.id,
                         color="blue", f=self.__class__.__name__
                     )
                 if isinstance(device, L3Device):
-                    your_interface.DHCPClient = DHCPClientHandler(device.id, link.id, debug=1)
+                    your_interface.DHCPClient = DHCPClientHandler(device.id, link.id, debug=1, clock=device.clock)
                     your_interface.ICMPHandler = ICMPHandler(device.id, link.id, "0.0.0.0", None, debug=1)
-                    your_interface.ARPHandler = ARPHandler(device.id, link.id, "0.0.0.0", debug=1)
+                    your_interface.ARPHandler = ARPHandler(device.id, link.id, "0.0.0.0", debug=1, clock=device.clock)
                     device._associateIPsToInterfaces() # Possibly in need of a lock
                 #else:
                     #print(self.id, type(device))
@@ -54,40 +54,305 @@ TODO: A static IP host doesn't know where the gateway is
 """
 
 class Switch(L2Device):
-    def __init__(self, connectedTo=[], debug=1): # Switch
+    def __init__(self, connectedTo=[], debug=1, stp=False): # Switch
+        """
+        :param stp: Run Spanning Tree, needed if this switch is part of a loop. See STP.py
+        """
         self.id = "{S}" + str(random.randint(10000, 99999999))
-        self.switch_table = {}
+
+        # One MAC table per VLAN, each MAC: [egress Interface, last seen], least
+        # recently seen first. A MAC moves to the back whenever a frame from it
+        # arrives, so the front is always the next entry to age out or be evicted
+        # Only handlers and _checkTimeouts() touch them, and a device never runs
+        # those two at once (see Device.listen()), so they need no lock
+        self.mac_tables = {1: OrderedDict()}
+        self.mac_table = self.mac_tables[1] # The default VLAN's
+        self.mac_aging = 300        # Seconds an entry lives without traffic from it
+        self.mac_table_size = 8192  # Entries kept per VLAN before evicting the oldest
+
+        # VLAN: the Interfaces a frame on that VLAN may be flooded out of, see _updateVLANs()
+        self.vlan_ports = {}
+        self.trunk_ports = [] # Trunks carrying every VLAN, the flood list of VLANs with no access ports
+
+        # Stats, see stats()
+        self.hits = 0       # Unicast frames forwarded out of a single known interface
+        self.misses = 0     # Unicast frames to a MAC not in the table, so flooded
+        self.floods = 0     # Every flooded frame: misses and broadcasts
+        self.aged = 0
+        self.evicted = 0
+        self.dropped = 0    # Frames on a VLAN their ingress port doesn't carry
+
+        # Created before connecting, so every port gets registered, see addInterface()
+        self.STPHandler = STPHandler(self.id, self.clock, self.flushMACs, debug=debug) if stp else None
 
         super().__init__(connectedTo, debug, self.id) # Switch
 
+    def addInterface(self, interface):
+        if not super().addInterface(interface):
+            return False
+
+        # Links to other switches trunk every VLAN, everything else is an access port on VLAN 1
+        interface.trunk = isinstance(self.peers[interface.linkid], Switch)
+        self._updateVLANs()
+
+        if self.STPHandler:
+            # Nothing but hosts and routers behind it? Then it can forward straight away
+            edge = not isinstance(self.peers[interface.linkid], Switch)
+            for port, p in self.STPHandler.addPort(interface, edge):
+                self.send(p, port)
+        return True
+
     def _checkTimeouts(self):
-        return
+        if self.STPHandler:
+            for interface, p in self.STPHandler.tick():
+                self.send(p, interface)
+
+        # Age out MACs we haven't heard from, oldest first
+        oldest = self.clock() - self.mac_aging
+        for vlan, table in self.mac_tables.items():
+            while table:
+                mac, entry = next(iter(table.items()))
+                if entry[1] > oldest:
+                    break
+                del table[mac]
+                self.aged += 1
+                if self.DEBUG == 2:
+                    Debug(self.id, "aged out", mac, "on VLAN", vlan,
+                        color="yellow", f=self.__class__.__name__
+                    )
+
+    def learn(self, mac, interface, vlan=1):
+        """
+        Record that mac is reachable out of interface, as of now
+
+        :param mac: Device ID (MAC)
+        :param interface: Interface the frame from mac came in on
+        :param vlan: VLAN the frame was on, int
+        """
+        table = self.mac_tables.get(vlan)
+        if table is None:
+            table = self.mac_tables[vlan] = OrderedDict()
+        entry = table.get(mac)
+        if entry is None:
+            if len(table) >= self.mac_table_size:
+                table.popitem(last=False)
+                self.evicted += 1
+            table[mac] = [interface, self.clock()]
+            return
+        # Refresh; if the MAC moved ports, the new interface wins
+        entry[0] = interface
+        entry[1] = self.clock()
+        table.move_to_end(mac)
+
+    def flushMACs(self):
+        """
+        Forget every learned MAC, e.g. when STP reports the tree changed
+        """
+        for table in self.mac_tables.values():
+            table.clear()
+
+    def setAccess(self, interface, vlan):
+        """
+        Make interface an access port: frames to and from it are untagged, and on vlan
+
+        :param interface: One of this switch's Interfaces
+        :param vlan: 1 - 4094, int
+        """
+        interface.trunk = False
+        interface.vlan = int(vlan)
+        self._updateVLANs()
+
+    def setTrunk(self, interface, allowed=None, native=1):
+        """
+        Make interface a trunk port: frames are tagged with their VLAN, except
+        those on the native VLAN
+
+        :param interface: One of this switch's Interfaces
+        :param allowed: The VLANs to carry, iterable of int, or None for all
+        :param native: VLAN for untagged frames, int
+        """
+        interface.trunk = True
+        interface.vlan = int(native)
+        interface.allowed_vlans = None if allowed is None else set(int(v) for v in allowed)
+        self._updateVLANs()
+
+    def _updateVLANs(self):
+        """
+        Rebuild each VLAN's flood list from the port configuration, so flooding
+        only ever looks at the ports of one VLAN
+        """
+        self.trunk_ports = [i for i in self.interfaces if i.trunk and i.allowed_vlans is None]
+        vlans = set()
+        for interface in self.interfaces:
+            if not interface.trunk:
+                vlans.add(interface.vlan)
+            elif interface.allowed_vlans is not None:
+                vlans.update(interface.allowed_vlans)
+            else:
+                vlans.add(interface.vlan)
+
+        self.vlan_ports = {vlan: [] for vlan in vlans}
+        for interface in self.interfaces:
+            for vlan in vlans:
+                if self._carries(interface, vlan):
+                    self.vlan_ports[vlan].append(interface)
+
+    def _carries(self, interface, vlan):
+        if not interface.trunk:
+            return interface.vlan == vlan
+        return interface.allowed_vlans is None or vlan in interface.allowed_vlans
+
+    def _ingressVLAN(self, interface, tag):
+        """
+        :param tag: The frame's 802.1Q VLAN ID, or None if it is untagged
+        :returns: The VLAN a frame arriving on interface belongs to, or None if interface won't take it
+        """
+        if interface.trunk:
+            if tag is None:
+                return interface.vlan
+            if interface.allowed_vlans is not None and tag not in interface.allowed_vlans:
+                return None
+            return tag
+        if tag is not None and tag != interface.vlan:
+            return None
+        return interface.vlan
+
+    def _egressTag(self, interface, vlan):
+        """
+        :returns: The tag vlan's frames leave interface with, or None for untagged
+        """
+        return vlan if interface.trunk and vlan != interface.vlan else None
+
+    def _sendOnVLAN(self, data, interface, vlan):
+        """
+        send(), tagged the way interface wants vlan's frames
+        """
+        tag = self._egressTag(interface, vlan)
+        if data.L2.VLAN != tag:
+            data.L2.VLAN = tag # Our own copy of L2, see `Device.send()`
+        self.send(data, interface)
+
+    def stats(self):
+        """
+        :returns: MAC table size and how frames were forwarded, dict
+        """
+        return {
+            "entries":sum(len(table) for table in self.mac_tables.values()),
+            "vlans":len(self.vlan_ports),
+            "hits":self.hits,
+            "misses":self.misses,
+            "floods":self.floods,
+            "aged":self.aged,
+            "evicted":self.evicted,
+            "dropped":self.dropped,
+        }
 
     # TODO: Dynamic ARP inspection for DHCP packets (DHCP snooping)
     def handleData(self, data, oninterface):
+        stp = self.STPHandler
+        if stp and data.L2.EtherType == "STP":
+            for interface, p in stp.handleBPDU(data, oninterface):
+                self.send(p, interface)
+            return
+
+        # Which VLAN is the frame on?
+        vlan = self._ingressVLAN(oninterface, data.L2.VLAN)
+        if vlan is None:
+            self.dropped += 1
+            return
+
+        if stp and oninterface not in stp.forwarding:
+            # Blocked, or still learning the MACs behind it
+            if oninterface in stp.learning:
+                self.learn(data.L2.From, oninterface, vlan)
+            return
+
         # In this case a Switch does not care about which interface it came in on
-        # Before evaluating, add incoming data to switch table
-        self.switch_table[data["L2"]["From"]] = data["L2"]["FromLink"]
+        # Before evaluating, add incoming data to the VLAN's MAC table
+        self.learn(data.L2.From, oninterface, vlan)
 
-        # Switch table lookup
-        if data["L2"]["To"] in self.switch_table:
+        # MAC table lookup
+        entry = self.mac_tables[vlan].get(data.L2.To)
+        if entry is not None:
             if self.DEBUG: 
-                Debug(self.id, "Found", data["L2"]["To"], "in switch table",
+                Debug(self.id, "Found", data.L2.To, "in MAC table",
                     color="green", f=self.__class__.__name__
                 )
-            
-            # Find which interface to send out to, based on the To field
-            for interface in self.interfaces:
-                if self.switch_table[ data["L2"]["To"] ] == interface.linkid:
-                    self.send(data, interface)
-                    break
+            self.hits += 1
+            if stp and entry[0] not in stp.forwarding:
+                return
+            self._sendOnVLAN(data, entry[0], vlan)
 
-        else: # Flood every interface with the request
+        else: # Flood every interface on the VLAN with the request
             if self.DEBUG:
-                Debug(self.id, "flooding interfaces",
+                Debug(self.id, "flooding VLAN", vlan,
                     color="green", f=self.__class__.__name__
                 )
-            for interface in self.interfaces:
-                if interface.linkid != data["L2"]["FromLink"]: # Dont send back on the same link
-                    self.send(data, interface)
+            if data.L2.To != MAC_BROADCAST:
+                self.misses += 1
+            self.floods += 1
+            for interface in self.vlan_ports.get(vlan, self.trunk_ports):
+                if interface is not oninterface: # Dont send back on the same link
+                    if stp and interface not in stp.forwarding:
+                        continue
+                    self._sendOnVLAN(data, interface, vlan)
+
+
+def preResolve(devices):
+    """
+    Seed every neighbor cache straight from the topology, as if everyone had
+    already ARPed for everyone else on their subnet, and have Switches learn
+    every MAC they would have learned along the way. Benchmarks call this so
+    they measure the steady state rather than the first round of flooding.
+
+    Each interface's broadcast domain is found by following links through
+    Switches the way its broadcasts would travel, VLANs included. Switches
+    running Spanning Tree don't learn anything here, since which of their
+    ports end up blocked is only known once the tree converges.
+
+    :param devices: Every Device in the topology, or at least every L3Device
+    :returns: How many neighbor entries were added, int
+    """
+    seeded = 0
+    for device in devices:
+        if not isinstance(device, L3Device):
+            continue
+        for interface in device.interfaces:
+            if not interface.ARPHandler:
+                continue
+
+            # Follow an untagged broadcast sent on interface
+            neighbors = []
+            visited = set() # (Switch, VLAN)
+            stack = [(device, interface, None)]
+            while stack:
+                sender, out, tag = stack.pop()
+                peer = sender.peers.get(out.linkid)
+                if peer is None:
+                    continue
+                ingress = peer.interfaces_by_link[out.linkid]
+                if isinstance(peer, L3Device):
+                    if tag is None and ingress.ARPHandler:
+                        neighbors.append(ingress)
+                elif isinstance(peer, Switch):
+                    vlan = peer._ingressVLAN(ingress, tag)
+                    if vlan is None or (peer, vlan) in visited:
+                        continue
+                    visited.add((peer, vlan))
+                    if not peer.STPHandler:
+                        peer.learn(device.id, ingress, vlan)
+                    for port in peer.vlan_ports.get(vlan, peer.trunk_ports):
+                        if port is not ingress:
+                            stack.append((peer, port, peer._egressTag(port, vlan)))
 
+            # Everyone on the same subnet is a neighbor
+            if not interface.ip:
+                continue
+            handler = interface.ARPHandler
+            with handler.lock:
+                for neighbor in neighbors:
+                    if neighbor.ip and interface.inSubnet(neighbor.ip):
+                        if neighbor.ip not in handler.arp_cache:
+                            seeded += 1
+                        handler.arp_cache.confirm(neighbor.ip, neighbor.ARPHandler.id)
+    return seeded
@@ -1,6 +1,14 @@
 from Device import *
+from FIB import FIB
+from DHCP import LeaseStore
 
 class L3Device(Device):
+
+    # Announce every newly assigned IP with a gratuitous ARP, so neighbors
+    # have it cached before the first packet. Set on the class to cover
+    # devices as they're built, e.g. L3Device.gratuitous_arp = True
+    gratuitous_arp = False
+
     def __init__(self, ID=None, ips=[], connectedTo=[], debug=1): # L3Device
         """
         A Device that operates primarily on L3. This class defines a standard handleData()
@@ -12,15 +20,14 @@ class L3Device(Device):
         """
         if isinstance(ips, str): ips = [ips]
         
-        self.ips = []               # 192.168.0.1
-        self.nmasks = []            # 255.255.255.0
-        self.cidr_nmasks = []       # 24
+        self.ips = []               # 192.168.0.1, IP
+        self.nmasks = []            # 255.255.255.0, IP
+        self.cidr_nmasks = []       # 24, int
         for item in ips:
             l = item.split("/")
-            self.ips.append(l[0])
-            self.cidr_nmasks.append(l[1])
-            netmask = '.'.join([str((0xffffffff << (32 - int(l[1])) >> i) & 0xff) for i in [24, 16, 8, 0]])
-            self.nmasks.append(netmask)
+            self.ips.append(IP(l[0]))
+            self.cidr_nmasks.append(int(l[1]))
+            self.nmasks.append(prefixToMask(l[1]))
         super().__init__(connectedTo, debug, ID) # L3Device
         
         
@@ -29,60 +36,69 @@ class L3Device(Device):
         Handle data as a L3 device would. All this does is read the L2/L3 information
         and forward the data to the correct handler, depending on port / ethertype / etc
         
-        :param data: See `Headers.makePacket()`, dict
+        :param data: See `Headers.makePacket()`, Packet
         """
         
         if not oninterface:
             oninterface = self.interfaces[0]
 
-        if data["L2"]["To"] not in [self.id, MAC_BROADCAST]: # L2 destination check
+        if data.L2.To not in [self.id, MAC_BROADCAST]: # L2 destination check
             print(self.id, "got L2 frame not for me, ignoring")
             return
 
-        if data["L2"]["EtherType"] == "ARP": # L2 multiplexing
+        if data.L2.EtherType == "ARP": # L2 multiplexing
             self.handleARP(data, oninterface)
 
         
         # ===================================================
 
-        elif data["L2"]["EtherType"] == "IPv4": # L3 multiplexing
+        elif data.L2.EtherType == "IPv4": # L3 multiplexing
             
-            #if data["L3"]["DIP"] not in [self.getIP(data["L2"]["To"]), IP_BROADCAST]:
-            if data["L3"]["DIP"] not in [oninterface.ip, IP_BROADCAST]:
+            #if data.L3.DIP not in [self.getIP(data.L2.To), IP_BROADCAST]:
+            if data.L3.DIP not in [oninterface.ip, IP_BROADCAST]:
 
-                print(self.id, "ignoring data from", data["L3"]["SIP"])
+                print(self.id, "ignoring data from", data.L3.SIP)
                 return
             
             #https://www.iana.org/assignments/protocol-numbers/protocol-numbers.xhtml
-            if data["L3"]["Protocol"] == "UDP": # 17
+            if data.L3.Protocol == "UDP": # 17
 
                 # Handle UDP protocols
 
                 # DHCP
-                if data["L4"]["DPort"] in [67, 68]: # L4 multiplexing
+                if data.L4.DPort in [67, 68]: # L4 multiplexing
                     self.handleDHCP(data, oninterface)
                 # elif...
                 # elif...
                 # elif...
                 else:
                     if self.DEBUG: 
-                        Debug(self.id, data["L4"]["DPort"], "not configured!", 
+                        Debug(self.id, data.L4.DPort, "not configured!", 
                             color="red", f=self.__class__.__name__
                         )
             
-            elif data["L3"]["Protocol"] == "ICMP": # 1
+            elif data.L3.Protocol == "ICMP": # 1
                 # await self.handleICMP(data, oninterface)
                 self.handleICMP(data, oninterface)
         else:
             if self.DEBUG: 
-                Debug(self.id, "ignoring", data["L2"]["From"], data["L2"]["EtherType"],
+                Debug(self.id, "ignoring", data.L2.From, data.L2.EtherType,
                     color="yellow", f=self.__class__.__name__
                 )
         
         return
     
     def _checkTimeouts(self):
-        return
+        self._checkNeighbors()
+
+    def _checkNeighbors(self):
+        """
+        Age every interface's ARP cache, and reprobe STALE neighbors still in use.
+        Every L3 device's _checkTimeouts() should call this
+        """
+        for interface in self.interfaces:
+            for p in interface.ARPHandler.expire():
+                self.send(p, interface)
 
     def sendICMP(self, targetIP, oninterface=None, timeout=5):
         """
@@ -92,9 +108,64 @@ class L3Device(Device):
 
         If you want finer control over the timeout, ARP the targetIP before
         calling this function.
+
+        :returns: Whether a reply came back, bool. A coroutine on an AsyncRuntime
         """
+        if self.aio:
+            return self.asendICMP(targetIP, oninterface, timeout)
+        targetIP = IP(targetIP)
+
         if not oninterface:
             oninterface = self.interfaces[0]
+        nextHopIP = self._nextHopICMP(targetIP, oninterface)
+
+        # Is the nexthop in my arp cache?
+        targetID = oninterface.ARPHandler.lookup(nextHopIP)
+        if not targetID: # ARP it
+            if self.DEBUG:
+                Debug(self.id, nextHopIP, "not in local ARP cache, sending ARP",
+                    color="yellow", f=self.__class__.__name__
+                )
+            # Block and wait for the ARP to finish
+            targetID = self.sendARP(nextHopIP, oninterface)
+
+        identifier = self._sendEcho(targetIP, targetID, oninterface)
+        if identifier is None:
+            return False
+
+        # Internally:
+        # Wait for the handler to resolve the echo's Future with the reply
+        replied = timeout and self._waitFor(oninterface.ICMPHandler.icmp_table[identifier], timeout)
+        return self._finishICMP(targetIP, identifier, oninterface, replied)
+
+    async def asendICMP(self, targetIP, oninterface=None, timeout=5):
+        """
+        sendICMP(), awaitable. See `L3Device.sendICMP()`
+        """
+        targetIP = IP(targetIP)
+        if not oninterface:
+            oninterface = self.interfaces[0]
+        nextHopIP = self._nextHopICMP(targetIP, oninterface)
+
+        targetID = oninterface.ARPHandler.lookup(nextHopIP)
+        if not targetID:
+            if self.DEBUG:
+                Debug(self.id, nextHopIP, "not in local ARP cache, sending ARP",
+                    color="yellow", f=self.__class__.__name__
+                )
+            targetID = await self.asendARP(nextHopIP, oninterface)
+
+        identifier = self._sendEcho(targetIP, targetID, oninterface)
+        if identifier is None:
+            return False
+
+        replied = timeout and await self._awaitFor(oninterface.ICMPHandler.icmp_table[identifier], timeout)
+        return self._finishICMP(targetIP, identifier, oninterface, replied)
+
+    def _nextHopICMP(self, targetIP, oninterface):
+        """
+        :returns: The IP to ARP for to reach targetIP, str
+        """
         if not oninterface.gateway:
             raise ValueError(self.id + " has no gateway; configure or use DHCP")
         if not self.getIP():
@@ -109,51 +180,36 @@ class L3Device(Device):
         # - If not, grab the gateway ID
         
         # Is targetIP in my subnet?
-        if ipaddress.ip_address(targetIP) in ipaddress.IPv4Network(oninterface.ip + "/" + oninterface.nmask, strict=False):
-            nextHopIP = targetIP
+        if oninterface.inSubnet(targetIP):
+            return targetIP
         else: # It's not, so use the gateway
-            nextHopIP = oninterface.gateway.split("/")[0]
-        
-        # Is the nexthop in my arp cache?
-        if nextHopIP in oninterface.ARPHandler.arp_cache:
-            targetID = oninterface.ARPHandler.arp_cache[nextHopIP]
-        else: # ARP it
-            if self.DEBUG:
-                Debug(self.id, nextHopIP, "not in local ARP cache, sending ARP",
-                    color="yellow", f=self.__class__.__name__
-                )
-            # Have a thread manage the ARP connection independent from this thread
-            targetID = [None]
-            x = threading.Thread(target=self.sendARP, args=(nextHopIP, oninterface), kwargs={"result":targetID})
-            x.start()
-            x.join() # Block and wait for the thread to finish
-            targetID = targetID[0]
+            return oninterface.gateway
 
+    def _sendEcho(self, targetIP, targetID, oninterface):
+        """
+        :returns: The identifier of the echo request sent, or None on failed ARP
+        """
         if not targetID: # On failed ARP
-            Debug(self.id + " ICMP Failed - could not reach " + targetIP,
+            Debug(self.id + " ICMP Failed - could not reach " + str(targetIP),
                 color="red", f=self.__class__.__name__
             )
-            return False
+            return None
         
         # Send the ICMP request
         p = oninterface.ICMPHandler.sendICMP(targetIP, targetID)
         self.send(p, oninterface)
-         
-        # Internally:
-        # Check whether or not the target ip has been populated with an ID (MAC)
-        now = time.time()
-        if timeout:
-            while (time.time() - now) < timeout:
-                if oninterface.ICMPHandler.icmp_table[p["L3"]["Data"]["identifier"]]:
-                    # ICMP Response received!
-                    del oninterface.ICMPHandler.icmp_table[p["L3"]["Data"]["identifier"]]
-                    return True
+        return p["L3"]["Data"]["identifier"]
+
+    def _finishICMP(self, targetIP, identifier, oninterface, replied):
+        oninterface.ICMPHandler.icmp_table.pop(identifier, None)
+        if replied:
+            # ICMP Response received!
+            return True
         
         if self.DEBUG:
             Debug(self.id, "ICMP timeout for", targetIP,
                 color="red", f=self.__class__.__name__
             )
-        del oninterface.ICMPHandler.icmp_table[p["L3"]["Data"]["identifier"]]
         return False
         
     def handleICMP(self, data, oninterface=None):
@@ -176,21 +232,19 @@ class L3Device(Device):
         """
         for device in connectedTo:
             link = Link([self, device])
-            my_interface = Interface(link, "0.0.0.0", self.id)
-            your_interface = Interface(link, "0.0.0.0", device.id)
+            my_interface = Interface(link, IP_ANY, self.id)
+            your_interface = Interface(link, IP_ANY, device.id)
             
-            my_interface.DHCPClient = DHCPClientHandler(self.id, link.id, debug=self.DEBUG)
-            my_interface.ICMPHandler = ICMPHandler(self.id, link.id, "0.0.0.0", None, debug=self.DEBUG)
-            my_interface.ARPHandler = ARPHandler(self.id, link.id, "0.0.0.0", debug=self.DEBUG)
-
-            if not my_interface in self.interfaces:
-                self.interfaces.append(my_interface)
-            if not your_interface in device.interfaces:
-                device.interfaces.append(your_interface)
+            my_interface.DHCPClient = DHCPClientHandler(self.id, link.id, debug=self.DEBUG, clock=self.clock)
+            my_interface.ICMPHandler = ICMPHandler(self.id, link.id, IP_ANY, None, debug=self.DEBUG)
+            my_interface.ARPHandler = ARPHandler(self.id, link.id, IP_ANY, debug=self.DEBUG, clock=self.clock)
+
+            self.addInterface(my_interface)
+            if device.addInterface(your_interface):
                 if isinstance(device, L3Device):
-                    your_interface.DHCPClient = DHCPClientHandler(device.id, link.id, debug=device.DEBUG)
-                    your_interface.ICMPHandler = ICMPHandler(device.id, link.id, "0.0.0.0", None, debug=device.DEBUG)
-                    your_interface.ARPHandler = ARPHandler(device.id, link.id, "0.0.0.0", debug=device.DEBUG)
+                    your_interface.DHCPClient = DHCPClientHandler(device.id, link.id, debug=device.DEBUG, clock=device.clock)
+                    your_interface.ICMPHandler = ICMPHandler(device.id, link.id, IP_ANY, None, debug=device.DEBUG)
+                    your_interface.ARPHandler = ARPHandler(device.id, link.id, IP_ANY, debug=device.DEBUG, clock=device.clock)
                     device._associateIPsToInterfaces() # Possibly in need of a lock
 
         self._associateIPsToInterfaces()
@@ -201,6 +255,7 @@ class L3Device(Device):
         If there are more interfaces than IPs, each interface gets 0.0.0.0
         """
         for i in range(len(self.interfaces)):
+            old = self.interfaces[i].ip
             try:
                 self.interfaces[i].ip = self.ips[i]
                 self.interfaces[i].nmask = self.nmasks[i]
@@ -208,13 +263,22 @@ class L3Device(Device):
                 self.interfaces[i].ICMPHandler.nmask = self.nmasks[i]
                 self.interfaces[i].ARPHandler.ip = self.ips[i]
             except IndexError:
-                self.interfaces[i].ip = "0.0.0.0"
+                self.interfaces[i].ip = IP_ANY
                 self.interfaces[i].nmask = None
-                self.interfaces[i].ICMPHandler.ip = "0.0.0.0"
+                self.interfaces[i].ICMPHandler.ip = IP_ANY
                 self.interfaces[i].ICMPHandler.nmask = None
-                self.interfaces[i].ARPHandler.ip = "0.0.0.0"
-                self.ips.append("0.0.0.0")
+                self.interfaces[i].ARPHandler.ip = IP_ANY
+                self.ips.append(IP_ANY)
                 self.nmasks.append(None)
+            if self.interfaces[i].ip != old:
+                self._announce(self.interfaces[i])
+
+    def _announce(self, interface):
+        """
+        Send a gratuitous ARP for interface's IP, if enabled, see gratuitous_arp
+        """
+        if self.gratuitous_arp and interface.ip:
+            self.send(interface.ARPHandler.announce(), interface)
 
     def getIP(self, ID=None):
         """
@@ -230,19 +294,17 @@ class L3Device(Device):
 
         # User provided an interface ID
         if "_I_" in ID:
-            for interface in self.interfaces:
-                if ID == interface.id:
-                    return interface.ip
-            else:
+            interface = self.interfaces_by_id.get(ID)
+            if interface is None:
                 raise ValueError(self.id + " getIP did not find an ip for interface " + ID)
+            return interface.ip
         
         # User provided a link ID
         elif "[L]" in ID:
-            for interface in self.interfaces:
-                if interface.linkid == ID:
-                    return interface.ip
-            else:
+            interface = self.interfaces_by_link.get(ID)
+            if interface is None:
                 raise ValueError(self.id + " getIP did not find an ip for link " + ID)
+            return interface.ip
 
         else:
             raise ValueError(self.id + " Can only pass in LinkIDs or interfaceIDs to getIP, not " + ID)
@@ -252,67 +314,90 @@ class L3Device(Device):
         Set the IP of an interface. By default, set the first link's IP, good for
         single interface devices. Also update the internal handler IPs of the interface.
         
-        :param val: The IP to set
+        :param val: The IP to set, see `Headers.IP`
         :param linkID: optional, the ID of the desired link
         """
         
         assert isinstance(interface, Interface)
-        assert isinstance(val, str)
+        val = IP(val)
         
         if not interface:
             interface = self.interfaces[0]
         
+        old = interface.ip
         interface.ip = val
         interface.ICMPHandler.ip = val
         interface.ARPHandler.ip = val
         interface.DHCPClient.ip = val
+        if interface.ip != old: # Like a new DHCP lease
+            self._announce(interface)
 
 # TODO: Associate DHCP info (lease, mask, gateway, etc) per interface instead of per device
 class Host(L3Device):
     def __init__(self, ips=[], connectedTo=[], debug=1):
         self.id = "-H-" + str(random.randint(10000, 99999999))
         super().__init__(self.id, ips, connectedTo, debug)
-        self.lthread.start()
+        self.start()
 
     def _checkTimeouts(self):
-
-        # DHCP
-        try: # TODO Clean up try
-            for interface in self.interfaces:
-                if interface.DHCPClient.lease[0] >= 0:
-                    interface.DHCPClient.lease_left = (interface.DHCPClient.lease[0] + interface.DHCPClient.lease[1]) - int(time.time())
-                    if self.DEBUG == 2: 
-                        Debug(self.id, "===", interface.DHCPClient.lease_left, "/", interface.DHCPClient.lease[0], 
-                            f=self.__class__.__name__
-                        )
-                    if interface.DHCPClient.lease_left <= 0.5 * interface.DHCPClient.lease[0] and interface.DHCPClient.DHCP_FLAG != 1:
-                        if self.DEBUG: 
-                            Debug(self.id, "renewing ip", self.getIP(), color="green", 
-                                f=self.__class__.__name__
-                            )
-                        interface.DHCPClient.DHCP_FLAG = 1
-                        self.sendDHCP("Renew")
-        except: pass
+        self._checkNeighbors()
+
+        # DHCP: retransmissions, renewing, rebinding, see `DHCPClientHandler.tick()`
+        for interface in self.interfaces:
+            client = interface.DHCPClient
+            for p in client.tick():
+                self.send(p, interface)
+            if client.lapsed:
+                # Nobody renewed the lease in time, so the address isn't ours anymore
+                client.lapsed = False
+                if self.DEBUG:
+                    Debug(self.id, "lost ip", interface.ip, color="red",
+                        f=self.__class__.__name__
+                    )
+                self.setIP(IP_ANY, interface)
         return 
                 
     ## Send D(iscover) or R(equest)
     def sendDHCP(self, context, oninterface=None, timeout=5):
+        """
+        :param context: "Init", "Renew" or "Rebind", str
+        :param timeout: Seconds to wait for the ACK. 0 sends without waiting; the
+            transaction's Future is then in `DHCPClientHandler.waiting`
+        :returns: Whether an ACK came back, bool. A coroutine on an AsyncRuntime
+        """
+        if self.aio:
+            return self.asendDHCP(context, oninterface, timeout)
+
+        oninterface, future = self._startDHCP(context, oninterface)
+        if timeout and self._waitFor(future, timeout):
+            # IP received / renewed!
+            return True
+        return self._timeoutDHCP()
+
+    async def asendDHCP(self, context, oninterface=None, timeout=5):
+        """
+        sendDHCP(), awaitable. See `Host.sendDHCP()`
+        """
+        oninterface, future = self._startDHCP(context, oninterface)
+        if timeout and await self._awaitFor(future, timeout):
+            return True
+        return self._timeoutDHCP()
+
+    def _startDHCP(self, context, oninterface):
         if not oninterface:
             oninterface = self.interfaces[0]
             
         # Internally:
-        # Have a flag set for what stage the DHCP client is on, see DHCPClientHandler.DHCP_FLAG
+        # Have a flag set for what stage the DHCP client is on, see DHCPClientHandler.DHCP_FLAG,
+        # and a Future for the transaction that handleDHCP() resolves on ACK
+        # Retransmission is up to the client from here on, see _checkTimeouts()
         p = oninterface.DHCPClient.sendDHCP(context)
-        self.send(p, oninterface)
-
-        now = time.time()
-        if timeout:
-            while (time.time() - now) < timeout:
-                if oninterface.DHCPClient.DHCP_FLAG == 2:
-                    # IP received / renewed!
-                    return True
-
+        future = oninterface.DHCPClient.waiting[oninterface.DHCPClient.current_tx]
+        if p: # Not held back, see DHCPClientHandler.init_delay
+            self.send(p, oninterface)
+        return oninterface, future
 
+    def _timeoutDHCP(self):
         if self.DEBUG: 
             Debug(self.id, "DHCP timeout",
                 color="red", f=self.__class__.__name__
@@ -322,30 +407,35 @@ class Host(L3Device):
     def handleDHCP(self, data, oninterface):
         # Get interface for the incoming data
         
-        if data["L3"]["Data"]["xid"] == oninterface.DHCPClient.current_tx:
+        if data.L3.Data.xid == oninterface.DHCPClient.current_tx:
             p = oninterface.DHCPClient.handleDHCP(data, oninterface)
             # On DORA ACK, no packet is returned to send out
             if p: 
                 self.send(p, oninterface)
-            else:
+            elif data.L3.Data.options[53] == 5:
                 # Extract all of the goodies
                 oninterface.nmask = "255.255.255.255"
                 oninterface.gateway = ""
 
-                if 1 in data["L3"]["Data"]["options"]:
-                    oninterface.nmask = data["L3"]["Data"]["options"][1]
-                if 3 in data["L3"]["Data"]["options"]:
-                    oninterface.gateway = data["L3"]["Data"]["options"][3]
+                if 1 in data.L3.Data.options:
+                    oninterface.nmask = data.L3.Data.options[1]
+                if 3 in data.L3.Data.options:
+                    oninterface.gateway = data.L3.Data.options[3]
 
-                self.setIP(data["L3"]["Data"]["yiaddr"], oninterface)
+                self.setIP(data.L3.Data.yiaddr, oninterface)
 
-                oninterface.DHCPClient.lease = (data["L3"]["Data"]["options"][51], int(time.time()) )
-                oninterface.DHCPClient.lease_left = (oninterface.DHCPClient.lease[0] + oninterface.DHCPClient.lease[1]) - int(time.time())
+                oninterface.DHCPClient.lease = (data.L3.Data.options[51], int(self.clock()) )
+                oninterface.DHCPClient.lease_left = (oninterface.DHCPClient.lease[0] + oninterface.DHCPClient.lease[1]) - int(self.clock())
                 oninterface.DHCPClient.DHCP_FLAG = 2
                 oninterface.DHCPClient.current_xid = -1
+
+                # Wake whoever is waiting in sendDHCP()
+                future = oninterface.DHCPClient.waiting.pop(data.L3.Data.xid, None)
+                if future and not future.done():
+                    future.set_result(data.L3.Data.yiaddr)
         else:
             if self.DEBUG: 
-                Debug(self.id, "ignoring DHCP from", data["L2"]["From"], 
+                Debug(self.id, "ignoring DHCP from", data.L2.From, 
                     color="yellow", f=self.__class__.__name__
                 )
 
@@ -357,38 +447,49 @@ class Router(L3Device):
         
         assert len(ips) == len(connectedTo)
 
-        # Check to see if targetIP is in my subnet
-        #if ipaddress.ip_address(targetIP) in ipaddress.IPv4Network(oninterface.ip + "/" + oninterface.nmask, strict=False):
-        
+        # Frames waiting on ARP for their next hop, see _queueForARP()
+        # (Interface, nextHopIP): {"frames": deque of Packets, "expires": time}
+        # Queued, flushed and expired only by handlers and _checkTimeouts(), which
+        # never run at the same time, see Device.listen()
+        self.arp_pending = {}
+        self.arp_queue_limit = 32   # Frames held per next hop; any more are dropped
+        self.arp_queue_timeout = 3  # Seconds to wait for a reply before dropping them all
+
+        # DHCP relay agent, see setDHCPRelay(). Interface: DHCP server IP
+        self.dhcp_relays = {}
+        self.relayed = 0
+
         # Establish directly connected networks 
+        # routing_table lists every route for display; lookups go through
+        # self.fib, which holds the same routes by prefix, see `FIB.FIB`
         self.routing_table = []
+        self.fib = FIB()
         for index, item in enumerate(ips):
-            network_obj = ipaddress.IPv4Network(item, strict=False)
-            # no.exploded = "x.x.x.0/y"
-            # no.network_address.exploded = "x.x.x.0"
-            # no.prefixlen = 24
-            # no.netmask.exploded = "255.255.255.0"
-            
             # Could be an address but we're making it a network
-            dest_addr = ipaddress.ip_network(self.ips[index] + "/32")
-            network_addr = ipaddress.ip_network(self.ips[index] + "/" + self.cidr_nmasks[index], strict=False)
-
             dL = {
                 "type":"L",
-                "dst":dest_addr,
+                "dst":self.ips[index],
+                "mask":prefixToMask(32),
+                "prefixlen":32,
                 "outgoing_interface":self.interfaces[index]
             }
 
             dC = {
                 "type":"C",
-                "dst":network_addr,
+                "dst":removeHostBits(self.ips[index], self.nmasks[index]),
+                "mask":self.nmasks[index],
+                "prefixlen":self.cidr_nmasks[index],
                 "outgoing_interface":self.interfaces[index]
             }
 
-            self.routing_table.append(dL)
-            self.routing_table.append(dC)
+            self._installRoute(dL)
+            self._installRoute(dC)
+
+        self.start()
 
-        self.lthread.start()
+    def _installRoute(self, route):
+        self.routing_table.append(route)
+        self.fib.insert(route["dst"], route["prefixlen"], route)
     
     def addRoute(self, route):
         # For now we only do S(tatic) routes
@@ -399,16 +500,34 @@ class Router(L3Device):
         assert isinstance(route[2], str)
         assert isinstance(route[3], Interface)
 
+        ip, mask = splitAddr(route[1])
         d = {
             "type":route[0],
-            "dst":ipaddress.ip_network(route[1], strict=False),
-            "nexthop":ipaddress.ip_address(route[2].split("/")[0]),
+            "dst":removeHostBits(ip, mask),
+            "mask":mask,
+            "prefixlen":maskToPrefix(mask),
+            "nexthop":IP(route[2]),
             "outgoing_interface":route[3]
         }   
         
-        self.routing_table.append(d)
+        self._installRoute(d)
 
 
+    def setDHCPRelay(self, interface, server):
+        """
+        Relay DHCP clients' broadcasts on interface to server, so one DHCP
+        server can hand out addresses on many routed subnets (an "ip helper-address").
+        The server picks the subnet by the giaddr we fill in, see `DHCPServerHandler.addScope()`
+
+        :param interface: One of our interfaces, Interface
+        :param server: The DHCP server's IP, see `Headers.IP`. None stops relaying
+        """
+        assert interface in self.interfaces
+        if server is None:
+            self.dhcp_relays.pop(interface, None)
+        else:
+            self.dhcp_relays[interface] = IP(server)
+
     def handleData(self, data, oninterface):
         """
         A router will directly interpret L2 data addressed to it, and will route
@@ -419,7 +538,7 @@ class Router(L3Device):
         https://docs.oracle.com/cd/E36784_01/html/E37474/ipplan-43.html
         https://learningnetwork.cisco.com/s/question/0D53i00000Ksx63CAB/what-is-a-local-route
 
-        :param data: See `Headers.makePacket()`, dict
+        :param data: See `Headers.makePacket()`, Packet
         """
         if self.DEBUG == 2:
             Debug(self.id, "got data", data,
@@ -429,123 +548,251 @@ class Router(L3Device):
         if not oninterface:
             oninterface = self.interfaces[0]
 
-        if data["L2"]["To"] not in [self.id, MAC_BROADCAST]: # L2 destination check
+        if data.L2.To not in [self.id, MAC_BROADCAST]: # L2 destination check
             print(self.id, "got L2 frame not for me, ignoring")
             return
 
-        if data["L2"]["EtherType"] == "ARP": # L2 multiplexing
+        if data.L2.EtherType == "ARP": # L2 multiplexing
             self.handleARP(data, oninterface)
         
         # ===================================================
             
         
 
-        elif data["L2"]["EtherType"] == "IPv4": # L3 multiplexing
+        elif data.L2.EtherType == "IPv4": # L3 multiplexing
             """
-            - Sort the table by prefixlength
-            - To match an incoming ip on the routing table:
-            - For through the sorted routing table and find the first match
+            - Find the longest prefix match for DIP in the FIB
                 - if match is on a directly connected network (C)
                     - check if in arp table, arp target, send to target
                 - elif match is on my IP (L)
-                    - super().handleData()
+                    - handle it myself
                 - else
                     if match.nexthop in ARP cache, etc. etc. etc
                     else: ARP first then send
-                - else?
-                    drop packet
+            - No match? drop packet
             """
+            if data.L3.DIP == IP_BROADCAST:
+                # Limited broadcasts never leave their segment; the only one we act on is DHCP
+                if data.L3.Protocol == "UDP" and data.L4.DPort == 67:
+                    self.handleDHCP(data, oninterface)
+                return
 
-            self.routing_table = sorted(self.routing_table, key=lambda x: ipaddress.ip_network(x["dst"], strict=False).prefixlen)
-            for route in self.routing_table:
-                dip = ipaddress.ip_address(data["L3"]["DIP"])
-                if dip in route["dst"]: # Found a match
+            return self._route(data, oninterface)
 
-                    if self.DEBUG == 2:
-                        Debug(self.id, "found a matching path for", dip, "on route", route,
-                            color = "blue", f=self.__class__.__name__
-                        )
-                    
-                    # ARP nexthop or dst, depending on route type
-                    if route["type"] == "C": 
-                        nextHopIP = data["L3"]["DIP"]
-                    elif route["type"] == "S":
-                        nextHopIP = route["nexthop"].exploded
-                    elif route["type"] == "L":
-                        # Addressed to me directly
-                        #super().handleData()
-                        pass
-
-                    # check if nextHopIP in arp cache
-                    if nextHopIP in route["outgoing_interface"].ARPHandler.arp_cache:
-                        nextHopID = route["outgoing_interface"].ARPHandler.arp_cache[nextHopIP]
-                    else: # ARP it
-                        nextHopID = [None]
-                        x = threading.Thread(target=self.sendARP, args=(nextHopIP, route["outgoing_interface"]), kwargs={"result":nextHopID})
-                        x.start()
-                        x.join() # Block and wait for the thread to finish
-                        nextHopID = nextHopID[0]
-                     
-                    if not nextHopID:
-                        if self.DEBUG:
-                            Debug(self.id, "ARP failed to find nexthop ID, dropping packet",
-                                color = "red", f=self.__class__.__name__
-                           )
-                        
-                    # Now with the nexthop's IP and ID, send data to nexthop
-                    # But first reconstruct the L2 frame
-                    if self.DEBUG:
-                        Debug(self.id, "Forwarding packet to", nextHopID, "@", nextHopIP,
-                            color = "green", f=self.__class__.__name__
-                       )
-
-                    data["L2"]["From"] = self.id
-                    data["L2"]["To"] = nextHopID
-
-
-                    self.send(data, route["outgoing_interface"])
-                    return True
-
-            else:
-                Debug(self.id, "Failed to find a match for packet, dropping",
-                    color="yellow", f=self.__class__.__name__    
+    def _route(self, data, oninterface):
+        """
+        Forward an IP packet by longest prefix match on its DIP, or handle it
+        if it's addressed to us
+
+        :returns: Whether the packet was forwarded or queued, bool. None if it was dropped or for us
+        """
+        route = self.fib.lookup(data.L3.DIP)
+        if route is None:
+            Debug(self.id, "Failed to find a match for packet, dropping",
+                color="yellow", f=self.__class__.__name__    
+            )
+            return
+
+        if self.DEBUG == 2:
+            Debug(self.id, "found a matching path for", data.L3.DIP, "on route", route,
+                color = "blue", f=self.__class__.__name__
+            )
+        
+        # ARP nexthop or dst, depending on route type
+        if route["type"] == "C": 
+            nextHopIP = data.L3.DIP
+        elif route["type"] == "S":
+            nextHopIP = route["nexthop"]
+        elif route["type"] == "L":
+            # Addressed to me directly; answer out of the interface it came in on
+            if data.L3.Protocol == "ICMP":
+                self.handleICMP(data, oninterface)
+            elif data.L3.Protocol == "UDP" and data.L4.DPort == 67:
+                self.handleDHCP(data, oninterface) # A server's reply to a relayed request
+            return
+
+        # check if nextHopIP in arp cache (None while a request is out)
+        nextHopID = route["outgoing_interface"].ARPHandler.lookup(nextHopIP)
+        if not nextHopID:
+            # Don't wait on it; park the frame until the reply comes in
+            return self._queueForARP(data, nextHopIP, route["outgoing_interface"])
+
+        return self._forward(data, nextHopIP, nextHopID, route["outgoing_interface"])
+
+    def handleDHCP(self, data, oninterface):
+        """
+        Relay DHCP between clients and servers, RFC2131 S4.1 and RFC1542 S4.
+        Clients' requests go to the server set for their interface with
+        giaddr filled in; the server's replies come back to giaddr and go out
+        to the client on that interface.
+        """
+        request = data.L3.Data
+        if request.op == 1: # Client to server
+            server = self.dhcp_relays.get(oninterface)
+            if server is None or request.hops >= 16:
+                return
+            DHCP = request.copy() # Everyone else on the segment got the same message
+            if not DHCP.giaddr:
+                DHCP.giaddr = oninterface.ip
+            DHCP.hops += 1
+            p = makePacket(
+                makePacket_L2("IPv4", self.id, self.id),
+                makePacket_L3(oninterface.ip, server, DHCP, "UDP"),
+                makePacket_L4_UDP(67, 67)
+            )
+            if self.DEBUG:
+                Debug(self.id, "relaying DHCP from", request.chaddr, "to", server,
+                    color="green", f=self.__class__.__name__
+                )
+            self.relayed += 1
+            self._route(p, oninterface)
+
+        elif request.op == 2: # Server to client
+            route = self.fib.lookup(request.giaddr)
+            if route is None or route["type"] != "L":
+                return # Not ours
+            interface = route["outgoing_interface"]
+            if interface not in self.dhcp_relays:
+                return
+            p = makePacket(
+                makePacket_L2("IPv4", self.id, MAC_BROADCAST if request.flags else request.chaddr),
+                makePacket_L3(interface.ip, IP_BROADCAST, request, "UDP"),
+                makePacket_L4_UDP(67, 68)
+            )
+            self.relayed += 1
+            self.send(p, interface)
+
+    def handleARP(self, data, oninterface=None):
+        """
+        Handle ARP as any device would, then send on whatever was waiting for the reply
+        """
+        if not oninterface:
+            oninterface = self.interfaces[0]
+        super().handleARP(data, oninterface)
+
+        # A reply, or a gratuitous ARP, may resolve a next hop frames are queued on
+        key = (oninterface, data.L2.Data.SPA)
+        if key in self.arp_pending:
+            nextHopID = oninterface.ARPHandler.lookup(data.L2.Data.SPA)
+            if nextHopID:
+                for frame in self.arp_pending.pop(key)["frames"]:
+                    self._forward(frame, data.L2.Data.SPA, nextHopID, oninterface)
+
+    def _queueForARP(self, data, nextHopIP, outgoing_interface):
+        """
+        Hold a frame until nextHopIP is resolved. The first frame for a next
+        hop sends the ARP request; later ones just join the queue.
+
+        :returns: Whether the frame was queued, bool
+        """
+        key = (outgoing_interface, nextHopIP)
+        pending = self.arp_pending.get(key)
+        if pending is None:
+            pending = self.arp_pending[key] = {
+                "frames": deque(),
+                "expires": self.clock() + self.arp_queue_timeout
+            }
+            p = outgoing_interface.ARPHandler.sendARP(nextHopIP)
+            if p: self.send(p, outgoing_interface) # Else someone's already asking
+
+        if len(pending["frames"]) >= self.arp_queue_limit:
+            if self.DEBUG:
+                Debug(self.id, "ARP queue for", nextHopIP, "is full, dropping packet",
+                    color="red", f=self.__class__.__name__
                 )
-                        
+            return False
+        pending["frames"].append(data)
+        return True
 
-            pass           
+    def _checkTimeouts(self):
+        self._checkNeighbors()
+
+        # Give up on next hops that never answered, and the frames waiting on them
+        now = self.clock()
+        for key, pending in list(self.arp_pending.items()):
+            if pending["expires"] > now:
+                continue
+            outgoing_interface, nextHopIP = key
+            self.arp_pending.pop(key, None)
+            outgoing_interface.ARPHandler.abandon(nextHopIP)
+            if self.DEBUG:
+                Debug(self.id, "ARP timeout for", nextHopIP, "- dropping", len(pending["frames"]), "packets",
+                    color="red", f=self.__class__.__name__
+                )           
+
+    def _forward(self, data, nextHopIP, nextHopID, outgoing_interface):
+        """
+        Rewrite the L2 frame for the next hop and send it on its way
+
+        :returns: False if the next hop couldn't be resolved, bool
+        """
+        if not nextHopID:
+            if self.DEBUG:
+                Debug(self.id, "ARP failed to find nexthop ID, dropping packet",
+                    color = "red", f=self.__class__.__name__
+               )
+            return False
+            
+        # Now with the nexthop's IP and ID, send data to nexthop
+        # But first reconstruct the L2 frame
+        if self.DEBUG:
+            Debug(self.id, "Forwarding packet to", nextHopID, "@", nextHopIP,
+                color = "green", f=self.__class__.__name__
+           )
+
+        data.L2.From = self.id
+        data.L2.To = nextHopID
+
+        self.send(data, outgoing_interface)
+        return True
 
 class DHCPServer(L3Device):
-    def __init__(self, ips, gateway, connectedTo=[], debug=1): # DHCPServer
+    def __init__(self, ips, gateway, connectedTo=[], debug=1, lease_file=None): # DHCPServer
+        """
+        Hands out addresses on the subnet of each of its IPs, one scope per
+        interface, and on any subnets added with `DHCPServerHandler.addScope()`
+
+        :param ips: "x.x.x.x/n", or a list of them, one per interface
+        :param gateway: The router handed out on ips[0]'s subnet, "x.x.x.x/n". Or a list, one per IP
+        :param lease_file: Keep leases in this file and pick them up again from it on start, see `DHCP.LeaseStore`
+        """
         self.id = "=DHCP=" + str(random.randint(10000, 99999999))
 
         # TODO: Move stuff to Interface class, including DHCP Server info?
-        self.gateway = gateway
+        gateways = [gateway] if isinstance(gateway, str) else list(gateway)
+        self.gateway = gateways[0]
 
         super().__init__(self.id, ips, connectedTo, debug) # DHCPServer
 
-        self.DHCPServerHandler = DHCPServerHandler(self.ips[0], self.nmasks[0], self.id, self.gateway, debug, self.interfaces)
-        self.lthread.start()
+        self.DHCPServerHandler = DHCPServerHandler(self.ips[0], self.nmasks[0], self.id, self.gateway, debug, self.interfaces, clock=self.clock)
+        for ip, gateway in zip(self.ips[1:], gateways[1:]):
+            self.DHCPServerHandler.addScope(gateway, ip)
+        if lease_file:
+            self.DHCPServerHandler.restore(LeaseStore(lease_file))
+        self.start()
     def _checkTimeouts(self):
-        # DHCP lease expiry check
-        del_ips = []
-        for k, v in self.DHCPServerHandler.leased_ips.items():
-            time_left = (v[2] + v[1]) - int(time.time())
-            if time_left <= 0:
-                # For now, just delete the entry. TODO: Clean up entry deletion procedure per RFC
-                # Mark the entry as deleted
-                del_ips.append(k)
-        return 
+        self._checkNeighbors()
+        self.DHCPServerHandler.expireOffers()
+        self.DHCPServerHandler.expireLeases()
+        if self.DHCPServerHandler.store:
+            self.DHCPServerHandler.store.flush(self.DHCPServerHandler.leased_ips)
 
-        # Then, actually delete it
-        if del_ips:
-            for key in del_ips: del self.DHCPServerHandler.leased_ips[k]
-            if self.DEBUG: print("(DHCP)", self.id, "deleted entries from lease table")
+    def stop(self):
+        """
+        Stop listening, and write out any leases not yet in the lease file
+        """
+        super().stop()
+        store = self.DHCPServerHandler.store
+        if store:
+            store.flush(self.DHCPServerHandler.leased_ips)
+            store.close()
 
     def handleDHCP(self, data, oninterface):
         #if self.DEBUG:
-        #    Debug(self.id, "got DHCP from " + Debug.colorID(data["L2"]["From"]), 
+        #    Debug(self.id, "got DHCP from " + Debug.colorID(data.L2.From), 
         #        color="green", f=self.__class__.__name__
         #    )
         response = self.DHCPServerHandler.handleDHCP(data, oninterface)
-        self.send(response, oninterface)
+        if response:
+            self.send(response, oninterface)
 
@@ -0,0 +1,292 @@
+from Headers import *
+from Debug import *
+
+# 802.1D Spanning Tree for a Switch, so redundant links don't loop frames forever.
+#
+# Every bridge starts out believing it is the root. The root sends a
+# Configuration BPDU out of its designated ports every hello_time; the others
+# relay it out of their own designated ports whenever it arrives on their root
+# port, adding their path cost. Comparing what each port hears against what it
+# would send itself elects one root, one root port per bridge and one
+# designated port per link, and every other port is blocked (alternate).
+#
+# A port only forwards after forward_delay discarding plus forward_delay
+# learning, so the tree settles before any loop could open up. Ports whose
+# information stops being refreshed age out after max_age, and a port whose
+# Link goes down is disabled at once; either way the roles are recomputed.
+# Topology changes are reported up to the root, which sets TC in its BPDUs so
+# every bridge flushes MACs learned over the old tree.
+#
+#   with Scheduler() as sim:
+#       S1 = Switch([A], stp=True)
+#       S2 = Switch([S1, S1, B], stp=True)   # Two links between S1 and S2
+#   sim.run(until=35)                        # One of them ends up blocked
+
+
+class STPPort:
+    __slots__ = ("interface", "id", "cost", "edge", "auto_edge", "disabled",
+                 "role", "state", "timer", "info", "age", "tc", "expires")
+
+    def __init__(self, interface, ID, edge, cost=19):
+        self.interface = interface
+        self.id = ID
+        self.cost = cost # 802.1D's path cost for 100Mb/s
+
+        # An edge port has no bridge behind it and forwards straight away.
+        # It stops being one the moment a BPDU arrives on it
+        self.edge = edge
+        self.auto_edge = edge
+        self.disabled = False
+
+        self.role = "designated" # root, designated, alternate or disabled
+        self.state = "discarding" # discarding, learning or forwarding
+        self.timer = None # When the next state change towards forwarding is due
+
+        # Best Configuration BPDU heard on this port: (root, cost, bridge, port)
+        self.info = None
+        self.age = 0
+        self.tc = False
+        self.expires = 0
+
+
+class STPHandler:
+    def __init__(self, ID, clock, flush, priority=32768, debug=1):
+        """
+        :param ID: The Switch's ID, which doubles as its bridge MAC
+        :param clock: Function returning the current time, see `Device.clock()`
+        :param flush: Function forgetting every learned MAC, called on topology changes
+        :param priority: Lower wins the root election, int
+        """
+        self.DEBUG = debug
+        self.id = ID
+        self.clock = clock
+        self.flush = flush
+        self.bridge = (priority, ID)
+
+        # 802.1D defaults, in seconds
+        self.hello_time = 2
+        self.max_age = 20
+        self.forward_delay = 15
+
+        self.ports = {} # Interface: STPPort
+        self.forwarding = set() # Interfaces that frames may enter and leave by
+        self.learning = set() # Interfaces that learn MACs but don't forward yet
+
+        self.root = self.bridge
+        self.cost = 0
+        self.root_port = None
+        self.next_hello = 0
+        self.tc_until = 0 # As root, set TC in BPDUs until then
+
+        # Stats
+        self.topology_changes = 0
+        self.last_change = None # When a port last changed state, to measure convergence
+
+    def addPort(self, interface, edge=False):
+        """
+        Run STP on a newly attached interface
+
+        :param edge: Whether nothing but end hosts are behind it, bool
+        """
+        port = STPPort(interface, 0x8000 | (len(self.ports) + 1), edge)
+        self.ports[interface] = port
+        return self._recompute()
+
+    def isRoot(self):
+        return self.root_port is None
+
+    def handleBPDU(self, data, oninterface):
+        """
+        Process a BPDU received on oninterface
+
+        :param data: See `Headers.makePacket()`, Packet
+        :returns: [(Interface, Packet)] to send
+        """
+        port = self.ports.get(oninterface)
+        if port is None or port.disabled:
+            return []
+        bpdu = data.L2.Data
+
+        out = []
+        if port.edge:
+            # There's a bridge on the other end after all
+            port.edge = False
+            self._setState(port, "discarding")
+            out += self._recompute()
+
+        if bpdu.type == 0x80: # TCN from downstream
+            if port.role == "designated":
+                out += self._topologyChange()
+            return out
+
+        if bpdu.age >= self.max_age:
+            return out # Went round too many bridges
+
+        vector = (bpdu.root, bpdu.cost, bpdu.bridge, bpdu.port)
+        # Keep the best information heard, or whatever the bridge we got it from says now
+        if port.info is None or vector <= port.info or vector[2:] == port.info[2:]:
+            port.info = vector
+            port.age = bpdu.age
+            port.tc = bool(bpdu.flags & 0x01)
+            port.expires = self.clock() + self.max_age - bpdu.age
+        out += self._recompute()
+
+        if port.role == "root":
+            if port.tc:
+                self.flush()
+            out += self._hello() # Pass the root's BPDU on down the tree
+        elif port.role == "designated":
+            # They claim to be designated on this link, but we are. Tell them
+            out.append((oninterface, self._config(port)))
+        return out
+
+    def tick(self):
+        """
+        Age out stale information, notice links going up and down, move ports
+        along towards forwarding and, as root, send hellos. Call this
+        periodically, see `Switch._checkTimeouts()`
+
+        :returns: [(Interface, Packet)] to send
+        """
+        now = self.clock()
+        out = []
+
+        changed = False
+        for port in self.ports.values():
+            if port.disabled == port.interface.link.up:
+                # Link state changed
+                port.disabled = not port.disabled
+                port.info = None
+                port.edge = port.auto_edge
+                changed = True
+                if self.DEBUG:
+                    Debug(self.id, "port", port.id, "link", "down" if port.disabled else "up",
+                        color="yellow", f=self.__class__.__name__
+                    )
+            elif port.info is not None and now >= port.expires:
+                port.info = None
+                changed = True
+        if changed:
+            out += self._recompute()
+
+        for port in self.ports.values():
+            if port.timer is not None and now >= port.timer:
+                if port.state == "discarding":
+                    self._setState(port, "learning")
+                    port.timer = now + self.forward_delay
+                else:
+                    self._setState(port, "forwarding")
+                    port.timer = None
+                    out += self._topologyChange()
+
+        if self.isRoot() and now >= self.next_hello:
+            self.next_hello = now + self.hello_time
+            out += self._hello()
+        return out
+
+    def _recompute(self):
+        """
+        Elect the root port and decide every port's role from what each has heard
+
+        :returns: [(Interface, Packet)] to send
+        """
+        best = None
+        for port in self.ports.values():
+            if port.disabled or port.info is None:
+                continue
+            root, cost, bridge, portid = port.info
+            if bridge == self.bridge:
+                continue # Our own BPDU, come back through a bridge that doesn't run STP
+            candidate = (root, cost + port.cost, bridge, portid, port.id)
+            if best is None or candidate < best:
+                best, root_port = candidate, port
+
+        if best is not None and best[0] < self.bridge:
+            self.root, self.cost, new_root_port = best[0], best[1], root_port
+        else:
+            self.root, self.cost, new_root_port = self.bridge, 0, None
+        if new_root_port is not self.root_port and self.DEBUG:
+            Debug(self.id, "root is", self.root[1], "cost", self.cost,
+                color="yellow", f=self.__class__.__name__
+            )
+        self.root_port = new_root_port
+
+        out = []
+        blocked = False
+        for port in self.ports.values():
+            if port.disabled:
+                role = "disabled"
+            elif port is self.root_port:
+                role = "root"
+            elif port.edge or port.info is None:
+                role = "designated"
+            elif (self.root, self.cost, self.bridge, port.id) < port.info:
+                role = "designated"
+            else:
+                role = "alternate"
+            port.role = role
+
+            if role in ("root", "designated"):
+                if port.edge:
+                    port.timer = None
+                    if port.state != "forwarding":
+                        self._setState(port, "forwarding")
+                elif port.state == "discarding" and port.timer is None:
+                    port.timer = self.clock() + self.forward_delay
+            else:
+                port.timer = None
+                if port.state != "discarding":
+                    blocked = blocked or port.state == "forwarding"
+                    self._setState(port, "discarding")
+
+        if blocked:
+            out += self._topologyChange()
+        return out
+
+    def _setState(self, port, state):
+        port.state = state
+        self.last_change = self.clock()
+        self.forwarding.discard(port.interface)
+        self.learning.discard(port.interface)
+        if state == "forwarding":
+            self.forwarding.add(port.interface)
+        elif state == "learning":
+            self.learning.add(port.interface)
+        if self.DEBUG == 2:
+            Debug(self.id, "port", port.id, port.role, state,
+                color="yellow", f=self.__class__.__name__
+            )
+
+    def _topologyChange(self):
+        """
+        Forget learned MACs, and make sure the root hears about it so every other
+        bridge does too
+
+        :returns: [(Interface, Packet)] to send
+        """
+        self.topology_changes += 1
+        self.flush()
+        if self.isRoot():
+            self.tc_until = self.clock() + self.max_age + self.forward_delay
+            return []
+        TCN = createTCNHeader(self.bridge)
+        return [(self.root_port.interface, makePacket(makePacket_L2("STP", self.id, MAC_STP, data=TCN)))]
+
+    def _config(self, port):
+        """
+        :returns: The Configuration BPDU to send on port, Packet
+        """
+        if self.isRoot():
+            age, tc = 0, self.clock() < self.tc_until
+        else:
+            age, tc = self.root_port.age + 1, self.root_port.tc
+        BPDU = createBPDUHeader(self.root, self.cost, self.bridge, port.id, age, tc,
+            self.max_age, self.hello_time, self.forward_delay)
+        return makePacket(makePacket_L2("STP", self.id, MAC_STP, data=BPDU))
+
+    def _hello(self):
+        """
+        :returns: A Configuration BPDU for every designated port with a bridge behind it, [(Interface, Packet)]
+        """
+        return [(port.interface, self._config(port)) for port in self.ports.values()
+            if port.role == "designated" and not port.edge]
@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import traceback
+
+# A discrete-event scheduler, used in place of per-device listener threads.
+#
+# Normally every Device runs its own listen() thread that sleeps between
+# frames. Devices created while a Scheduler is active instead post their work
+# (frame deliveries, _checkTimeouts() ticks) onto one priority queue ordered
+# by virtual time. Running the scheduler pops events in order and jumps the
+# clock straight to each one, so a simulation runs as fast as the handlers
+# themselves and every device shares a single thread.
+#
+#   with Scheduler() as sim:
+#       A, B, C, D, R1, R2, S1, S2, S3 = topology1()
+#   A.sendICMP(B.getIP())     # Advances virtual time until the reply arrives
+#   sim.run(until=60)         # Let another minute of virtual time pass
+
+
+class Event:
+    def __init__(self, when, fn, args, background=False):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+        # Background events (periodic ticks) never keep run() going by themselves
+        self.background = background
+
+
+class Scheduler:
+
+    # The scheduler that newly constructed Devices attach themselves to
+    active = None
+
+    def __init__(self, link_delay=0.001, tick=0.25, strict=False):
+        """
+        :param link_delay: Virtual seconds a frame spends on a link, float
+        :param tick: Virtual seconds between _checkTimeouts() calls per device, float
+        :param strict: Raise exceptions from handlers instead of printing them, bool
+        """
+        self.now = 0.0
+        self.link_delay = link_delay
+        self.tick = tick
+        self.strict = strict
+
+        # (when, seq, Event); seq keeps same-time events in FIFO order
+        self.queue = []
+        self.seq = itertools.count()
+        self.pending = 0 # Non-background events in the queue
+
+        self.devices = []
+        self.processed = 0
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = Scheduler.active
+        Scheduler.active = self
+        return self
+
+    def __exit__(self, *exc):
+        Scheduler.active = self.previous
+        self.previous = None
+
+    def schedule(self, delay, fn, *args, background=False):
+        """
+        Call fn(*args) once `delay` virtual seconds have passed.
+
+        :returns: Event, which may be passed to cancel()
+        """
+        event = Event(self.now + delay, fn, args, background)
+        heapq.heappush(self.queue, (event.when, next(self.seq), event))
+        if not background:
+            self.pending += 1
+        return event
+
+    def cancel(self, event):
+        event.cancelled = True
+
+    def step(self):
+        """
+        Pop and run the next event, advancing the clock to it.
+
+        :returns: False if there was nothing left to run, bool
+        """
+        if not self.queue:
+            return False
+        when, _, event = heapq.heappop(self.queue)
+        if not event.background:
+            self.pending -= 1
+        if event.cancelled:
+            return True
+
+        self.now = when
+        self.processed += 1
+        try:
+            event.fn(*event.args)
+        except Exception:
+            # Mirror a crashed handler thread: report it and keep simulating
+            if self.strict: raise
+            traceback.print_exc()
+        return True
+
+    def run(self, until=None):
+        """
+        Run events in time order. Without `until`, stop once only background
+        events (periodic ticks) remain; with it, stop at that virtual time.
+
+        :param until: Virtual time to stop at, float
+        """
+        while self.queue:
+            if until is None and not self.pending:
+                break
+            if until is not None and self.queue[0][0] > until:
+                break
+            self.step()
+
+        if until is not None:
+            self.now = max(self.now, until)
+
+    def runUntil(self, condition, timeout):
+        """
+        Run events until condition() is true or `timeout` virtual seconds
+        pass. This is how blocking calls like sendARP() wait in simulation;
+        it may be called from inside a running event.
+
+        :param condition: Function returning bool
+        :param timeout: Virtual seconds, float
+        :returns: condition(), bool
+        """
+        deadline = self.now + timeout
+        while not condition():
+            if not self.queue or self.queue[0][0] > deadline:
+                # Nothing left that could happen in time
+                self.now = max(self.now, deadline)
+                return bool(condition())
+            self.step()
+        return True
+
+    def addDevice(self, device):
+        """
+        Begin driving a device's _checkTimeouts() from the event queue,
+        the equivalent of starting its listener thread.
+        """
+        self.devices.append(device)
+        self.schedule(self.tick, self._tick, device, background=True)
+
+    def _tick(self, device):
+        if device.thread_exit: return
+        device._checkTimeouts()
+        self.schedule(self.tick, self._tick, device, background=True)
@@ -1,8 +1,23 @@
 import unittest
+import copy
 import sys
 import io
 from contextlib import redirect_stdout
 from L2 import *
+from L3 import *
+from Scheduler import Scheduler
+from AsyncRuntime import AsyncRuntime
+from WorkerPool import WorkerPool
+from Codec import *
+from FIB import FIB
+from ARP import ARPHandler, NeighborTable, INCOMPLETE, REACHABLE, STALE
+from DHCP import AddressPool, DHCPServerHandler, LeaseStore
+import asyncio
+import threading
+import time
+import os
+import tempfile
+from concurrent.futures import Future
 
 
 """
@@ -127,6 +142,947 @@ class HostTestCase(unittest.TestCase):
             else:
                 self.fail("RecvSendARP failed")
 
+class HeaderTestCase(unittest.TestCase):
+    def setUp(self):
+        ICMP = createICMPHeader(8, identifier=42)
+        self.p = makePacket(makePacket_L2("IPv4", "a", "b"), makePacket_L3("1.1.1.1", "2.2.2.2", ICMP, "ICMP"))
+
+    def test_DictView(self):
+        self.assertEqual(self.p["L2"]["To"], "b")
+        self.assertIs(self.p["L3"]["Data"], self.p.L3.Data)
+        self.assertEqual(self.p.L3.Data["identifier"], 42)
+
+        self.p["L2"]["To"] = "c"
+        self.assertEqual(self.p.L2.To, "c")
+        self.assertIn("DIP", self.p.L3)
+        self.assertNotIn("L5", self.p)
+        with self.assertRaises(KeyError):
+            self.p["L2"]["Nope"] = 1
+
+    def test_Slots(self):
+        for header in (self.p, self.p.L2, self.p.L3, self.p.L3.Data):
+            self.assertFalse(hasattr(header, "__dict__"))
+
+    def test_DeepCopy(self):
+        q = copy.deepcopy(self.p)
+        q.L2.To = "c"
+        q.L3.Data.identifier = 1
+        self.assertEqual(self.p.L2.To, "b")
+        self.assertEqual(self.p.L3.Data.identifier, 42)
+        self.assertEqual(q.toDict()["L3"]["DIP"], IP("2.2.2.2"))
+
+    def test_CopyL2(self):
+        q = self.p.copyL2()
+        q.L2.To = "c"
+        self.assertEqual(self.p.L2.To, "b")
+        self.assertIsNot(q.L2, self.p.L2)
+        self.assertIs(q.L3, self.p.L3)
+
+    def test_AboveL4(self):
+        with self.assertRaises(ValueError):
+            makePacket(makePacket_L2(), L5=makePacket_L2())
+
+class AddressTestCase(unittest.TestCase):
+    def test_IP(self):
+        ip = IP("1.1.1.2/24")
+        self.assertEqual(ip, 0x01010102)
+        self.assertEqual(str(ip), "1.1.1.2")
+        self.assertIs(IP(ip), ip)
+        self.assertEqual(IP(""), IP_ANY)
+        self.assertRaises(ValueError, IP, "abc")
+
+    def test_Masks(self):
+        self.assertEqual(str(prefixToMask(24)), "255.255.255.0")
+        self.assertEqual(maskToPrefix("255.255.240.0"), 20)
+        self.assertEqual(splitAddr("10.1.2.3/8"), (IP("10.1.2.3"), IP("255.0.0.0")))
+
+    def test_InterfaceSubnet(self):
+        interface = Interface(Link(), "1.1.1.2", "x")
+        interface.nmask = "255.255.255.0"
+        interface.gateway = "1.1.1.1/24"
+        self.assertEqual(interface.network, IP("1.1.1.0"))
+        self.assertEqual(interface.gateway, IP("1.1.1.1"))
+        self.assertTrue(interface.inSubnet(IP("1.1.1.200")))
+        self.assertFalse(interface.inSubnet(IP("1.1.2.1")))
+
+class FIBTestCase(unittest.TestCase):
+    def test_LongestMatch(self):
+        fib = FIB()
+        fib.insert("0.0.0.0", 0, "default")
+        fib.insert("10.0.0.0", 8, "a")
+        fib.insert("10.1.0.0", 16, "b")
+        fib.insert("10.1.2.3", 32, "c")
+        self.assertEqual(fib.lookup(IP("10.1.2.3")), "c")
+        self.assertEqual(fib.lookup(IP("10.1.2.4")), "b")
+        self.assertEqual(fib.lookup(IP("10.2.0.1")), "a")
+        self.assertEqual(fib.lookup(IP("11.0.0.1")), "default")
+
+        self.assertEqual(fib.remove("10.1.0.0", 16), "b")
+        self.assertEqual(fib.lookup(IP("10.1.2.4")), "a")
+        self.assertEqual(len(fib), 3)
+
+    def test_MatchesLinearScan(self):
+        rng = random.Random(7)
+        routes = [(rng.getrandbits(32), rng.choice([1, 4, 8, 16, 23, 24, 30, 32])) for i in range(500)]
+        fib = FIB()
+        for i, (prefix, prefixlen) in enumerate(routes):
+            fib.insert(prefix, prefixlen, i)
+
+        for i in range(2000):
+            ip = rng.getrandbits(32) if i % 2 else routes[i % len(routes)][0]
+            best, best_len = None, -1
+            for j, (prefix, prefixlen) in enumerate(routes):
+                mask = int(prefixToMask(prefixlen))
+                if ip & mask == prefix & mask and prefixlen >= best_len:
+                    best, best_len = j, prefixlen # Later inserts replace earlier ones
+            self.assertEqual(fib.lookup(ip), best)
+
+class NeighborTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.table = NeighborTable(lambda: self.now, reachable_time=30, gc_time=60, incomplete_time=5, max_size=3)
+
+    def test_States(self):
+        self.table.markIncomplete(IP("1.1.1.2"))
+        self.assertEqual(self.table.state(IP("1.1.1.2")), INCOMPLETE)
+        self.assertIn(IP("1.1.1.2"), self.table)
+        self.assertIsNone(self.table.get(IP("1.1.1.2"))) # Never half resolved
+
+        self.table.confirm(IP("1.1.1.2"), "-H-1")
+        self.assertEqual(self.table.state(IP("1.1.1.2")), REACHABLE)
+        self.now = 30
+        self.assertEqual(self.table.state(IP("1.1.1.2")), STALE)
+        self.assertEqual(self.table.get(IP("1.1.1.2")), "-H-1")
+
+    def test_Expire(self):
+        self.table.markIncomplete(IP("1.1.1.9"))
+        self.table.confirm(IP("1.1.1.2"), "-H-1")
+        self.table.confirm(IP("1.1.1.3"), "-H-2")
+        self.now = 40
+        self.table.get(IP("1.1.1.3")) # In use while STALE
+        self.assertEqual(self.table.expire(), [IP("1.1.1.3")])
+        self.assertNotIn(IP("1.1.1.9"), self.table)
+
+        self.now = 42
+        self.table.confirm(IP("1.1.1.3"), "-H-2") # Answered
+
+        # Unused for gc_time
+        self.now = 61
+        self.assertEqual(self.table.expire(), [])
+        self.assertNotIn(IP("1.1.1.2"), self.table)
+        self.assertEqual(self.table.state(IP("1.1.1.3")), REACHABLE)
+
+        # Used while STALE again, and this time the reprobe goes unanswered
+        self.now = 80
+        self.table.get(IP("1.1.1.3"))
+        self.assertEqual(self.table.expire(), [IP("1.1.1.3")])
+        self.now = 85
+        self.table.expire()
+        self.assertNotIn(IP("1.1.1.3"), self.table)
+
+    def test_LRU(self):
+        for i in range(3):
+            self.table.confirm(IP(i + 1), "-H-" + str(i))
+        self.table.get(IP(1))
+        self.table.confirm(IP(4), "-H-3")
+        self.assertEqual(list(self.table.entries), [IP(3), IP(1), IP(4)])
+        self.assertEqual(self.table.evicted, 1)
+
+    def test_LookupLocks(self):
+        # get() reorders the table, so handlers look MACs up under the ARPHandler's lock
+        handler = ARPHandler("-H-1", "[L]1", IP("1.1.1.1"), debug=0, clock=lambda: self.now)
+        handler.arp_cache.confirm(IP("1.1.1.2"), "-H-2")
+        found = []
+        with handler.lock:
+            t = threading.Thread(target=lambda: found.append(handler.lookup(IP("1.1.1.2"))))
+            t.start()
+            t.join(0.05)
+            self.assertTrue(t.is_alive())
+        t.join(1)
+        self.assertEqual(found, ["-H-2"])
+
+    def test_Reprobe(self):
+        handler = ARPHandler("-H-1", "[L]1", IP("1.1.1.1"), debug=0, clock=lambda: self.now)
+        handler.arp_cache.confirm(IP("1.1.1.2"), "-H-2")
+        self.now = 40
+        handler.lookup(IP("1.1.1.2")) # In use while STALE
+        probes = handler.expire()
+        self.assertEqual([(p.L2.To, p.L2.Data.TPA) for p in probes], [("-H-2", IP("1.1.1.2"))])
+
+class AddressPoolTestCase(unittest.TestCase):
+    def test_AllocateRelease(self):
+        pool = AddressPool("10.0.0.10", "10.0.0.12")
+        self.assertTrue(pool.reserve("10.0.0.11"))
+        self.assertFalse(pool.reserve("10.0.0.11"))
+        self.assertFalse(pool.reserve("10.0.0.13")) # Not in the pool
+        self.assertEqual([pool.allocate(), pool.allocate()], [IP("10.0.0.10"), IP("10.0.0.12")])
+        self.assertIsNone(pool.allocate())
+
+        pool.release("10.0.0.11")
+        pool.release("10.0.0.11")
+        self.assertEqual(pool.available(), 1)
+        self.assertEqual(pool.allocate(), IP("10.0.0.11"))
+        self.assertIsNone(pool.allocate())
+
+    def test_Large(self):
+        pool = AddressPool("10.0.0.0", "10.255.255.255")
+        self.assertEqual(pool.available(), 2 ** 24)
+        self.assertEqual(pool.allocate(), IP("10.0.0.0"))
+
+class DHCPServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        # A /28 leaves 10 - 14 to hand out
+        self.server = DHCPServerHandler("1.1.1.2", "255.255.255.240", "=DHCP=1", "1.1.1.1/28", 0, [], clock=lambda: self.now)
+
+    def discover(self, chaddr):
+        DHCP = createDHCPHeader(chaddr=chaddr, options={53:1, 55:[1, 3, 6]})
+        p = makePacket(makePacket_L2("IPv4", chaddr, MAC_BROADCAST), makePacket_L3(IP_ANY, IP_BROADCAST, DHCP, "UDP"), makePacket_L4_UDP(68, 67))
+        offer = self.server.handleDHCP(p, None)
+        return offer and offer.L3.Data.yiaddr
+
+    def request(self, chaddr, ip):
+        DHCP = createDHCPHeader(chaddr=chaddr, options={50:ip, 53:3, 54:self.server.ip})
+        p = makePacket(makePacket_L2("IPv4", chaddr, MAC_BROADCAST), makePacket_L3(IP_ANY, IP_BROADCAST, DHCP, "UDP"), makePacket_L4_UDP(68, 67))
+        ack = self.server.handleDHCP(p, None)
+        return ack and ack.L3.Data.yiaddr
+
+    def test_OfferReservation(self):
+        offers = [self.discover("-H-" + str(i)) for i in range(5)]
+        self.assertEqual(len(set(offers)), 5)
+        self.assertEqual(self.discover("-H-0"), offers[0]) # Discovering again
+        self.assertIsNone(self.discover("-H-5")) # Exhausted
+
+        # Someone else can't take an offered address
+        self.assertIsNone(self.request("-H-5", offers[1]))
+        self.assertEqual(self.request("-H-1", offers[1]), offers[1])
+
+        # Offers that are never requested go back to the pool
+        self.now = self.server.offer_timeout
+        self.assertIsNotNone(self.discover("-H-5"))
+        self.assertEqual(self.server.pool.available(), 3)
+
+    def test_ReturningClient(self):
+        ip = self.request("-H-1", self.discover("-H-1"))
+        self.assertEqual(self.server.findLease(makePacket(makePacket_L2(), makePacket_L3(IP_ANY, IP_ANY, createDHCPHeader(chaddr="-H-1")))), ip)
+        self.discover("-H-2")
+        self.assertEqual(self.discover("-H-1"), ip) # Its old address, not a new one
+        self.assertEqual(self.server.pool.available(), 3)
+
+        # Moving to another free address drops the old lease
+        self.assertEqual(self.request("-H-1", IP("1.1.1.14")), IP("1.1.1.14"))
+        self.assertNotIn(ip, self.server.leased_ips)
+        self.assertTrue(self.server.pool.isFree(ip))
+        self.assertEqual(self.server.by_chaddr, {"-H-1": IP("1.1.1.14")})
+
+    def test_LeaseStore(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "leases")
+            self.server.restore(LeaseStore(path))
+            a = self.request("-H-1", self.discover("-H-1"))
+            b = self.request("-H-2", self.discover("-H-2"))
+            self.server.store.flush(self.server.leased_ips)
+
+            # A restarted server has the same leases, and the addresses stay taken
+            restarted = DHCPServerHandler("1.1.1.2", "255.255.255.240", "=DHCP=1", "1.1.1.1/28", 0, [], clock=lambda: self.now)
+            self.assertEqual(restarted.restore(LeaseStore(path)), 2)
+            self.assertEqual(restarted.leased_ips, self.server.leased_ips)
+            self.assertEqual(restarted.by_chaddr, {"-H-1": a, "-H-2": b})
+            self.assertFalse(restarted.pool.isFree(a))
+            self.server.store.close()
+            self.server = restarted
+            self.assertEqual(self.discover("-H-1"), a)
+
+            # Renewals grow the log until it's compacted down to the live leases
+            store = self.server.store
+            store.compact_min = 4
+            for i in range(3):
+                self.request("-H-1", a)
+                store.flush(self.server.leased_ips)
+            self.assertEqual(store.compactions, 1)
+            with open(path) as f:
+                self.assertEqual(len(f.read().splitlines()), 2)
+            store.close()
+            self.assertEqual(LeaseStore(path).load(), self.server.leased_ips)
+
+    def test_LeaseStoreTorn(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "leases")
+            store = LeaseStore(path)
+            store.put(IP("1.1.1.10"), ("id\twith\ttabs\n", 60, 0.0, "-H-1"))
+            store.put(IP("1.1.1.11"), ("-H-21.1.1.11", 60, 0.0, "-H-2"))
+            store.flush()
+            store.close()
+
+            # A crash half way through writing the last lease
+            with open(path, "r+") as f:
+                f.truncate(os.path.getsize(path) - 20)
+            store = LeaseStore(path)
+            self.assertEqual(store.load(), {IP("1.1.1.10"): ("id\twith\ttabs\n", 60, 0.0, "-H-1")})
+            self.assertEqual(store.lines, 1)
+
+            # Appending after it doesn't run into the torn line
+            store.delete(IP("1.1.1.10"))
+            store.flush()
+            store.close()
+            self.assertEqual(LeaseStore(path).load(), {})
+
+    def test_LeaseExpiry(self):
+        a = self.request("-H-1", self.discover("-H-1"))
+        b = self.request("-H-2", self.discover("-H-2"))
+
+        # Renew one halfway through
+        self.now = self.server.lease_offer / 2
+        DHCP = createDHCPHeader(chaddr="-H-2", ciaddr=b, options={53:3})
+        p = makePacket(makePacket_L2("IPv4", "-H-2", "=DHCP=1"), makePacket_L3(b, self.server.ip, DHCP, "UDP"), makePacket_L4_UDP(68, 67))
+        self.assertEqual(self.server.handleDHCP(p, None).L3.Data.yiaddr, b)
+        self.assertEqual(len(self.server.lease_expiry), 2) # Not a second timer
+
+        self.now = self.server.lease_offer
+        self.assertEqual(self.server.expireLeases(), [a])
+        self.assertTrue(self.server.pool.isFree(a))
+        self.now = self.server.lease_offer * 1.5
+        self.assertEqual(self.server.expireLeases(), [b])
+        self.assertEqual(self.server.leased_ips, {})
+        self.assertEqual(self.server.lease_expiry, [])
+
+    def test_LeaseChurn(self):
+        # Leased, dropped and leased again: still one heap entry for the address
+        ip = self.request("-H-1", self.discover("-H-1"))
+        for i in range(5):
+            self.server._unlease(ip)
+            self.now += 10
+            self.assertEqual(self.request("-H-1", self.discover("-H-1")), ip)
+        self.assertEqual(len(self.server.lease_expiry), 1)
+
+        # The stale entry comes up first and makes way for the live lease
+        self.now = self.server.lease_offer
+        self.assertEqual(self.server.expireLeases(), [])
+        self.assertEqual(len(self.server.lease_expiry), 1)
+        self.now += 50
+        self.assertEqual(self.server.expireLeases(), [ip])
+        self.assertEqual(self.server.lease_expiry, [])
+
+class CodecTestCase(unittest.TestCase):
+    def test_ARP(self):
+        p = makePacket(makePacket_L2("ARP", "-H-1234", MAC_BROADCAST, data=createARPHeader(1, "_I_5678", "1.1.1.2", 0, "1.1.1.1")))
+        raw = encodePacket(p)
+        self.assertEqual(len(raw), 14 + 28)
+        self.assertEqual(raw[:6], b"\xff" * 6)
+        self.assertEqual(WirePacket(raw, "link").toDict(), dict(p.toDict(), L2=dict(p.L2.toDict(), FromLink="link")))
+
+    def test_ICMP(self):
+        p = makePacket(makePacket_L2("IPv4", "-H-1234", "=R=99"), makePacket_L3("1.1.1.2", "2.2.2.2", createICMPHeader(8, identifier=42), "ICMP"))
+        raw = encodePacket(p)
+        self.assertEqual(checksum(raw[14:34]), 0)
+        self.assertEqual(checksum(raw[34:]), 0)
+
+        q = WirePacket(raw)
+        self.assertEqual(q.L3.TTL, p.L3.TTL)
+        self.assertEqual(q.L3.Data.toDict(), p.L3.Data.toDict())
+        self.assertEqual(q.L4, "")
+
+    def test_BPDU(self):
+        BPDU = createBPDUHeader((32768, "{S}12"), 19, (4096, "{S}34"), 0x8002, age=1, tc=True)
+        p = makePacket(makePacket_L2("STP", "{S}34", MAC_STP, data=BPDU))
+        raw = encodePacket(p)
+        self.assertEqual(len(raw), 14 + 3 + 35)
+        self.assertEqual(raw[:6], bytes.fromhex("0180c2000000"))
+        self.assertEqual(WirePacket(raw).toDict(), p.toDict())
+
+    def test_VLAN(self):
+        ARP = createARPHeader(1, "-H-1234", "1.1.1.2", 0, "1.1.1.3")
+        p = makePacket(makePacket_L2("ARP", "-H-1234", MAC_BROADCAST, data=ARP, vlan=10))
+        raw = encodePacket(p)
+        self.assertEqual(len(raw), 18 + 28)
+        self.assertEqual(raw[12:16], bytes.fromhex("8100000a"))
+        self.assertEqual(WirePacket(raw).toDict(), p.toDict())
+
+        # Retagging a frame that came off the wire keeps everything above L2
+        ICMP = makePacket(makePacket_L2("IPv4", "-H-1234", "=R=99", vlan=10), makePacket_L3("1.1.1.2", "2.2.2.2", createICMPHeader(8), "ICMP"))
+        q = WirePacket(encodePacket(ICMP))
+        q.L2.VLAN = None
+        self.assertEqual(WirePacket(encodePacket(q)).L3.Data.toDict(), ICMP.L3.Data.toDict())
+
+    def test_DHCP(self):
+        DHCP = createDHCPHeader(chaddr="-H-1234", options={53:1, 55:[1, 3, 6], 61:"-H-1234", 6:""})
+        p = makePacket(
+            makePacket_L2("IPv4", "-H-1234", MAC_BROADCAST),
+            makePacket_L3("0.0.0.0", IP_BROADCAST, DHCP, "UDP"),
+            makePacket_L4_UDP(68, 67)
+        )
+        q = WirePacket(encodePacket(p))
+        self.assertEqual(q.L3.Data.toDict(), DHCP.toDict())
+        self.assertEqual((q.L4.SPort, q.L4.DPort), (68, 67))
+
+    def test_Lazy(self):
+        p = makePacket(makePacket_L2("IPv4", "-H-1234", "=R=99"), makePacket_L3("1.1.1.2", "2.2.2.2", createICMPHeader(8), "ICMP"))
+        q = WirePacket(encodePacket(p))
+        q.L2.To = "-H-1234"
+        self.assertRaises(AttributeError, Packet.L3.__get__, q) # Never unpacked
+        self.assertEqual(encodePacket(q)[14:], encodePacket(p)[14:])
+
+    def test_Simulation(self):
+        with Scheduler() as sim:
+            A = Host(["1.1.1.2/24"], debug=0)
+            B = Host(["2.2.2.2/24"], debug=0)
+            S1 = Switch([A], debug=0)
+            R1 = Router(["1.1.1.1/24", "2.2.2.1/24"], [S1, B], debug=0)
+        A.interfaces[0].gateway = "1.1.1.1/24"
+        B.interfaces[0].gateway = "2.2.2.1/24"
+        for device in sim.devices:
+            device.wire = True
+        with redirect_stdout(io.StringIO()):
+            self.assertTrue(A.sendICMP(B.getIP()))
+
+class InboxTestCase(unittest.TestCase):
+    def test_DrainAll(self):
+        inbox = Inbox()
+        for i in range(5):
+            inbox.put(i)
+        self.assertEqual(list(inbox.drain(0)), [0, 1, 2, 3, 4])
+        self.assertEqual(len(inbox), 0)
+
+    def test_WakeOnSend(self):
+        inbox = Inbox()
+        threading.Timer(0.05, inbox.put, args=("frame",)).start()
+        now = time.time()
+        self.assertEqual(list(inbox.drain(5)), ["frame"])
+        self.assertLess(time.time() - now, 1)
+
+    def test_ConcurrentSenders(self):
+        inbox = Inbox()
+        senders = [threading.Thread(target=lambda: [inbox.put(i) for i in range(1000)]) for _ in range(8)]
+        for t in senders: t.start()
+        for t in senders: t.join()
+        self.assertEqual(len(inbox.drain(0)), 8000)
+
+    def test_StopWakesListener(self):
+        A = Host(["1.1.1.2/24"], debug=0)
+        A.check_interval = 60
+        time.sleep(0.3) # Let the listener settle into a long wait
+        A.stop()
+        A.lthread.join(1)
+        self.assertFalse(A.lthread.is_alive())
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def test_PerKeyOrder(self):
+        pool = WorkerPool(4)
+        seen = {"a":[], "b":[]}
+        for i in range(200):
+            pool.submit("a", seen["a"].append, i)
+            pool.submit("b", seen["b"].append, i)
+        for i in range(100):
+            if pool.stats()["completed"] == 400: break
+            time.sleep(0.01)
+        self.assertEqual(seen["a"], list(range(200)))
+        self.assertEqual(seen["b"], list(range(200)))
+
+    def test_Stats(self):
+        pool = WorkerPool(1)
+        started, gate = threading.Event(), threading.Event()
+        pool.submit("a", lambda: started.set() or gate.wait())
+        started.wait(1)
+        for i in range(5):
+            pool.submit("a", lambda: None)
+        self.assertEqual(pool.stats()["depth"], 5)
+        self.assertEqual(pool.stats()["threads"], 1)
+        gate.set()
+        for i in range(100):
+            if pool.stats()["completed"] == 6: break
+            time.sleep(0.01)
+        self.assertEqual(pool.stats()["depth"], 0)
+        self.assertGreater(pool.stats()["max_wait"], 0)
+
+    def test_BlockedHandlerRunsOwnQueue(self):
+        # A handler waiting on something queued behind it for the same key
+        pool = WorkerPool(1)
+        flag, done = [], threading.Event()
+        def waiter():
+            with pool.blocking():
+                while not flag:
+                    pool.runPending("a")
+            done.set()
+        pool.submit("a", waiter)
+        pool.submit("a", flag.append, True)
+        self.assertTrue(done.wait(2))
+
+    def test_TimeoutsOnWorker(self):
+        # _checkTimeouts() is serialized with the device's handlers
+        A = Host(["1.1.1.2/24"], debug=0)
+        held, done = [], threading.Event()
+        def check():
+            held.append(A.executor.holds(A))
+            done.set()
+        A._checkTimeouts = check
+        self.assertTrue(done.wait(2))
+        A.stop()
+        self.assertTrue(held[0])
+
+class FutureTestCase(unittest.TestCase):
+    def test_WaitWakesOnResult(self):
+        # A threaded wait blocks on the Future itself instead of polling
+        A = Host(["1.1.1.2/24"], debug=0)
+        future = Future()
+        threading.Timer(0.05, future.set_result, ("done",)).start()
+        start = time.time()
+        self.assertTrue(A._waitFor(future, 5))
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(A._waitFor(Future(), 0.05))
+        A.stop()
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        A --- S --- R --- B
+        """
+        self.sim = Scheduler()
+        with self.sim:
+            self.A = Host(["1.1.1.2/24"], debug=0)
+            self.B = Host(["2.2.2.2/24"], debug=0)
+            self.S1 = Switch([self.A], debug=0)
+            self.R1 = Router(["1.1.1.1/24", "2.2.2.1/24"], [self.S1, self.B], debug=0)
+        self.A.interfaces[0].gateway = "1.1.1.1/24"
+        self.B.interfaces[0].gateway = "2.2.2.1/24"
+        self.output = io.StringIO()
+
+    def test_NoThreads(self):
+        for device in (self.A, self.B, self.S1, self.R1):
+            self.assertFalse(device.lthread.is_alive())
+            self.assertIsNone(device.executor)
+        self.assertEqual(len(self.sim.devices), 4)
+
+    def test_Indexes(self):
+        for interface in self.R1.interfaces:
+            self.assertIs(self.R1.getInterfaceFromID(interface.id), interface)
+            self.assertIs(self.R1.getLinkFromID(interface.linkid), interface.link)
+            self.assertIs(findInterfaceFromLinkID(interface.linkid, self.R1.interfaces_by_link), interface)
+        self.assertIs(self.R1.getOtherDeviceOnInterface(self.R1.interfaces[1].linkid), self.B)
+        self.assertIs(self.B.getOtherDeviceOnInterface(self.B.interfaces[0].linkid), self.R1)
+        self.assertEqual(self.R1.getIP(self.R1.interfaces[1].linkid), IP("2.2.2.1"))
+        self.assertFalse(self.R1.addInterface(self.R1.interfaces[0]))
+        self.assertEqual(len(self.R1.interfaces), 2)
+        with self.assertRaises(ValueError):
+            self.R1.getLinkFromID("[L]0")
+
+    def test_ARP(self):
+        with redirect_stdout(self.output):
+            self.assertEqual(self.A.sendARP(self.R1.getIP()), self.R1.id)
+
+        # Request and response each cross two links
+        self.assertAlmostEqual(self.sim.now, 4 * self.sim.link_delay)
+        self.assertEqual(self.A.interfaces[0].ARPHandler.waiting, {})
+
+    def test_ARPTimeout(self):
+        with redirect_stdout(self.output):
+            self.assertFalse(self.A.sendARP("1.1.1.99", timeout=5))
+        self.assertGreaterEqual(self.sim.now, 5)
+        self.assertEqual(self.A.interfaces[0].ARPHandler.waiting, {})
+
+    def test_ICMPAcrossRouter(self):
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendICMP(self.B.getIP()))
+            self.assertTrue(self.B.sendICMP(self.A.getIP()))
+        self.assertLess(self.sim.now, 1)
+
+    def test_MACTable(self):
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendICMP(self.B.getIP()))
+        # ARP broadcasts (A for R1, then R1 for A) flood, everything else is forwarded from the table
+        self.assertEqual(self.S1.floods, 2)
+        self.assertEqual(self.S1.misses, 0)
+        self.assertGreater(self.S1.hits, 0)
+        self.assertIs(self.S1.mac_table[self.A.id][0], self.S1.interfaces[0])
+
+        # Nothing heard from either side for longer than the aging time
+        self.S1.mac_aging = 10
+        self.sim.run(until=self.sim.now + 11)
+        self.assertEqual(len(self.S1.mac_table), 0)
+        self.assertEqual(self.S1.aged, 2)
+
+    def test_MACTableSize(self):
+        self.S1.mac_table_size = 2
+        for mac in ("m1", "m2", "m3"):
+            self.S1.learn(mac, self.S1.interfaces[0])
+        self.assertEqual(list(self.S1.mac_table), ["m2", "m3"])
+        self.S1.learn("m2", self.S1.interfaces[1]) # Moved, and now most recent
+        self.assertEqual(list(self.S1.mac_table), ["m3", "m2"])
+        self.assertIs(self.S1.mac_table["m2"][0], self.S1.interfaces[1])
+        self.assertEqual(self.S1.stats()["evicted"], 1)
+
+    def test_ARPAbandon(self):
+        handler = self.A.interfaces[0].ARPHandler
+        first, p = handler.resolve(IP("1.1.1.99"))
+        second, q = handler.resolve(IP("1.1.1.99"))
+        self.assertIs(first, second)
+        self.assertIsNotNone(p)
+        self.assertIsNone(q)
+
+        # One caller timing out leaves the request to the other
+        handler.abandon(IP("1.1.1.99"), first)
+        self.assertIn(IP("1.1.1.99"), handler.waiting)
+        self.assertIsNone(handler.sendARP(IP("1.1.1.99")))
+        handler.abandon(IP("1.1.1.99"), second)
+        self.assertEqual(handler.waiting, {})
+        self.assertNotIn(IP("1.1.1.99"), handler.arp_cache)
+
+    def test_ARPReprobe(self):
+        with redirect_stdout(self.output):
+            self.A.sendARP(self.R1.getIP())
+        table = self.A.interfaces[0].ARPHandler.arp_cache
+        self.sim.run(until=self.sim.now + table.reachable_time)
+        self.assertEqual(table.state(self.R1.getIP()), STALE)
+
+        # Used while STALE: reprobed with a unicast request on the next tick
+        self.assertEqual(table.get(self.R1.getIP()), self.R1.id)
+        floods = self.S1.floods
+        self.sim.run(until=self.sim.now + 1)
+        self.assertEqual(table.state(self.R1.getIP()), REACHABLE)
+        self.assertEqual(self.S1.floods, floods)
+
+    def test_ARPPendingQueue(self):
+        with redirect_stdout(self.output):
+            self.A.sendARP(self.R1.getIP()) # A knows its gateway
+
+        # Count the router's ARP requests towards B
+        sent = []
+        handler = self.R1.interfaces[1].ARPHandler
+        original = handler.sendARP
+        handler.sendARP = lambda ip: sent.append(ip) or original(ip)
+
+        for i in range(3):
+            self.A.send(self.A.interfaces[0].ICMPHandler.sendICMP(self.B.getIP(), self.R1.id))
+        with redirect_stdout(self.output):
+            self.sim.run()
+
+        self.assertEqual(sent, [self.B.getIP()])
+        self.assertEqual(len(self.A.interfaces[0].ICMPHandler.icmp_table), 3)
+        self.assertTrue(all(f.done() for f in self.A.interfaces[0].ICMPHandler.icmp_table.values()))
+        self.assertEqual(self.R1.arp_pending, {})
+
+    def test_ARPPendingExpiry(self):
+        with redirect_stdout(self.output):
+            self.A.sendARP(self.R1.getIP())
+            self.A.send(self.A.interfaces[0].ICMPHandler.sendICMP(IP("2.2.2.99"), self.R1.id))
+            self.sim.run(until=1)
+            self.assertEqual(len(self.R1.arp_pending), 1)
+            self.sim.run(until=1 + self.R1.arp_queue_timeout)
+        self.assertEqual(self.R1.arp_pending, {})
+        self.assertNotIn(IP("2.2.2.99"), self.R1.interfaces[1].ARPHandler.arp_cache)
+
+    def test_GratuitousARP(self):
+        self.A.gratuitous_arp = True
+        with redirect_stdout(self.output):
+            self.A.setIP("1.1.1.3", self.A.interfaces[0])
+            self.sim.run()
+        # The router learned the new address without asking, and didn't reply
+        self.assertEqual(self.R1.interfaces[0].ARPHandler.arp_cache.get(IP("1.1.1.3")), self.A.id)
+        self.assertNotIn(IP("1.1.1.3"), self.A.interfaces[0].ARPHandler.arp_cache)
+
+    def test_PreResolve(self):
+        # A <-> R1 on one side, R1 <-> B on the other
+        self.assertEqual(preResolve([self.A, self.B, self.S1, self.R1]), 4)
+        self.assertEqual(preResolve([self.A, self.B, self.S1, self.R1]), 0)
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendICMP(self.B.getIP()))
+        self.assertEqual(self.S1.floods, 0)
+
+    def test_ICMPToRouter(self):
+        # Matches the router's /32 local route, not the connected /24
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendICMP(self.R1.getIP(self.R1.interfaces[1].id)))
+
+    def test_EventOrder(self):
+        order = []
+        self.sim.schedule(2, order.append, "b")
+        self.sim.schedule(1, order.append, "a")
+        self.sim.schedule(2, order.append, "c")
+        self.sim.run()
+        self.assertEqual(order, ["a", "b", "c"])
+        self.assertEqual(self.sim.now, 2)
+
+class DHCPScopeTestCase(unittest.TestCase):
+    def test_ScopePerInterface(self):
+        """
+        A --- S1 --- D1 --- S2 --- B
+        """
+        sim = Scheduler()
+        with sim:
+            A, B = Host(debug=0), Host(debug=0)
+            S1, S2 = Switch([A], debug=0), Switch([B], debug=0)
+            D1 = DHCPServer(["1.1.1.2/24", "2.2.2.2/24"], ["1.1.1.1/24", "2.2.2.1/24"], [S1, S2], debug=0)
+        scope = D1.DHCPServerHandler.scopes.lookup(IP("2.2.2.0"))
+        scope.lease, scope.options = 60, {6: IP("8.8.8.8")}
+        with redirect_stdout(io.StringIO()):
+            self.assertTrue(A.sendDHCP("init"))
+            self.assertTrue(B.sendDHCP("init"))
+            self.assertTrue(B.sendDHCP("renew"))
+        self.assertTrue(A.interfaces[0].inSubnet(IP("1.1.1.1")))
+        self.assertTrue(B.interfaces[0].inSubnet(IP("2.2.2.1")))
+        self.assertEqual(B.interfaces[0].gateway, IP("2.2.2.1"))
+        client = B.interfaces[0].DHCPClient
+        self.assertEqual((client.DHCP_IP, client.lease[0]), (IP("2.2.2.2"), 60))
+        self.assertEqual(A.interfaces[0].DHCPClient.lease[0], D1.DHCPServerHandler.lease_offer)
+
+class DHCPRelayTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        A, B --- S1 --- R1 --- D1, with R1 relaying 1.1.1.0/24's DHCP to D1
+        """
+        self.sim = Scheduler()
+        with self.sim:
+            self.A, self.B = Host(debug=0), Host(debug=0)
+            self.D1 = DHCPServer("2.2.2.2/24", gateway="2.2.2.1/24", debug=0)
+            self.S1 = Switch([self.A, self.B], debug=0)
+            self.R1 = Router(["1.1.1.1/24", "2.2.2.1/24"], [self.S1, self.D1], debug=0)
+        self.D1.DHCPServerHandler.addScope("1.1.1.1/24")
+        self.R1.setDHCPRelay(self.R1.interfaces[0], "2.2.2.2")
+        self.output = io.StringIO()
+
+    def test_Relay(self):
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendDHCP("init"))
+            self.assertTrue(self.B.sendDHCP("init"))
+        self.assertTrue(self.A.interfaces[0].inSubnet(IP("1.1.1.1")))
+        self.assertEqual(self.A.interfaces[0].gateway, IP("1.1.1.1"))
+        self.assertNotEqual(self.A.getIP(), self.B.getIP())
+        self.assertEqual(set(self.D1.DHCPServerHandler.leased_ips), {self.A.getIP(), self.B.getIP()})
+        self.assertEqual(self.R1.relayed, 8) # Four messages each
+
+        # Renewals are unicast straight to the server, and routed back
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendDHCP("renew"))
+        self.assertEqual(self.R1.relayed, 8)
+
+    def test_NoRelay(self):
+        self.R1.setDHCPRelay(self.R1.interfaces[0], None)
+        with redirect_stdout(self.output):
+            self.assertFalse(self.A.sendDHCP("init", timeout=1))
+        self.assertEqual(self.D1.DHCPServerHandler.leased_ips, {})
+
+class DHCPClientTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        A --- S1 --- D1, handing out 60 second leases
+        """
+        self.sim = Scheduler()
+        with self.sim:
+            self.A = Host(debug=0)
+            self.S1 = Switch([self.A], debug=0)
+            self.D1 = DHCPServer("1.1.1.2/24", gateway="1.1.1.1/24", connectedTo=[self.S1], debug=0)
+        self.D1.DHCPServerHandler.scope.lease = 60
+        self.client = self.A.interfaces[0].DHCPClient
+        self.output = io.StringIO()
+
+    def test_Retransmit(self):
+        # The Discover is lost, but the one sent 4ish seconds later isn't
+        self.A.interfaces[0].link.up = False
+        with redirect_stdout(self.output):
+            self.assertFalse(self.A.sendDHCP("init", timeout=1))
+            self.A.interfaces[0].link.up = True
+            self.sim.run(until=self.sim.now + 10)
+        self.assertTrue(self.A.interfaces[0].inSubnet(IP("1.1.1.1")))
+        self.assertEqual(self.client.state, "BOUND")
+        self.assertGreaterEqual(self.client.retransmits, 1)
+
+        # Backoff doubles up to the cap, give or take the jitter
+        self.client.attempts = 1
+        self.assertTrue(3 <= self.client._backoff() <= 5)
+        self.client.attempts = 10
+        self.assertTrue(63 <= self.client._backoff() <= 65)
+
+    def test_Rebind(self):
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendDHCP("init"))
+        ip = self.A.getIP()
+
+        # Renewals go to a server that isn't there, so at T2 the client asks everyone
+        self.client.DHCP_IP = IP("1.1.1.99")
+        with redirect_stdout(self.output):
+            self.sim.run(until=self.sim.now + 50)
+        self.assertEqual(self.client.state, "RENEWING")
+        self.assertGreaterEqual(self.client.retransmits, 1)
+        with redirect_stdout(self.output):
+            self.sim.run(until=self.sim.now + 10)
+        self.assertEqual(self.client.state, "BOUND")
+        self.assertEqual(self.A.getIP(), ip)
+        self.assertEqual(self.client.DHCP_IP, IP("1.1.1.2"))
+
+    def test_WaitAcrossRebind(self):
+        # A caller waiting on a renewal is woken by the rebind that replaces it
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendDHCP("init"))
+            self.client.DHCP_IP = IP("1.1.1.99")
+            self.assertTrue(self.A.sendDHCP("renew", timeout=60))
+        self.assertGreater(self.sim.now, 52) # At T2
+        self.assertEqual(self.client.state, "BOUND")
+
+    def test_Lapse(self):
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendDHCP("init"))
+        self.A.interfaces[0].link.up = False
+        with redirect_stdout(self.output):
+            self.sim.run(until=self.sim.now + 61)
+        self.assertEqual(self.A.getIP(), IP_ANY)
+        self.assertEqual(self.client.state, "SELECTING")
+
+        # Back to INIT and Discovering; the server is there again eventually
+        self.A.interfaces[0].link.up = True
+        with redirect_stdout(self.output):
+            self.sim.run(until=self.sim.now + 70)
+        self.assertTrue(self.A.interfaces[0].inSubnet(IP("1.1.1.1")))
+
+class VLANTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        A (10), B (20) --- S1 ==trunk== S2 --- C (10), D (20)
+        """
+        self.sim = Scheduler()
+        with self.sim:
+            self.A, self.B, self.C, self.D = [Host(["1.1.1." + str(i) + "/24"], debug=0) for i in range(2, 6)]
+            self.S1 = Switch([self.A, self.B], debug=0)
+            self.S2 = Switch([self.S1, self.C, self.D], debug=0)
+        for S, host, vlan in ((self.S1, self.A, 10), (self.S1, self.B, 20), (self.S2, self.C, 10), (self.S2, self.D, 20)):
+            host.interfaces[0].gateway = "1.1.1.1/24"
+            S.setAccess(S.interfaces_by_link[host.interfaces[0].linkid], vlan)
+        self.output = io.StringIO()
+
+    def test_Ports(self):
+        trunk = self.S2.interfaces[0]
+        self.assertTrue(trunk.trunk)
+        self.assertEqual(self.S2.vlan_ports[10], [trunk, self.S2.interfaces[1]])
+        self.assertEqual(self.S2.vlan_ports[20], [trunk, self.S2.interfaces[2]])
+
+    def test_SameVLAN(self):
+        with redirect_stdout(self.output):
+            self.assertEqual(self.A.sendARP(self.C.getIP()), self.C.id)
+        # A was learned on VLAN 10 only, across the trunk
+        self.assertIn(self.A.id, self.S2.mac_tables[10])
+        self.assertNotIn(self.A.id, self.S2.mac_tables.get(20, {}))
+        self.assertNotIn(self.A.id, self.S2.mac_table)
+
+    def test_Isolation(self):
+        with redirect_stdout(self.output):
+            self.assertFalse(self.A.sendARP(self.B.getIP(), timeout=1))
+            self.assertFalse(self.A.sendARP(self.D.getIP(), timeout=1))
+        # The broadcast only went out of VLAN 10's ports
+        self.assertEqual(self.S1.floods + self.S2.floods, 4)
+
+    def test_PreResolve(self):
+        preResolve([self.A, self.B, self.C, self.D])
+        self.assertEqual(self.A.interfaces[0].ARPHandler.arp_cache.get(self.C.getIP()), self.C.id)
+        self.assertNotIn(self.B.getIP(), self.A.interfaces[0].ARPHandler.arp_cache)
+        self.assertNotIn(self.D.getIP(), self.A.interfaces[0].ARPHandler.arp_cache)
+
+    def test_AllowedVLANs(self):
+        self.S1.setTrunk(self.S1.interfaces_by_link[self.S2.interfaces[0].linkid], allowed=[20])
+        with redirect_stdout(self.output):
+            self.assertFalse(self.A.sendARP(self.C.getIP(), timeout=1))
+            self.assertEqual(self.B.sendARP(self.D.getIP()), self.D.id)
+
+class STPTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        A --- S1 ---- S2 --- B
+               |      |
+               +- S3 -+
+        """
+        self.sim = Scheduler()
+        with self.sim:
+            self.A = Host(["1.1.1.2/24"], debug=0)
+            self.B = Host(["1.1.1.3/24"], debug=0)
+            self.S1 = Switch([self.A], debug=0, stp=True)
+            self.S2 = Switch([self.S1, self.B], debug=0, stp=True)
+            self.S3 = Switch([self.S1, self.S2], debug=0, stp=True)
+        self.switches = (self.S1, self.S2, self.S3)
+        for host in (self.A, self.B):
+            host.interfaces[0].gateway = "1.1.1.1/24"
+        self.output = io.StringIO()
+
+    def roles(self):
+        return [port.role for S in self.switches for port in S.STPHandler.ports.values()]
+
+    def test_Converge(self):
+        self.sim.run(until=2 * self.S1.STPHandler.forward_delay + 1)
+        roots = set(S.STPHandler.root for S in self.switches)
+        self.assertEqual(roots, {min(S.STPHandler.bridge for S in self.switches)})
+        self.assertEqual(self.roles().count("alternate"), 1)
+        self.assertEqual(self.roles().count("root"), 2)
+
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendICMP(self.B.getIP()))
+        # Nothing looped: every switch flooded A's ARP broadcast exactly once
+        self.assertEqual([S.floods for S in self.switches], [1, 1, 1])
+
+    def test_LinkFailure(self):
+        self.sim.run(until=40)
+        # Cut one of the links that are forwarding
+        S, port = next((S, port) for S in self.switches for port in S.STPHandler.ports.values()
+            if port.role == "root")
+        port.interface.link.up = False
+        self.sim.run(until=self.sim.now + 2 * S.STPHandler.forward_delay + 1)
+
+        self.assertNotIn("alternate", self.roles())
+        self.assertEqual(self.roles().count("disabled"), 2)
+        with redirect_stdout(self.output):
+            self.assertTrue(self.A.sendICMP(self.B.getIP()))
+
+class AsyncRuntimeTestCase(unittest.TestCase):
+    def test_ICMPAcrossRouter(self):
+        """
+        A --- S --- R --- B, on a single event loop
+        """
+        async def run():
+            with AsyncRuntime() as rt:
+                A = Host(["1.1.1.2/24"], debug=0)
+                B = Host(["2.2.2.2/24"], debug=0)
+                S1 = Switch([A], debug=0)
+                R1 = Router(["1.1.1.1/24", "2.2.2.1/24"], [S1, B], debug=0)
+            config(*rt.devices)
+            A.interfaces[0].gateway = "1.1.1.1/24"
+            B.interfaces[0].gateway = "2.2.2.1/24"
+
+            results = await asyncio.gather(A.sendICMP(B.getIP()), B.sendICMP(A.getIP()))
+            await rt.stop()
+            return results
+
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(asyncio.run(run()), [True, True])
+
+    def test_CoalescedARP(self):
+        async def run():
+            with AsyncRuntime() as rt:
+                A = Host(["1.1.1.2/24"], debug=0)
+                B = Host(["1.1.1.3/24"], debug=0)
+                S1 = Switch([A, B], debug=0)
+            config(*rt.devices)
+            results = await asyncio.gather(*[A.sendARP(B.getIP()) for i in range(5)])
+            await rt.stop()
+            return results, S1.floods, A.interfaces[0].ARPHandler.waiting
+
+        with redirect_stdout(io.StringIO()):
+            results, floods, waiting = asyncio.run(run())
+        self.assertEqual(len(set(results)), 1)
+        self.assertTrue(results[0].startswith("-H-"))
+        self.assertEqual(floods, 1) # One broadcast for all five
+        self.assertEqual(waiting, {})
+
+    def test_DHCP(self):
+        async def run():
+            with AsyncRuntime() as rt:
+                A = Host(debug=0)
+                D1 = DHCPServer("1.1.1.2/24", gateway="1.1.1.1/24", debug=0)
+                S1 = Switch([A, D1], debug=0)
+            config(*rt.devices)
+            result = await A.sendDHCP("init")
+            await rt.stop()
+            return result, A.getIP()
+
+        with redirect_stdout(io.StringIO()):
+            result, ip = asyncio.run(run())
+        self.assertTrue(result)
+        self.assertTrue(str(ip).startswith("1.1.1."))
+
 if __name__ == "__main__":
     """
     Every test grabs the output of debug info and asserts things about that output
@@ -0,0 +1,183 @@
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
+# Frame handling for the threaded runtime. Instead of a new thread per frame,
+# listeners submit handleData() calls, and their periodic _checkTimeouts(), to
+# a WorkerPool: a fixed set of threads shared by every device (or a subset, see
+# Device.executor).
+#
+# Work is queued per key (the device), and a key is only ever handed to one
+# worker at a time, so each device still handles its frames and timers one by
+# one and in arrival order while different devices run in parallel. Handler
+# and timer state therefore never needs a lock of its own.
+#
+# Handlers are allowed to block (a Router waiting on ARP). A blocked handler
+# keeps running its own device's queue inline through runPending(), since
+# the reply it waits for is queued behind it, and the pool starts a spare
+# worker so blocked handlers can't starve everybody else.
+
+
+class WorkerPool:
+
+    # The pool devices use unless given their own, see shared()
+    default = None
+
+    @classmethod
+    def shared(cls):
+        """
+        :returns: The simulation-wide pool, created on first use
+        """
+        if cls.default is None:
+            cls.default = WorkerPool()
+        return cls.default
+
+    def __init__(self, size=8):
+        """
+        :param size: Number of worker threads, int
+        """
+        self.size = size
+        self.cv = threading.Condition()
+        self.local = threading.local()
+
+        self.queues = {}        # key: deque of (fn, args, submitted at)
+        self.ready = deque()    # keys with work that no worker holds
+        self.threads = 0
+        self.blocked = 0
+
+        # Stats, see stats()
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        with self.cv:
+            for i in range(size):
+                self._spawn()
+
+    def _spawn(self):
+        self.threads += 1
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, key, fn, *args):
+        """
+        Queue fn(*args) behind any other work for key
+
+        :param key: What to serialize on, usually a Device
+        """
+        with self.cv:
+            queue = self.queues.get(key)
+            if queue is None:
+                # Nobody holds this key; make it available to a worker
+                queue = self.queues[key] = deque()
+                self.ready.append(key)
+                self.cv.notify()
+            queue.append((fn, args, time.perf_counter()))
+
+            self.submitted += 1
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def _take(self, key):
+        """
+        Pop the next item for key. Caller holds self.cv
+        """
+        fn, args, submitted = self.queues[key].popleft()
+        wait = time.perf_counter() - submitted
+        self.depth -= 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return fn, args
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            # Mirror a crashed handler thread: report it and keep working
+            traceback.print_exc()
+        with self.cv:
+            self.completed += 1
+
+    def _worker(self):
+        while True:
+            with self.cv:
+                while not self.ready:
+                    # Spare workers retire once blocked handlers have finished
+                    if self.threads - self.blocked > self.size:
+                        self.threads -= 1
+                        return
+                    self.cv.wait()
+                key = self.ready.popleft()
+                fn, args = self._take(key)
+
+            self.local.key = key
+            self._run(fn, args)
+            self.local.key = None
+
+            with self.cv:
+                if self.queues[key]:
+                    self.ready.append(key) # Back of the line, for fairness
+                    self.cv.notify()
+                else:
+                    del self.queues[key]
+
+    def holds(self, key):
+        """
+        :returns: Whether the calling thread is a worker running work for key, bool
+        """
+        return getattr(self.local, "key", None) is key
+
+    def runPending(self, key):
+        """
+        From inside a handler for key, handle key's next queued item inline.
+        Does nothing from any other thread.
+
+        :returns: Whether an item was run, bool
+        """
+        if not self.holds(key):
+            return False
+        with self.cv:
+            if not self.queues[key]:
+                return False
+            fn, args = self._take(key)
+        self._run(fn, args)
+        return True
+
+    @contextmanager
+    def blocking(self):
+        """
+        Wrap a wait inside a handler. If that leaves no worker free, a spare
+        one is started for the duration.
+        """
+        if getattr(self.local, "key", None) is None: # Not one of our workers
+            yield
+            return
+
+        with self.cv:
+            self.blocked += 1
+            if self.threads - self.blocked < self.size:
+                self._spawn()
+        try:
+            yield
+        finally:
+            with self.cv:
+                self.blocked -= 1
+
+    def stats(self):
+        """
+        :returns: Queue depth and how long work waited to start, dict
+        """
+        with self.cv:
+            return {
+                "threads":self.threads,
+                "depth":self.depth,
+                "max_depth":self.max_depth,
+                "submitted":self.submitted,
+                "completed":self.completed,
+                "avg_wait":self.total_wait / self.submitted if self.submitted else 0.0,
+                "max_wait":self.max_wait,
+            }
@@ -1,5 +1,6 @@
 from L2 import *
 from L3 import *
+from Scheduler import Scheduler
 import asyncio
 import time
 
@@ -26,8 +27,8 @@ def ICMPTest_SameSubnet():
     A = Host(["1.1.1.2/24"])
     B = Host(["1.1.1.3/24"])
     S1 = Switch([A, B], debug=0)
-    A.interfaces[0].gateway="abc"
-    B.interfaces[0].gateway="abc"
+    A.interfaces[0].gateway="1.1.1.1/24" # Unused, B is on the same subnet
+    B.interfaces[0].gateway="1.1.1.1/24" # Unused, A is on the same subnet
     A.sendICMP(B.getIP())
     B.sendICMP(A.getIP())
 
@@ -111,6 +112,16 @@ def ICMPTest_DifferentSubnet3():
     A.sendICMP(C.getIP())
     
 
+def ICMPTest_Simulated():
+    """
+    Given topology1(), A -> B in virtual time with no listener threads
+    """
+    with Scheduler() as sim:
+        A, B, C, D, R1, R2, S1, S2, S3 = topology1()
+
+    A.sendICMP(B.getIP())
+    pprint("Virtual time elapsed:", sim.now, "events:", sim.processed)
+
 def ARP_Router_to_Host():
     A = Host(["1.1.1.2/24"])
     R1 = Router(["1.1.1.1/24"], [A, B])
@@ -128,6 +139,7 @@ def main():
     #ICMPTest_SameSubnet()
     #ICMPTest_DifferentSubnet1()
     #ICMPTest_DifferentSubnet2()
+    #ICMPTest_Simulated()
     ICMPTest_DifferentSubnet3()
 
     #SendArpToRouter()